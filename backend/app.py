@@ -1,15 +1,24 @@
+import atexit
+import hashlib
 import os
-from flask import Flask, request, jsonify
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, stream_with_context
 from google.cloud import firestore
 from google.oauth2 import service_account
-import vertexai
-from vertexai.generative_models import GenerativeModel
-from fpdf import FPDF
 from google.cloud import storage
-from datetime import datetime, timedelta
 import json
 from google.cloud import bigquery
 from flask_cors import CORS
+from bigquery_writer import BufferedRowWriter
+from chat_store import ChatWriter, KnownUsers
+import history
+from metrics import metrics
+from model_registry import ModelRegistry
+from pdf_reports import PdfReportJobs, ReportNotFound
+from profile_store import ProfileStore
+from signed_urls import SignedUrlCache
+from response_cache import ResponseCache, create_backend
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -27,22 +36,110 @@ bigquery_client = bigquery.Client(credentials=credentials, project=credentials.p
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)
+
+# Users seen recently skip the existence lookup in /chat
+known_users = KnownUsers(ttl=int(os.environ.get("KNOWN_USER_TTL", 300)))
+# Chat history is saved behind the response in batched commits
+chat_writer = ChatWriter(
+    firestore_client, flush_interval=float(os.environ.get("CHAT_WRITE_FLUSH_INTERVAL", 0.5))
+)
+atexit.register(chat_writer.close)
+# Profile point lookups: TTL cache, then Firestore, BigQuery only as a fallback
+BIGQUERY_USERS_TABLE = "buildnblog.wellness_analytics.users"
+# Fields every onboarded profile has
+REQUIRED_PROFILE_FIELDS = ["name", "age", "height", "weight", "goal", "experience"]
+profile_store = ProfileStore(
+    firestore_client,
+    bigquery_client,
+    BIGQUERY_USERS_TABLE,
+    ttl=int(os.environ.get("PROFILE_CACHE_TTL", 60)),
+    max_bytes_billed=int(os.environ.get("PROFILE_QUERY_MAX_BYTES", 100 * 1024 * 1024)),
+)
+# Onboarding rows are streamed to BigQuery in batches off the request path
+onboarding_writer = BufferedRowWriter(
+    bigquery_client,
+    BIGQUERY_USERS_TABLE,
+    batch_size=int(os.environ.get("ONBOARDING_BATCH_SIZE", 500)),
+    flush_interval=float(os.environ.get("ONBOARDING_FLUSH_INTERVAL", 5)),
+    spill_path=os.environ.get("ONBOARDING_SPILL_PATH", "/tmp/onboarding_rows.ndjson"),
+)
+atexit.register(onboarding_writer.close)
+# Chat-history PDFs are rendered on a small pool, and only when new chats arrived
+PDF_BUCKET = "getufit"
+pdf_reports = PdfReportJobs(
+    firestore_client,
+    storage_client,
+    PDF_BUCKET,
+    load_profile=lambda user_id: profile_store.get(user_id, bigquery_fallback=False),
+    flush_chats=lambda: chat_writer.flush(timeout=5),
+    max_workers=int(os.environ.get("PDF_WORKERS", 2)),
+    report_ttl=int(os.environ.get("PDF_REPORT_CACHE_TTL", 60)),
+)
+atexit.register(pdf_reports.close)
+# Signed /download_pdf URLs are reused until shortly before they expire
+signed_urls = SignedUrlCache(
+    expiration=15 * 60,
+    refresh_margin=int(os.environ.get("SIGNED_URL_REFRESH_MARGIN", 120)),
+)
+# Runs /chat's user lookup while Gemini is generating
+user_check_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="user-check")
 # Vertex AI configuration
 generation_config = {
     "max_output_tokens": 8192,
     "temperature": 1,
     "top_p": 0.95,
 }
+GEMINI_PRO_MODEL = "gemini-1.5-pro-002"
+EMBEDDING_MODEL = "text-embedding-004"
+
+# Shared Gemini clients, created once per worker and reused by every thread
+model_registry = ModelRegistry(
+    project=credentials.project_id, location="us-central1", credentials=credentials
+)
+model_registry.warm_up([(GEMINI_PRO_MODEL, generation_config)])
+
+
+def get_gemini_model():
+    """Return the shared Gemini Pro model configured with generation_config."""
+    return model_registry.get(GEMINI_PRO_MODEL, generation_config)
+
+
+def embed_prompt(text):
+    """Embed a prompt for semantic response-cache lookups."""
+    return model_registry.embedding_model(EMBEDDING_MODEL).get_embeddings([text])[0].values
+
+
+# Gemini responses shared by near-identical /chat and /youtube_links queries
+response_cache = ResponseCache(
+    create_backend(
+        os.environ.get("RESPONSE_CACHE_BACKEND", "memory"),
+        max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 5000)),
+    ),
+    embedder=embed_prompt,
+    # Semantic matching is opt-in; 0 keeps the cache exact-match only
+    similarity=float(os.environ.get("RESPONSE_CACHE_SIMILARITY", 0)),
+    embed_timeout=float(os.environ.get("RESPONSE_CACHE_EMBED_TIMEOUT", 0.5)),
+    ttls={
+        "chat": int(os.environ.get("RESPONSE_CACHE_CHAT_TTL", 3600)),
+        "youtube": int(os.environ.get("RESPONSE_CACHE_YOUTUBE_TTL", 86400)),
+    },
+)
+
+
+def generate_text(prompt):
+    """Return Gemini's text for ``prompt``, or None if it produced none."""
+    response = get_gemini_model().generate_content(
+        [prompt],
+        stream=False,  # Disable streaming for simplicity
+    )
+    try:
+        return response.text.strip()
+    except (AttributeError, ValueError):
+        return None
 
-def call_gemini_api(query):
-    """Call the Gemini model using Vertex AI."""
-    # Initialize Vertex AI
-    vertexai.init(project=credentials.project_id, location="us-central1", credentials=credentials)
-
-    # Load the Gemini Pro model
-    model = GenerativeModel("gemini-1.5-pro-002")
 
-    
+def build_chat_prompt(query):
+    """Wrap a user query in the fitness-only chatbot instructions."""
     base_prompt = (
         "You are a chatbot specialized in fitness, nutrition, and health wellness. "
         "You provide advice strictly related to fitness, nutrition, exercise routines, and wellness plans. "
@@ -51,42 +148,117 @@ def call_gemini_api(query):
         "User query: {query}\n\n"
     )
 
-# Inject the user query into the base_prompt
-    formatted_query = base_prompt.format(query=query)  # Ensure 'user_query' contains the actual user input
+    # Inject the user query into the base_prompt
+    return base_prompt.format(query=query)
 
-# Generate response
-    response = model.generate_content(
-        [formatted_query], 
-        generation_config=generation_config,
-        stream=False,  # Disable streaming for simplicity
+
+def call_gemini_api(query):
+    """Call the Gemini model using Vertex AI, reusing answers to similar queries."""
+    response = response_cache.get_or_generate(
+        "chat", query, lambda: generate_text(build_chat_prompt(query))
     )
+    return response or "Sorry, I could not generate a response."
+
+
+def stream_gemini_api(query):
+    """Yield the chatbot response to ``query`` in chunks as Gemini produces them."""
+    model = get_gemini_model()
+    responses = model.generate_content([build_chat_prompt(query)], stream=True)
+    for chunk in responses:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. a trailing finish reason)
+            continue
+        if text:
+            yield text
+
+
+def user_exists(user_id):
+    """Look the user up in Firestore, remembering ids that exist."""
+    with metrics.timer("chat.user_check"):
+        exists = firestore_client.collection("users").document(user_id).get().exists
+    if exists:
+        known_users.add(user_id)
+    return exists
+
+
+def save_chat(user_id, user_input, response):
+    """Queue a chat exchange for the user's chats subcollection."""
+    chat_writer.save(user_id, {
+        "query": user_input,
+        "response": response,
+        "timestamp": firestore.SERVER_TIMESTAMP,
+    })
+
+
+def sse_event(data, event=None):
+    """Format ``data`` as a server-sent event."""
+    message = f"data: {json.dumps(data)}\n\n"
+    return f"event: {event}\n{message}" if event else message
+
+
+def stream_chat_response(user_id, user_input, started):
+    """Forward Gemini chunks as SSE and save the full reply once the stream ends."""
+    cached, probe = response_cache.lookup("chat", user_input)
+    if cached is not None:
+        save_chat(user_id, user_input, cached)
+        metrics.observe("chat.stream.total", time.perf_counter() - started)
+        yield sse_event({"text": cached})
+        yield sse_event({"response": cached}, event="done")
+        return
+
+    parts = []
+    try:
+        for text in stream_gemini_api(user_input):
+            if not parts:
+                metrics.observe("chat.stream.ttfb", time.perf_counter() - started)
+            parts.append(text)
+            yield sse_event({"text": text})
+    except Exception as e:
+        logging.error(f"Error streaming /chat response: {e}")
+        metrics.incr("chat.stream.errors")
+        yield sse_event({"error": str(e)}, event="error")
+        return
+
+    response = "".join(parts).strip()
+    response_cache.store(probe, response)
+    response = response or "Sorry, I could not generate a response."
+    try:
+        save_chat(user_id, user_input, response)
+    except Exception as e:
+        logging.error(f"Error saving streamed chat for user {user_id}: {e}")
+    metrics.observe("chat.stream.total", time.perf_counter() - started)
+    yield sse_event({"response": response}, event="done")
+
 
-    # Extract and return the generated content
-    if hasattr(response, "text"):
-        return response.text.strip()  # Return the text response
-    else:
-        return "Sorry, I could not generate a response."
-    
 def gemini(query):
     """Call the Gemini model using Vertex AI."""
-    # Initialize Vertex AI
-    vertexai.init(project=credentials.project_id, location="us-central1", credentials=credentials)
-
-    # Load the Gemini Pro model
-    model = GenerativeModel("gemini-1.5-pro-002")
- 
-    # Generate response
-    response = model.generate_content(
-        [query],  # Pass the user query as a list of strings
-        generation_config=generation_config,
-        stream=False,  # Disable streaming for simplicity
+    return generate_text(query) or "Sorry, I could not generate a response."
+
+def build_youtube_prompt(exercise_query):
+    """Prompt Gemini for tutorial videos as a JSON list of titles and URLs."""
+    return (
+        f"Provide a list of the best YouTube video links for the following exercise: {exercise_query}. "
+        "The videos should be high-quality tutorials or demonstrations, "
+        "and return them in this JSON format: "
+        "[{'title': 'Video Title', 'url': 'YouTube URL'}]"
     )
 
-    # Extract and return the generated content
-    if hasattr(response, "text"):
-        return response.text.strip()  # Return the text response
-    else:
-        return "Sorry, I could not generate a response."
+
+def parse_youtube_links(response):
+    """Parse the video list out of a Gemini response.
+
+    Raises json.JSONDecodeError for non-JSON output and ValueError if the
+    JSON is not a list.
+    """
+    # Sanitize response
+    response = response.strip("```json").strip("```").strip()
+    video_links = json.loads(response)
+    if not isinstance(video_links, list):
+        raise ValueError("Invalid response format")
+    return video_links
+
 
 @app.route("/user", methods=["POST", "GET"])
 def user():
@@ -102,6 +274,8 @@ def user():
 
             # Save or update user profile in Firestore
             firestore_client.collection("users").document(user_id).set(user_data)
+            profile_store.put(user_id, user_data)
+            known_users.add(user_id)
             return jsonify({"message": "User profile saved successfully."})
 
         elif request.method == "GET":
@@ -110,9 +284,9 @@ def user():
             if not user_id:
                 return jsonify({"error": "user_id is required"}), 400
 
-            user_doc = firestore_client.collection("users").document(user_id).get()
-            if user_doc.exists:
-                return jsonify(user_doc.to_dict())
+            user_data = profile_store.get(user_id, bigquery_fallback=False)
+            if user_data is not None:
+                return jsonify(user_data)
             else:
                 return jsonify({"error": "User not found"}), 404
 
@@ -122,31 +296,43 @@ def user():
 @app.route("/chat", methods=["POST"])
 def chat():
     """Handle user queries and provide AI-generated responses."""
+    started = time.perf_counter()
     try:
         # Get user input from request
         user_input = request.json.get("query")
         user_id = request.json.get("user_id")
+        # Only a JSON true opts in; strings like "false" must not start a stream
+        stream = request.json.get("stream") is True
 
         if not user_input or not user_id:
             return jsonify({"error": "Invalid input"}), 400
 
-        # Verify if user exists
-        user_doc = firestore_client.collection("users").document(user_id).get()
-        if not user_doc.exists:
-            return jsonify({"error": "User not found. Please create a user profile first."}), 404
+        # Verify the user exists, concurrently with generation unless seen recently
+        user_check = None
+        if user_id not in known_users:
+            user_check = user_check_executor.submit(user_exists, user_id)
+
+        # Opt-in streaming: forward chunks as server-sent events
+        if stream:
+            if user_check is not None and not user_check.result():
+                return jsonify({"error": "User not found. Please create a user profile first."}), 404
+            return Response(
+                stream_with_context(stream_chat_response(user_id, user_input, started)),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
 
         # Call the Gemini API
         response = call_gemini_api(user_input)
 
-        # Save interaction to Firestore under the user's document
-        chat_data = {
-            "query": user_input,
-            "response": response,
-            "timestamp": firestore.SERVER_TIMESTAMP
-        }
-        # Save chat data inside user's subcollection
-        firestore_client.collection("users").document(user_id).collection("chats").add(chat_data)
+        if user_check is not None and not user_check.result():
+            metrics.incr("chat.unknown_user_generations")
+            return jsonify({"error": "User not found. Please create a user profile first."}), 404
+
+        # Save interaction under the user's document without waiting for the write
+        save_chat(user_id, user_input, response)
 
+        metrics.observe("chat.total", time.perf_counter() - started)
         return jsonify({"response": response})
 
     except Exception as e:
@@ -160,33 +346,26 @@ def youtube_links():
         if not exercise_query:
             return jsonify({"error": "Exercise query is required"}), 400
 
-        # Prompt to request YouTube links
-        youtube_prompt = (
-            f"Provide a list of the best YouTube video links for the following exercise: {exercise_query}. "
-            "The videos should be high-quality tutorials or demonstrations, "
-            "and return them in this JSON format: "
-            "[{'title': 'Video Title', 'url': 'YouTube URL'}]"
-        )
-
-        # Call the Gemini API with the YouTube prompt
-        response = gemini(youtube_prompt)
+        # Reuse links generated for the same or a similar exercise
+        cached, probe = response_cache.lookup("youtube", exercise_query)
+        if cached is not None:
+            response = cached
+        else:
+            # Call the Gemini API with the YouTube prompt
+            response = gemini(build_youtube_prompt(exercise_query))
 
         # Log raw response for debugging
         logging.debug(f"Raw response from Gemini Pro: {response}")
 
-        # Sanitize response
-        response = response.strip("```json").strip("```").strip()
-
         # Parse the response
         try:
-            video_links = json.loads(response)
-            if isinstance(video_links, list):
-                return jsonify({"videos": video_links})
-            else:
-                raise ValueError("Invalid response format")
+            video_links = parse_youtube_links(response)
         except json.JSONDecodeError:
             logging.error(f"Failed to parse response: {response}")
             return jsonify({"error": "Failed to parse response from Gemini Pro"}), 500
+        # Only responses that parsed are worth caching
+        response_cache.store(probe, response)
+        return jsonify({"videos": video_links})
 
     except Exception as e:
         logging.error(f"Error in /youtube_links: {e}")
@@ -195,80 +374,135 @@ def youtube_links():
 
 @app.route("/generate_pdf", methods=["POST"])
 def generate_pdf():
-    """Generate a PDF for a user's chat history and wellness plan."""
+    """Generate a PDF for a user's chat history and wellness plan.
+
+    With ``"async": true`` the PDF is rendered in the background and the
+    response carries a job id to poll at /pdf_status. ``"force": true``
+    re-renders even if no chats arrived since the last PDF.
+    """
     try:
         # Get user_id from the request
         user_id = request.json.get("user_id")
         if not user_id:
             return jsonify({"error": "user_id is required"}), 400
+        force = bool(request.json.get("force", False))
 
-        # Fetch user profile
-        user_doc = firestore_client.collection("users").document(user_id).get()
-        if not user_doc.exists:
-            return jsonify({"error": "User not found"}), 404
-        user_data = user_doc.to_dict()
-
-        # Fetch chat history
-        chats_ref = firestore_client.collection("users").document(user_id).collection("chats")
-        chat_docs = chats_ref.stream()
-        chat_history = [doc.to_dict() for doc in chat_docs]
-
-        if not chat_history:
-            return jsonify({"error": "No chat history found for this user."}), 404
-
-        # Create a PDF
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
-
-        # Add user profile to the PDF
-        pdf.cell(200, 10, txt="Personalized Wellness Plan", ln=True, align="C")
-        pdf.cell(200, 10, txt=f"User: {user_data.get('name', 'N/A')} (ID: {user_id})", ln=True)
-        pdf.cell(200, 10, txt=f"Age: {user_data.get('age', 'N/A')} | Gender: {user_data.get('gender', 'N/A')}", ln=True)
-        pdf.ln(10)  # Add some spacing
-
-        # Add chat history to the PDF
-        pdf.set_font("Arial", size=10)
-        for chat in chat_history:
-            pdf.cell(200, 10, txt=f"Query: {chat.get('query', 'N/A')}", ln=True)
-            pdf.multi_cell(0, 10, txt=f"Response: {chat.get('response', 'N/A')}")
-            pdf.ln(5)
-
-        # Save the PDF to memory or Cloud Storage
-        pdf_file_name = f"{user_id}_wellness_plan.pdf"
-        bucket_name = "getufit"  # Replace with your Cloud Storage bucket name
-
-        # Upload PDF to Cloud Storage
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(pdf_file_name)
-        blob.upload_from_string(pdf.output(dest="S").encode("latin1"), content_type="application/pdf")
+        if request.json.get("async"):
+            job = pdf_reports.submit(user_id, force=force)
+            return jsonify({
+                "message": "PDF generation started.",
+                "job_id": job["job_id"],
+                "status": job["status"],
+            }), 202
 
-        pdf_url = f"https://storage.googleapis.com/{bucket_name}/{pdf_file_name}"
-        return jsonify({"message": "PDF generated successfully.", "pdf_url": pdf_url})
+        try:
+            result = pdf_reports.run(user_id, force=force)
+        except ReportNotFound as e:
+            return jsonify({"error": str(e)}), 404
+        return jsonify({"message": "PDF generated successfully.", **result})
 
     except Exception as e:
         logging.error(f"Error in /generate_pdf: {e}")
         return jsonify({"error": str(e)}), 500
+
+
+@app.route("/pdf_status", methods=["GET"])
+def pdf_status():
+    """Report a PDF job's progress, or the user's last render when given user_id."""
+    try:
+        job_id = request.args.get("job_id")
+        user_id = request.args.get("user_id")
+        if job_id:
+            job = pdf_reports.status(job_id)
+            if job is None:
+                return jsonify({"error": "PDF job not found"}), 404
+            return jsonify(job)
+        if user_id:
+            report = pdf_reports.report(user_id)
+            if report is None:
+                return jsonify({"error": "PDF not found"}), 404
+            return jsonify(report)
+        return jsonify({"error": "job_id or user_id is required"}), 400
+
+    except Exception as e:
+        logging.error(f"Error in /pdf_status: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# Page size limits for /chat_history
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_PAGE_SIZE", 50))
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+
+
+@app.route("/chat_history", methods=["GET"])
+def chat_history():
+    """Return one page of a user's chats in timestamp order.
+
+    Pass the returned ``next_cursor`` as ``cursor`` to get the next page;
+    ``order=desc`` pages from the newest chat backwards.
+    """
+    try:
+        user_id = request.args.get("user_id")
+        if not user_id:
+            return jsonify({"error": "user_id is required"}), 400
+        try:
+            limit = int(request.args.get("limit", CHAT_HISTORY_PAGE_SIZE))
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        limit = max(1, min(limit, CHAT_HISTORY_MAX_PAGE_SIZE))
+        direction = history.DESCENDING if request.args.get("order") == "desc" else history.ASCENDING
+
+        # Exchanges still in the write-behind queue belong on the first page
+        if not request.args.get("cursor"):
+            chat_writer.flush(timeout=5)
+        try:
+            chats, next_cursor = history.read_page(
+                history.chats_collection(firestore_client, user_id),
+                limit,
+                cursor=request.args.get("cursor"),
+                direction=direction,
+            )
+        except KeyError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        return jsonify({"chats": chats, "next_cursor": next_cursor})
+
+    except Exception as e:
+        logging.error(f"Error in /chat_history: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route("/download_pdf", methods=["GET"])
 def download_pdf():
     user_id = request.args.get("user_id")
     if not user_id:
         return jsonify({"error": "user_id is required"}), 400
 
-    bucket_name = "getufit"
-    pdf_file_name = f"{user_id}_wellness_plan.pdf"
+    pdf_file_name = PdfReportJobs.blob_name(user_id)
 
     try:
-        bucket = storage_client.bucket(bucket_name)
+        bucket = storage_client.bucket(PDF_BUCKET)
         blob = bucket.blob(pdf_file_name)
 
-        if not blob.exists():
-            return jsonify({"error": "PDF not found"}), 404
-
-        signed_url = blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(minutes=15),
-            method="GET",
+        # The render record says whether and which generation of the PDF exists
+        report = pdf_reports.report(user_id)
+        if report is not None:
+            generation = report.get("generation")
+            metrics.incr("signed_urls.exists_checks_avoided")
+        else:
+            # PDFs rendered before render records existed
+            legacy_blob = bucket.get_blob(pdf_file_name)
+            if legacy_blob is None:
+                return jsonify({"error": "PDF not found"}), 404
+            generation = legacy_blob.generation
+
+        signed_url = signed_urls.get(
+            user_id,
+            generation,
+            lambda expiration: blob.generate_signed_url(
+                version="v4",
+                expiration=expiration,
+                method="GET",
+            ),
         )
         return jsonify({"pdf_url": signed_url})
 
@@ -288,8 +522,7 @@ def onboard_user():
             return jsonify({"error": "user_id is required"}), 400
 
         # Validate required fields
-        required_fields = ["name", "age", "height", "weight", "goal", "experience"]
-        for field in required_fields:
+        for field in REQUIRED_PROFILE_FIELDS:
             if not user_data.get(field):
                 return jsonify({"error": f"{field} is required"}), 400
 
@@ -297,14 +530,13 @@ def onboard_user():
         try:
             logging.debug("Attempting to save user data to Firestore.")
             firestore_client.collection("users").document(user_id).set(user_data)
+            profile_store.put(user_id, user_data)
             logging.debug(f"Successfully saved user data to Firestore for user_id: {user_id}")
         except Exception as firestore_error:
             logging.error(f"Error saving to Firestore: {firestore_error}")
 
-        # Save data to BigQuery
+        # Queue data for BigQuery; the writer batches, retries and spills to disk
         try:
-            logging.debug("Attempting to save user data to BigQuery.")
-            bigquery_table = "buildnblog.wellness_analytics.users"
             row_to_insert = {
                 "user_id": user_id,
                 "name": user_data["name"],
@@ -315,8 +547,8 @@ def onboard_user():
                 "health_issues": user_data.get("health_issues", ""),
                 "experience": user_data["experience"],
             }
-            bigquery_client.insert_rows_json(bigquery_table, [row_to_insert])
-            logging.debug(f"Successfully saved user data to BigQuery for user_id: {user_id}")
+            onboarding_writer.insert(row_to_insert)
+            logging.debug(f"Queued user data for BigQuery for user_id: {user_id}")
         except Exception as bigquery_error:
             logging.error(f"Error saving to BigQuery: {bigquery_error}")
 
@@ -339,20 +571,12 @@ def fetch_user_from_bigquery():
         if not user_id:
             return jsonify({"error": "user_id is required"}), 400
 
-        # Query BigQuery for user data
-        query = f"""
-        SELECT *
-        FROM `buildnblog.wellness_analytics.users`
-        WHERE user_id = '{user_id}'
-        """
-        logging.debug(f"Executing BigQuery: {query}")
-        query_job = bigquery_client.query(query)
-        results = [dict(row) for row in query_job]
-
-        if not results:
+        # Served from the profile cache or Firestore; BigQuery only if neither has the user
+        user_data = profile_store.get(user_id, required_fields=REQUIRED_PROFILE_FIELDS)
+        if user_data is None:
             return jsonify({"error": "User not found in BigQuery"}), 404
 
-        return jsonify({"user_data": results[0]})
+        return jsonify({"user_data": user_data})
 
     except Exception as e:
         logging.error(f"Error fetching user data from BigQuery: {e}")
@@ -414,31 +638,17 @@ def fetch_user_from_bigquery():
 #         logging.error(f"Error in /generate_fitness_plan_from_bigquery: {e}")
 #         return jsonify({"error": str(e)}), 500
 
-@app.route("/generate_fitness_plan_from_bigquery", methods=["GET"])
-def generate_fitness_plan_from_bigquery():
-    """Generate personalized fitness plan from BigQuery data."""
-    try:
-        user_id = request.args.get("user_id")
-        if not user_id:
-            return jsonify({"error": "user_id is required"}), 400
-
-        # Fetch user data from BigQuery
-        query = f"""
-        SELECT *
-        FROM `buildnblog.wellness_analytics.users`
-        WHERE user_id = '{user_id}'
-        """
-        query_job = bigquery_client.query(query)
-        results = [dict(row) for row in query_job]
-
-        if not results:
-            return jsonify({"error": "User not found in BigQuery"}), 404
+# Bump when the plan prompt changes so stored plans are regenerated
+PLAN_PROMPT_VERSION = 2
+# Profile fields that feed the plan prompt; a change to any of them invalidates the plan
+PLAN_PROFILE_FIELDS = REQUIRED_PROFILE_FIELDS + ["health_issues"]
+# Document id of the stored plan inside users/{id}/fitness_plans
+CURRENT_PLAN_ID = "current"
 
-        user_data = results[0]
-        logging.debug(f"User data retrieved from BigQuery: {user_data}")
 
-        # Generate fitness plan using AI
-        ai_query = f"""
+def build_fitness_plan_prompt(user_data):
+    """Prompt Gemini for a weekly plan in the JSON shape the frontend renders."""
+    return f"""
         Generate a personalized fitness plan for the following user:
         Name: {user_data['name']}
         Age: {user_data['age']}
@@ -468,11 +678,78 @@ def generate_fitness_plan_from_bigquery():
             "nutrition": "string"
         }}
         """
-        ai_response = call_gemini(ai_query)
+
+
+def plan_fingerprint(user_data):
+    """Hash the prompt version and the profile fields the plan was generated from."""
+    fields = {field: user_data.get(field) for field in PLAN_PROFILE_FIELDS}
+    payload = json.dumps([PLAN_PROMPT_VERSION, fields], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def current_plan_ref(user_id):
+    return (
+        firestore_client.collection("users").document(user_id)
+        .collection("fitness_plans").document(CURRENT_PLAN_ID)
+    )
+
+
+@app.route("/generate_fitness_plan_from_bigquery", methods=["GET"])
+def generate_fitness_plan_from_bigquery():
+    """Return the user's fitness plan, generating it only when their profile changed.
+
+    Pass ``refresh=true`` to regenerate regardless of the stored fingerprint.
+    """
+    started = time.perf_counter()
+    try:
+        user_id = request.args.get("user_id")
+        if not user_id:
+            return jsonify({"error": "user_id is required"}), 400
+        refresh = request.args.get("refresh", "").lower() in ("1", "true", "yes")
+
+        user_data = profile_store.get(user_id, required_fields=REQUIRED_PROFILE_FIELDS)
+        if user_data is None:
+            return jsonify({"error": "User not found in BigQuery"}), 404
+        logging.debug(f"User data for fitness plan: {user_data}")
+
+        fingerprint = plan_fingerprint(user_data)
+        plan_ref = current_plan_ref(user_id)
+        plan_doc = plan_ref.get()
+        plan = plan_doc.to_dict() if plan_doc.exists else None
+        if plan and not refresh and plan.get("fingerprint") == fingerprint:
+            metrics.incr("fitness_plan.hits")
+            metrics.observe("fitness_plan.cached", time.perf_counter() - started)
+            return jsonify({
+                "raw_ai_response": plan["raw_ai_response"],
+                "cached": True,
+                "generated_at": plan.get("generated_at"),
+            })
+
+        metrics.incr("fitness_plan.refreshes" if refresh else "fitness_plan.misses")
+        ai_response = call_gemini(build_fitness_plan_prompt(user_data))
         logging.debug(f"Raw AI Response: {ai_response}")
+        if not ai_response:
+            return jsonify({"error": "Failed to generate fitness plan"}), 500
 
+        # Keep the parsed plan alongside the raw text for /get_saved_plan readers
+        record = {}
+        try:
+            parsed = json.loads(sanitize_response(ai_response))
+            if isinstance(parsed, dict):
+                record.update(parsed)
+        except json.JSONDecodeError:
+            logging.warning(f"Stored fitness plan for {user_id} is not valid JSON.")
+        record.update({
+            "raw_ai_response": ai_response,
+            "fingerprint": fingerprint,
+            "prompt_version": PLAN_PROMPT_VERSION,
+            "generated_at": firestore.SERVER_TIMESTAMP,
+        })
+        plan_ref.set(record)
+
+        metrics.observe("fitness_plan.generated", time.perf_counter() - started)
         # Send the raw AI response to the frontend
-        return jsonify({"raw_ai_response": ai_response})
+        return jsonify({"raw_ai_response": ai_response, "cached": False})
 
     except Exception as e:
         logging.error(f"Error in /generate_fitness_plan_from_bigquery: {e}")
@@ -554,15 +831,14 @@ def get_saved_plan():
         if not user_id:
             return jsonify({"error": "user_id is required"}), 400
 
-        # Fetch the latest fitness plan
-        plans_ref = firestore_client.collection("users").document(user_id).collection("fitness_plans")
-        plans = [doc.to_dict() for doc in plans_ref.stream()]
-
-        if not plans:
+        # The current plan is one known document; only users whose plans predate it need a query
+        plan_doc = current_plan_ref(user_id).get()
+        if not plan_doc.exists:
+            plans_ref = history.plans_collection(firestore_client, user_id)
+            plan_doc = history.latest(plans_ref, "generated_at") or history.latest(plans_ref, "__name__")
+        if plan_doc is None:
             return jsonify({"error": "No fitness plan found for this user."}), 404
-
-        # Return the most recent plan
-        return jsonify(plans[-1])
+        return jsonify(plan_doc.to_dict())
 
     except Exception as e:
         logging.error(f"Error in /get_saved_plan: {e}")
@@ -578,9 +854,8 @@ def get_saved_plan():
 def call_gemini(query):
     """Call the Gemini model using Vertex AI to generate structured content."""
     try:
-        vertexai.init(project=credentials.project_id, location="us-central1", credentials=credentials)
-        model = GenerativeModel("gemini-1.5-pro-002")
-        response = model.generate_content([query], generation_config=generation_config, stream=False)
+        model = get_gemini_model()
+        response = model.generate_content([query], stream=False)
         if hasattr(response, 'candidates') and response.candidates:
             return response.candidates[0].content.parts[0].text
         return None
@@ -620,5 +895,16 @@ def health_check():
     """Health check endpoint."""
     return jsonify({"status": "Backend is running!"})
 
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Expose in-process counters and latency summaries."""
+    snapshot = metrics.snapshot()
+    snapshot["response_cache"] = response_cache.stats()
+    snapshot["profiles"] = profile_store.stats()
+    snapshot["onboarding_writer"] = onboarding_writer.stats()
+    snapshot["signed_urls"] = signed_urls.stats()
+    return jsonify(snapshot)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080)
@@ -0,0 +1,255 @@
+"""Asyncio serving mode for the backend.
+
+Run with ``gunicorn -k uvicorn.workers.UvicornWorker asgi:app``. The
+I/O-bound routes (/chat, /user, /youtube_links) are served natively with the
+async Firestore client and ``generate_content_async``, so one worker can keep
+many Gemini calls in flight. Every other route falls through to the Flask app,
+which runs on a bounded thread pool together with the blocking BigQuery, GCS
+and FPDF work.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+
+from a2wsgi import WSGIMiddleware
+from google.cloud import firestore
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as backend
+from metrics import metrics
+
+# Threads available to the mounted Flask routes and their blocking SDK calls
+BLOCKING_WORKERS = int(os.environ.get("ASGI_BLOCKING_WORKERS", 16))
+
+# Created inside the event loop at startup
+async_firestore = None
+
+
+def users_collection():
+    return async_firestore.collection("users")
+
+
+async def generate_async(prompt):
+    """Await a Gemini response for ``prompt``; None if it has no text."""
+    model = backend.get_gemini_model()
+    response = await model.generate_content_async([prompt])
+    try:
+        return response.text.strip()
+    except (AttributeError, ValueError):
+        return None
+
+
+async def stream_async(prompt):
+    """Yield Gemini response chunks for ``prompt`` as they arrive."""
+    model = backend.get_gemini_model()
+    responses = await model.generate_content_async([prompt], stream=True)
+    async for chunk in responses:
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            yield text
+
+
+async def cached_chat(user_input):
+    """Answer from the response cache, or generate and cache the reply."""
+    cached, probe = await asyncio.to_thread(backend.response_cache.lookup, "chat", user_input)
+    if cached is not None:
+        return cached
+    response = await generate_async(backend.build_chat_prompt(user_input))
+    await asyncio.to_thread(backend.response_cache.store, probe, response)
+    return response
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except json.JSONDecodeError:
+        return {}
+
+
+async def health_check(request):
+    return JSONResponse({"status": "Backend is running!"})
+
+
+async def user(request):
+    """Save or retrieve user profiles."""
+    try:
+        if request.method == "POST":
+            user_data = await read_json(request)
+            user_id = user_data.get("user_id")
+            if not user_id:
+                return JSONResponse({"error": "user_id is required"}, status_code=400)
+            await users_collection().document(user_id).set(user_data)
+            backend.profile_store.put(user_id, user_data)
+            backend.known_users.add(user_id)
+            return JSONResponse({"message": "User profile saved successfully."})
+
+        user_id = request.query_params.get("user_id")
+        if not user_id:
+            return JSONResponse({"error": "user_id is required"}, status_code=400)
+        user_data = backend.profile_store.cached(user_id)
+        if user_data is None:
+            user_doc = await users_collection().document(user_id).get()
+            if not user_doc.exists:
+                return JSONResponse({"error": "User not found"}, status_code=404)
+            user_data = user_doc.to_dict()
+            backend.profile_store.put(user_id, user_data)
+        return JSONResponse(user_data)
+
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def user_exists(user_id):
+    """Look the user up unless they were seen recently, remembering ids that exist."""
+    if user_id in backend.known_users:
+        return True
+    start = time.perf_counter()
+    user_doc = await users_collection().document(user_id).get()
+    metrics.observe("chat.user_check", time.perf_counter() - start)
+    if user_doc.exists:
+        backend.known_users.add(user_id)
+    return user_doc.exists
+
+
+async def stream_chat_response(user_id, user_input, started):
+    """Forward Gemini chunks as SSE and save the full reply once the stream ends."""
+    cached, probe = await asyncio.to_thread(backend.response_cache.lookup, "chat", user_input)
+    if cached is not None:
+        backend.save_chat(user_id, user_input, cached)
+        metrics.observe("chat.stream.total", time.perf_counter() - started)
+        yield backend.sse_event({"text": cached})
+        yield backend.sse_event({"response": cached}, event="done")
+        return
+
+    parts = []
+    try:
+        async for text in stream_async(backend.build_chat_prompt(user_input)):
+            if not parts:
+                metrics.observe("chat.stream.ttfb", time.perf_counter() - started)
+            parts.append(text)
+            yield backend.sse_event({"text": text})
+    except Exception as e:
+        logging.error(f"Error streaming /chat response: {e}")
+        metrics.incr("chat.stream.errors")
+        yield backend.sse_event({"error": str(e)}, event="error")
+        return
+
+    response = "".join(parts).strip()
+    await asyncio.to_thread(backend.response_cache.store, probe, response)
+    response = response or "Sorry, I could not generate a response."
+    try:
+        backend.save_chat(user_id, user_input, response)
+    except Exception as e:
+        logging.error(f"Error saving streamed chat for user {user_id}: {e}")
+    metrics.observe("chat.stream.total", time.perf_counter() - started)
+    yield backend.sse_event({"response": response}, event="done")
+
+
+async def chat(request):
+    """Handle user queries and provide AI-generated responses."""
+    started = time.perf_counter()
+    try:
+        content = await read_json(request)
+        user_input = content.get("query")
+        user_id = content.get("user_id")
+        if not user_input or not user_id:
+            return JSONResponse({"error": "Invalid input"}, status_code=400)
+
+        not_found = JSONResponse(
+            {"error": "User not found. Please create a user profile first."}, status_code=404
+        )
+        if content.get("stream") is True:
+            if not await user_exists(user_id):
+                return not_found
+            return StreamingResponse(
+                stream_chat_response(user_id, user_input, started),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        # Check the user while Gemini generates
+        exists, response = await asyncio.gather(user_exists(user_id), cached_chat(user_input))
+        if not exists:
+            metrics.incr("chat.unknown_user_generations")
+            return not_found
+        if response is None:
+            response = "Sorry, I could not generate a response."
+        backend.save_chat(user_id, user_input, response)
+
+        metrics.observe("chat.total", time.perf_counter() - started)
+        return JSONResponse({"response": response})
+
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def youtube_links(request):
+    """Generate YouTube links for exercises using Gemini Pro."""
+    try:
+        exercise_query = (await read_json(request)).get("exercise")
+        if not exercise_query:
+            return JSONResponse({"error": "Exercise query is required"}, status_code=400)
+
+        cached, probe = await asyncio.to_thread(
+            backend.response_cache.lookup, "youtube", exercise_query
+        )
+        response = cached or await generate_async(backend.build_youtube_prompt(exercise_query))
+        logging.debug(f"Raw response from Gemini Pro: {response}")
+        try:
+            video_links = backend.parse_youtube_links(response or "")
+        except json.JSONDecodeError:
+            logging.error(f"Failed to parse response: {response}")
+            return JSONResponse(
+                {"error": "Failed to parse response from Gemini Pro"}, status_code=500
+            )
+        await asyncio.to_thread(backend.response_cache.store, probe, response)
+        return JSONResponse({"videos": video_links})
+
+    except Exception as e:
+        logging.error(f"Error in /youtube_links: {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def get_metrics(request):
+    snapshot = metrics.snapshot()
+    snapshot["response_cache"] = backend.response_cache.stats()
+    snapshot["profiles"] = backend.profile_store.stats()
+    snapshot["onboarding_writer"] = backend.onboarding_writer.stats()
+    snapshot["signed_urls"] = backend.signed_urls.stats()
+    return JSONResponse(snapshot)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global async_firestore
+    async_firestore = firestore.AsyncClient(
+        credentials=backend.credentials, project=backend.credentials.project_id
+    )
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route("/", health_check),
+        Route("/user", user, methods=["GET", "POST"]),
+        Route("/chat", chat, methods=["POST"]),
+        Route("/youtube_links", youtube_links, methods=["POST"]),
+        Route("/metrics", get_metrics),
+        # Everything else is served by the Flask app on the bounded pool
+        Mount("/", WSGIMiddleware(backend.app, workers=BLOCKING_WORKERS)),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+    ],
+    lifespan=lifespan,
+)
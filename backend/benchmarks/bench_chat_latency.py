@@ -0,0 +1,137 @@
+"""Compare /chat latency with sequential round trips and with the overlapped pipeline.
+
+Usage: python benchmarks/bench_chat_latency.py [--requests 400] [--concurrency 16]
+           [--lookup-ms 30] [--generate-ms 600] [--write-ms 40] [--users 50]
+
+Firestore and Gemini are replaced by in-process fakes that sleep for the
+configured round-trip times (with lognormal jitter), so the numbers isolate
+how the three calls are scheduled. The sequential path is the original
+handler: lookup, then generate, then ``chats.add``. The overlapped path uses
+KnownUsers, a concurrent lookup and the ChatWriter write-behind queue.
+Against a live server, use loadtest_chat.py instead.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_store import ChatWriter, KnownUsers  # noqa: E402
+
+
+class FakeFirestore:
+    """Just enough of the Firestore client for a chat write and a user lookup."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def collection(self, name):
+        return _Ref(self)
+
+    def batch(self):
+        return _Batch(self)
+
+
+class _Ref:
+    def __init__(self, client):
+        self.client = client
+
+    def document(self, *_):
+        return self
+
+    def collection(self, *_):
+        return self
+
+    def get(self):
+        self.client.latency("lookup")
+        return self
+
+    exists = True
+
+    def add(self, data):
+        self.client.latency("write")
+
+    def set(self, data):
+        self.client.latency("write")
+
+
+class _Batch:
+    def __init__(self, client):
+        self.client = client
+
+    def set(self, ref, data):
+        pass
+
+    def commit(self):
+        self.client.latency("write")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--lookup-ms", type=float, default=30)
+    parser.add_argument("--generate-ms", type=float, default=600)
+    parser.add_argument("--write-ms", type=float, default=40)
+    parser.add_argument("--users", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    medians = {"lookup": args.lookup_ms, "generate": args.generate_ms, "write": args.write_ms}
+
+    def latency(kind):
+        time.sleep(medians[kind] / 1000 * rng.lognormal(0, 0.35))
+
+    client = FakeFirestore(latency)
+    users = [f"user-{i}" for i in rng.integers(0, args.users, args.requests)]
+
+    def sequential(user_id):
+        ref = client.collection("users").document(user_id)
+        if not ref.get().exists:
+            return
+        latency("generate")
+        ref.collection("chats").add({})
+
+    known_users = KnownUsers(ttl=300)
+    writer = ChatWriter(client, flush_interval=0.05)
+    user_check_executor = ThreadPoolExecutor(max_workers=8)
+
+    def user_exists(user_id):
+        exists = client.collection("users").document(user_id).get().exists
+        if exists:
+            known_users.add(user_id)
+        return exists
+
+    def overlapped(user_id):
+        user_check = None
+        if user_id not in known_users:
+            user_check = user_check_executor.submit(user_exists, user_id)
+        latency("generate")
+        if user_check is not None and not user_check.result():
+            return
+        writer.save(user_id, {})
+
+    print(f"{'pipeline':>11} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>7}")
+    for name, handler in (("sequential", sequential), ("overlapped", overlapped)):
+        def timed(user_id):
+            start = time.perf_counter()
+            handler(user_id)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            latencies = np.array(list(executor.map(timed, users))) * 1000
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>11} {np.percentile(latencies, 50):8.1f} "
+            f"{np.percentile(latencies, 99):8.1f} {len(users) / elapsed:7.1f}"
+        )
+    writer.close()
+
+
+if __name__ == "__main__":
+    main()
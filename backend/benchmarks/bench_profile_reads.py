@@ -0,0 +1,140 @@
+"""Compare 1k sequential profile reads: per-request BigQuery jobs vs ProfileStore.
+
+Usage: python benchmarks/bench_profile_reads.py [--reads 1000] [--users 100]
+           [--bigquery-ms 1500] [--bigquery-cached-ms 400] [--firestore-ms 15]
+           [--ttl 60] [--bigquery-sample 20]
+
+Clients are in-process fakes that sleep for the configured latencies, so
+the comparison shows how often each path pays for a round trip. BigQuery
+paths only run --bigquery-sample reads and are extrapolated to --reads
+(marked *), since 1k real query jobs take tens of minutes; the
+parameterized path counts repeat users as BigQuery result-cache hits.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profile_store import ProfileStore  # noqa: E402
+
+
+class FakeJob:
+    def __init__(self, rows, cache_hit):
+        self.rows = rows
+        self.cache_hit = cache_hit
+        self.total_bytes_processed = 10 * 1024 * 1024
+
+    def result(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeBigQuery:
+    def __init__(self, job_seconds, cached_seconds):
+        self.job_seconds = job_seconds
+        self.cached_seconds = cached_seconds
+        self.seen = set()
+
+    def query(self, query, job_config=None):
+        if job_config is not None and job_config.dry_run:
+            return FakeJob([], False)
+        params = job_config.query_parameters if job_config is not None else []
+        key = (query, tuple(p.value for p in params))
+        cache_hit = key in self.seen and bool(job_config and job_config.use_query_cache)
+        self.seen.add(key)
+        time.sleep(self.cached_seconds if cache_hit else self.job_seconds)
+        return FakeJob([{"user_id": "u", "name": "n"}], cache_hit)
+
+
+class FakeFirestore:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def collection(self, name):
+        return self
+
+    def document(self, user_id):
+        return self
+
+    def get(self):
+        time.sleep(self.seconds)
+        return self
+
+    exists = True
+
+    def to_dict(self):
+        return {"user_id": "u", "name": "n"}
+
+
+def report(name, latencies, total, extrapolated=False):
+    latencies = np.array(latencies) * 1000
+    mark = "*" if extrapolated else " "
+    print(
+        f"{name:>24} {total:9.1f}{mark} {np.percentile(latencies, 50):8.1f} "
+        f"{np.percentile(latencies, 99):8.1f}"
+    )
+
+
+def timed_reads(read, user_ids):
+    latencies = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        read(user_id)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reads", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--bigquery-ms", type=float, default=1500)
+    parser.add_argument("--bigquery-cached-ms", type=float, default=400)
+    parser.add_argument("--firestore-ms", type=float, default=15)
+    parser.add_argument("--ttl", type=float, default=60)
+    parser.add_argument("--bigquery-sample", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    user_ids = [f"user-{i}" for i in rng.integers(0, args.users, args.reads)]
+    sample = user_ids[:args.bigquery_sample]
+    scale = args.reads / len(sample)
+    bigquery_client = FakeBigQuery(args.bigquery_ms / 1000, args.bigquery_cached_ms / 1000)
+    firestore_client = FakeFirestore(args.firestore_ms / 1000)
+
+    print(f"{'path':>24} {'total s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+
+    def fstring_query(user_id):
+        # The original lookup: a fresh, unparameterized job per request
+        query = f"SELECT * FROM `t` WHERE user_id = '{user_id}' -- {time.time_ns()}"
+        return list(bigquery_client.query(query))
+
+    latencies = timed_reads(fstring_query, sample)
+    report("bigquery f-string", latencies, sum(latencies) * scale, extrapolated=True)
+
+    # Repeat lookups of the same user are answered from BigQuery's result cache
+    store = ProfileStore(firestore_client, bigquery_client, "t", ttl=0)
+    misses = timed_reads(store.query_bigquery, sample)
+    hits = timed_reads(store.query_bigquery, sample)
+    unique = len(set(user_ids))
+    total = unique * np.mean(misses) + (args.reads - unique) * np.mean(hits)
+    report("bigquery parameterized", misses + hits, total, extrapolated=True)
+
+    store = ProfileStore(firestore_client, bigquery_client, "t", ttl=0)
+    latencies = timed_reads(store.get, user_ids)
+    report("firestore", latencies, sum(latencies))
+
+    store = ProfileStore(firestore_client, bigquery_client, "t", ttl=args.ttl)
+    latencies = timed_reads(store.get, user_ids)
+    report(f"firestore + {args.ttl:g}s cache", latencies, sum(latencies))
+    print("* extrapolated from --bigquery-sample reads")
+
+
+if __name__ == "__main__":
+    main()
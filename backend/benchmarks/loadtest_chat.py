@@ -0,0 +1,90 @@
+"""Closed-loop load test for POST /chat at increasing concurrency.
+
+Usage: python benchmarks/loadtest_chat.py --url http://localhost:8080 --user-id demo
+           [--concurrency 1 8 32 64] [--duration 30] [--query "..."] [--stream]
+
+Run it once against the thread-pool server (app:app) and once with
+SERVING_MODE=asgi to compare throughput and tail latency at the same load.
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def post_chat(url, payload, timeout):
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/chat",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+        return response.status
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_level(args, payload, concurrency):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                post_chat(args.url, payload, args.timeout)
+            except (urllib.error.URLError, OSError):
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    elapsed = time.perf_counter() - start
+    return latencies, errors[0], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--user-id", required=True)
+    parser.add_argument("--query", default="Suggest a 20 minute low-impact workout.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--stream", action="store_true")
+    args = parser.parse_args()
+
+    payload = {"user_id": args.user_id, "query": args.query}
+    if args.stream:
+        payload["stream"] = True
+
+    print(f"{'conc':>5} {'ok':>6} {'errors':>7} {'req/s':>8} {'p50 s':>8} {'p99 s':>8}")
+    for concurrency in args.concurrency:
+        latencies, errors, elapsed = run_level(args, payload, concurrency)
+        if latencies:
+            p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+        else:
+            p50 = p99 = float("nan")
+        print(
+            f"{concurrency:>5} {len(latencies):>6} {errors:>7} "
+            f"{len(latencies) / elapsed:8.2f} {p50:8.3f} {p99:8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from metrics import metrics
+
+# Per-row error reasons that retrying cannot fix
+REJECTED_REASONS = {"invalid"}
+
+
+class BufferedRowWriter:
+    """Background writer that streams rows into a BigQuery table in batches.
+
+    ``insert`` journals the row to ``spill_path`` (NDJSON, fsynced) and buffers
+    it. A flusher thread sends the buffer with one ``insert_rows_json`` call
+    once it holds ``batch_size`` rows or its oldest row is ``flush_interval``
+    seconds old. Every row keeps the insertId it was given on ``insert``, so
+    retries and replays of the spill file after a restart are deduplicated by
+    BigQuery. Rows BigQuery rejects as invalid go to ``<spill_path>.rejected``;
+    all other failures are retried with exponential backoff and never dropped.
+    Each process needs its own spill file.
+    """
+
+    def __init__(self, client, table, batch_size=500, flush_interval=5.0, spill_path=None,
+                 backoff=0.5, max_backoff=60.0):
+        self._client = client
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._buffer = []  # (row_id, row)
+        self._oldest = None
+        self._failures = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._spill = None
+
+        if spill_path:
+            with self._lock:
+                self._recover()
+                self._rewrite_spill()
+
+        self._thread = threading.Thread(target=self._run, name="bigquery-writer", daemon=True)
+        self._thread.start()
+
+    def insert(self, row):
+        """Queue ``row`` for the table and return its insertId."""
+        row_id = uuid.uuid4().hex
+        with self._lock:
+            if self._spill is not None:
+                self._spill.write(json.dumps({"id": row_id, "row": row}, default=str) + "\n")
+                self._spill.flush()
+                os.fsync(self._spill.fileno())
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append((row_id, row))
+            if len(self._buffer) >= self.batch_size:
+                self._wake.notify()
+        metrics.incr("bigquery_writer.rows_queued")
+        return row_id
+
+    def close(self, timeout=30):
+        """Flush what can be sent within ``timeout``; the rest stays in the spill file."""
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffered_rows": len(self._buffer),
+                "consecutive_failures": self._failures,
+                "spill_path": self.spill_path,
+            }
+
+    # Spill file ----------------------------------------------------------
+
+    def _recover(self):
+        # Caller must hold self._lock
+        if not os.path.exists(self.spill_path):
+            return
+        seen = set()
+        with open(self.spill_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn write from a crash
+                if record["id"] in seen:
+                    continue
+                seen.add(record["id"])
+                self._buffer.append((record["id"], record["row"]))
+        if self._buffer:
+            self._oldest = time.monotonic()
+            metrics.incr("bigquery_writer.rows_recovered", len(self._buffer))
+            logging.info(f"Recovered {len(self._buffer)} unsent rows for {self.table}.")
+
+    def _rewrite_spill(self):
+        # Caller must hold self._lock; keeps exactly the rows not yet written
+        if not self.spill_path:
+            return
+        if self._spill is not None:
+            self._spill.close()
+        tmp_path = f"{self.spill_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for row_id, row in self._buffer:
+                f.write(json.dumps({"id": row_id, "row": row}, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.spill_path)
+        self._spill = open(self.spill_path, "a", encoding="utf-8")
+
+    def _reject(self, rejected):
+        metrics.incr("bigquery_writer.rows_rejected", len(rejected))
+        for row_id, row, errors in rejected:
+            logging.error(f"BigQuery rejected row {row_id} for {self.table}: {errors}")
+        if not self.spill_path:
+            return
+        with open(f"{self.spill_path}.rejected", "a", encoding="utf-8") as f:
+            for row_id, row, errors in rejected:
+                f.write(json.dumps({"id": row_id, "row": row, "errors": errors}, default=str) + "\n")
+
+    # Flushing --------------------------------------------------------------
+
+    def _next_batch(self):
+        # Caller must hold self._lock
+        while not self._closed:
+            if len(self._buffer) >= self.batch_size:
+                break
+            if self._buffer:
+                age = time.monotonic() - self._oldest
+                if age >= self.flush_interval:
+                    break
+                self._wake.wait(self.flush_interval - age)
+            else:
+                self._wake.wait()
+        batch = self._buffer[:self.batch_size]
+        del self._buffer[:len(batch)]
+        self._oldest = time.monotonic() if self._buffer else None
+        return batch
+
+    def _send(self, batch):
+        """Insert ``batch`` and return the rows that should be retried."""
+        start = time.perf_counter()
+        try:
+            errors = self._client.insert_rows_json(
+                self.table,
+                [row for _, row in batch],
+                row_ids=[row_id for row_id, _ in batch],
+                skip_invalid_rows=True,
+            )
+        except Exception as e:
+            metrics.incr("bigquery_writer.request_errors")
+            logging.error(f"Streaming insert of {len(batch)} rows into {self.table} failed: {e}")
+            return batch
+        metrics.observe("bigquery_writer.flush", time.perf_counter() - start)
+
+        row_errors = {error["index"]: error["errors"] for error in errors}
+        retry, rejected = [], []
+        for index, (row_id, row) in enumerate(batch):
+            errs = row_errors.get(index)
+            if not errs:
+                continue
+            metrics.incr("bigquery_writer.row_errors")
+            if any(err.get("reason") in REJECTED_REASONS for err in errs):
+                rejected.append((row_id, row, errs))
+            else:
+                retry.append((row_id, row))
+        if rejected:
+            self._reject(rejected)
+        metrics.incr("bigquery_writer.rows_written", len(batch) - len(row_errors))
+        return retry
+
+    def _run(self):
+        while True:
+            with self._lock:
+                batch = self._next_batch()
+                if not batch:
+                    return  # closed and drained
+
+            retry = self._send(batch)
+
+            with self._lock:
+                if retry:
+                    # Failed rows go back to the front, keeping their insertIds
+                    self._buffer[:0] = retry
+                    self._oldest = time.monotonic()
+                    self._failures += 1
+                    metrics.incr("bigquery_writer.retries")
+                else:
+                    self._failures = 0
+                self._rewrite_spill()
+                if retry and self._closed:
+                    logging.error(f"Leaving {len(self._buffer)} rows in {self.spill_path} at shutdown.")
+                    return
+                failures = self._failures
+
+            if failures:
+                time.sleep(min(self.max_backoff, self.backoff * 2 ** (failures - 1)))
@@ -0,0 +1,159 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+# Firestore rejects write batches with more than 500 operations
+MAX_BATCH_WRITES = 500
+
+
+class KnownUsers:
+    """Short-TTL cache of user ids that were recently confirmed to exist."""
+
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._expiry = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        with self._lock:
+            expires = self._expiry.get(user_id)
+            if expires is not None and expires < time.monotonic():
+                del self._expiry[user_id]
+                expires = None
+        metrics.incr("known_users.hits" if expires is not None else "known_users.misses")
+        return expires is not None
+
+    def add(self, user_id):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._expiry[user_id] = time.monotonic() + self.ttl
+            self._expiry.move_to_end(user_id)
+            while len(self._expiry) > self.max_entries:
+                self._expiry.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._expiry.pop(user_id, None)
+
+
+class ChatWriter:
+    """Write-behind queue that saves chat messages with Firestore WriteBatch commits.
+
+    ``save`` assigns the document id up front and returns immediately. A
+    background thread groups queued writes into batches of up to
+    ``batch_size``, commits them at least every ``flush_interval`` seconds and
+    retries failed commits with exponential backoff; since every write is a
+    ``set`` on a fixed document, retrying a commit that did land is harmless.
+    When the queue is full or the writer is closed, ``save`` writes inline.
+    """
+
+    def __init__(self, client, batch_size=100, flush_interval=0.5, max_retries=5,
+                 backoff=0.2, max_queue=10000):
+        self._client = client
+        self.batch_size = min(batch_size, MAX_BATCH_WRITES)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+        self._thread.start()
+
+    def save(self, user_id, chat_data):
+        """Queue ``chat_data`` as a new document in users/{user_id}/chats."""
+        doc_ref = (
+            self._client.collection("users").document(user_id).collection("chats").document()
+        )
+        if not self._closed.is_set():
+            try:
+                self._queue.put_nowait((doc_ref, chat_data, time.monotonic()))
+                return doc_ref
+            except queue.Full:
+                metrics.incr("chat_writer.overflow")
+        doc_ref.set(chat_data)
+        return doc_ref
+
+    def flush(self, timeout=None):
+        """Block until every queued write has been committed or dropped."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=30):
+        """Stop accepting writes and drain the queue; called at shutdown."""
+        self._closed.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.error(f"Chat writer closed with {self._queue.qsize()} writes still queued.")
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        try:
+            items = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(items) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # Once closing, commit whatever is queued without waiting
+                if self._closed.is_set() or remaining <= 0:
+                    items.append(self._queue.get_nowait())
+                else:
+                    items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._next_batch()
+            if not items:
+                if self._closed.is_set():
+                    return
+                continue
+            try:
+                self._commit(items)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _commit(self, items):
+        for attempt in range(self.max_retries + 1):
+            batch = self._client.batch()
+            for doc_ref, chat_data, _ in items:
+                batch.set(doc_ref, chat_data)
+            start = time.perf_counter()
+            try:
+                batch.commit()
+            except Exception as e:
+                metrics.incr("chat_writer.commit_errors")
+                if attempt == self.max_retries:
+                    metrics.incr("chat_writer.dropped", len(items))
+                    logging.error(f"Dropping {len(items)} chat writes after {attempt + 1} attempts: {e}")
+                    return
+                delay = self.backoff * 2 ** attempt
+                logging.warning(f"Chat batch commit failed, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                continue
+
+            now = time.monotonic()
+            metrics.observe("chat_writer.commit", time.perf_counter() - start)
+            metrics.incr("chat_writer.written", len(items))
+            metrics.incr("chat_writer.batches")
+            for _, _, enqueued in items:
+                metrics.observe("chat_writer.lag", now - enqueued)
+            return
@@ -0,0 +1,77 @@
+from google.cloud import firestore
+
+from metrics import metrics
+
+# Documents fetched per query when a caller walks a whole history
+DEFAULT_PAGE_SIZE = 200
+
+ASCENDING = firestore.Query.ASCENDING
+DESCENDING = firestore.Query.DESCENDING
+
+
+def chats_collection(client, user_id):
+    return client.collection("users").document(user_id).collection("chats")
+
+
+def plans_collection(client, user_id):
+    return client.collection("users").document(user_id).collection("fitness_plans")
+
+
+def _page_query(collection_ref, order_field, direction, limit, start_after=None):
+    query = collection_ref.order_by(order_field, direction=direction).limit(limit)
+    if start_after is not None:
+        # A snapshot cursor also orders by document id, so equal timestamps
+        # (chats committed in one batch) are neither skipped nor repeated
+        query = query.start_after(start_after)
+    return query
+
+
+def iter_pages(collection_ref, order_field="timestamp", direction=ASCENDING,
+               page_size=DEFAULT_PAGE_SIZE):
+    """Yield lists of document snapshots, one ordered query of ``page_size`` at a time."""
+    cursor = None
+    while True:
+        with metrics.timer("history.page"):
+            page = list(_page_query(collection_ref, order_field, direction, page_size, cursor).stream())
+        metrics.incr("history.documents_read", len(page))
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        cursor = page[-1]
+
+
+def iter_documents(collection_ref, order_field="timestamp", direction=ASCENDING,
+                   page_size=DEFAULT_PAGE_SIZE):
+    """Yield document dicts in order without holding more than one page in memory."""
+    for page in iter_pages(collection_ref, order_field, direction, page_size):
+        for doc in page:
+            yield doc.to_dict()
+
+
+def latest(collection_ref, order_field):
+    """Return the snapshot with the greatest ``order_field``, or None."""
+    docs = list(collection_ref.order_by(order_field, direction=DESCENDING).limit(1).stream())
+    return docs[0] if docs else None
+
+
+def read_page(collection_ref, limit, cursor=None, order_field="timestamp", direction=ASCENDING):
+    """Return ``(documents, next_cursor)`` for one page of an ordered collection.
+
+    ``cursor`` is the id of the last document of the previous page, as
+    returned in ``next_cursor``; ``next_cursor`` is None after the last page.
+    Raises KeyError if the cursor document no longer exists.
+    """
+    start_after = None
+    if cursor:
+        start_after = collection_ref.document(cursor).get()
+        if not start_after.exists:
+            raise KeyError(cursor)
+    # Fetch one extra document to learn whether another page follows
+    with metrics.timer("history.page"):
+        docs = list(_page_query(collection_ref, order_field, direction, limit + 1, start_after).stream())
+    metrics.incr("history.documents_read", len(docs))
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    items = [{"id": doc.id, **doc.to_dict()} for doc in docs]
+    return items, docs[-1].id if has_more else None
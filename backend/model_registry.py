@@ -0,0 +1,95 @@
+import json
+import logging
+import threading
+import time
+
+import vertexai
+from vertexai.generative_models import GenerativeModel
+from vertexai.language_models import TextEmbeddingModel
+
+from metrics import metrics
+
+
+class ModelRegistry:
+    """Process-wide cache of Gemini model clients.
+
+    ``vertexai.init`` runs once per worker and each ``GenerativeModel`` is built
+    once per (model name, generation config) pair, so the gunicorn threads share
+    credentials and gRPC channels instead of rebuilding them on every request.
+    """
+
+    def __init__(self, project, location, credentials):
+        self._project = project
+        self._location = location
+        self._credentials = credentials
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._models = {}
+
+    def _ensure_initialized(self):
+        # Caller must hold self._lock
+        if self._initialized:
+            return
+        start = time.perf_counter()
+        vertexai.init(
+            project=self._project,
+            location=self._location,
+            credentials=self._credentials,
+        )
+        metrics.observe("model_registry.vertexai_init", time.perf_counter() - start)
+        self._initialized = True
+
+    def get(self, model_name, generation_config=None):
+        """Return the shared model for ``model_name`` and ``generation_config``."""
+        key = (model_name, _config_key(generation_config))
+        model = self._models.get(key)
+        if model is not None:
+            metrics.incr("model_registry.hits")
+            return model
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                self._ensure_initialized()
+                start = time.perf_counter()
+                model = GenerativeModel(model_name, generation_config=generation_config)
+                metrics.observe("model_registry.model_setup", time.perf_counter() - start)
+                metrics.incr("model_registry.misses")
+                self._models[key] = model
+                logging.info(f"Created Gemini model client for {model_name}.")
+        return model
+
+    def embedding_model(self, model_name):
+        """Return the shared text embedding model for ``model_name``."""
+        key = (model_name, "embedding")
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                self._ensure_initialized()
+                model = TextEmbeddingModel.from_pretrained(model_name)
+                self._models[key] = model
+                logging.info(f"Created embedding model client for {model_name}.")
+        return model
+
+    def warm_up(self, specs):
+        """Build the models in ``specs`` (pairs of name and config) ahead of traffic."""
+        for model_name, generation_config in specs:
+            start = time.perf_counter()
+            try:
+                model = self.get(model_name, generation_config)
+                # The prediction client (and its gRPC channel) is created lazily on
+                # first use; touch it here so the first request doesn't pay for it.
+                getattr(model, "_prediction_client", None)
+                metrics.observe("model_registry.warm_up", time.perf_counter() - start)
+            except Exception as e:
+                logging.error(f"Failed to warm up Gemini model {model_name}: {e}")
+
+
+def _config_key(generation_config):
+    if generation_config is None:
+        return None
+    return json.dumps(generation_config, sort_keys=True, default=str)
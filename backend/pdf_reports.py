@@ -0,0 +1,277 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from fpdf import FPDF
+
+import history
+from metrics import metrics
+
+# Profile fields printed in the report header; a change to any of them forces a re-render
+REPORT_PROFILE_FIELDS = ["name", "age", "gender"]
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class ReportNotFound(Exception):
+    """The user or their chat history does not exist."""
+
+
+def render_wellness_pdf(user_id, user_data, chats):
+    """Render the profile header and chat exchanges; return (pdf bytes, page count)."""
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+
+    # Add user profile to the PDF
+    pdf.cell(200, 10, txt="Personalized Wellness Plan", ln=True, align="C")
+    pdf.cell(200, 10, txt=f"User: {user_data.get('name', 'N/A')} (ID: {user_id})", ln=True)
+    pdf.cell(200, 10, txt=f"Age: {user_data.get('age', 'N/A')} | Gender: {user_data.get('gender', 'N/A')}", ln=True)
+    pdf.ln(10)  # Add some spacing
+
+    # Add chat history to the PDF
+    pdf.set_font("Arial", size=10)
+    for chat in chats:
+        pdf.cell(200, 10, txt=f"Query: {chat.get('query', 'N/A')}", ln=True)
+        pdf.multi_cell(0, 10, txt=f"Response: {chat.get('response', 'N/A')}")
+        pdf.ln(5)
+
+    return pdf.output(dest="S").encode("latin1"), pdf.page_no()
+
+
+def report_fingerprint(user_data):
+    fields = {field: user_data.get(field) for field in REPORT_PROFILE_FIELDS}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class PdfReportJobs:
+    """Renders users' chat-history PDFs on a worker pool and tracks each job.
+
+    A job re-renders only when the newest chat timestamp or the chat count
+    differs from the report record at ``users/{id}/reports/wellness_pdf``,
+    or the user's header fields changed; when all of them match it finishes
+    immediately with ``rebuilt: False``. Job
+    state lives in memory and is mirrored to ``pdf_jobs/{job_id}`` so any
+    instance can answer a status poll. A user has at most one active job per
+    process; submitting again returns it. Report records are kept in memory
+    for ``report_ttl`` seconds so download requests can rely on them without
+    a Firestore read each time.
+    """
+
+    def __init__(self, firestore_client, storage_client, bucket_name, load_profile,
+                 flush_chats=None, max_workers=2, job_ttl=3600, report_ttl=60):
+        self._firestore = firestore_client
+        self._bucket = storage_client.bucket(bucket_name)
+        self.bucket_name = bucket_name
+        self._load_profile = load_profile
+        self._flush_chats = flush_chats
+        self.job_ttl = job_ttl
+        self.report_ttl = report_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pdf-report")
+        self._jobs = {}  # job_id -> job dict
+        self._active = {}  # user_id -> job_id of its queued or running job
+        self._reports = {}  # user_id -> (expires_at, report record)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def blob_name(user_id):
+        return f"{user_id}_wellness_plan.pdf"
+
+    def report_ref(self, user_id):
+        return (
+            self._firestore.collection("users").document(user_id)
+            .collection("reports").document("wellness_pdf")
+        )
+
+    def report(self, user_id, cached=True):
+        """Return the record of the user's last render, or None."""
+        if cached:
+            with self._lock:
+                item = self._reports.get(user_id)
+                if item is not None and item[0] > time.monotonic():
+                    metrics.incr("pdf.report_cache_hits")
+                    return dict(item[1])
+        doc = self.report_ref(user_id).get()
+        if not doc.exists:
+            return None
+        report = doc.to_dict()
+        self._remember(user_id, report)
+        return report
+
+    def _remember(self, user_id, report):
+        if self.report_ttl <= 0:
+            return
+        with self._lock:
+            self._prune()
+            self._reports[user_id] = (time.monotonic() + self.report_ttl, dict(report))
+
+    # Jobs ------------------------------------------------------------------
+
+    def submit(self, user_id, force=False):
+        """Queue a render for ``user_id`` and return its job, reusing an active one."""
+        with self._lock:
+            self._prune()
+            job_id = self._active.get(user_id)
+            if job_id is not None:
+                metrics.incr("pdf.jobs_coalesced")
+                return _public(self._jobs[job_id])
+            job = self._new_job(user_id)
+            self._active[user_id] = job["job_id"]
+        self._save(job)
+        self._executor.submit(self._run, job["job_id"], force)
+        metrics.incr("pdf.jobs_submitted")
+        return _public(job)
+
+    def run(self, user_id, force=False):
+        """Render in the calling thread and return the result; raises ReportNotFound."""
+        with metrics.timer("pdf.job"):
+            return self._build(user_id, force)
+
+    def status(self, job_id):
+        """Return the job's state, or None if no instance knows it."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return _public(job)
+        doc = self._firestore.collection("pdf_jobs").document(job_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _new_job(self, user_id):
+        # Caller must hold self._lock
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "status": QUEUED,
+            "created_at": datetime.now(timezone.utc),
+        }
+        self._jobs[job["job_id"]] = job
+        return job
+
+    def _prune(self):
+        # Caller must hold self._lock; drops finished jobs older than job_ttl and stale reports
+        now = time.monotonic()
+        cutoff = now - self.job_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.get("_finished", cutoff) < cutoff]:
+            del self._jobs[job_id]
+        for user_id in [user_id for user_id, (expires_at, _) in self._reports.items() if expires_at <= now]:
+            del self._reports[user_id]
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            if fields.get("status") in (DONE, FAILED):
+                job["_finished"] = time.monotonic()
+                if self._active.get(job["user_id"]) == job_id:
+                    del self._active[job["user_id"]]
+            snapshot = dict(job)
+        self._save(snapshot)
+
+    def _save(self, job):
+        try:
+            self._firestore.collection("pdf_jobs").document(job["job_id"]).set(_public(job))
+        except Exception as e:
+            logging.error(f"Failed to record PDF job {job['job_id']}: {e}")
+
+    def _run(self, job_id, force):
+        with self._lock:
+            job = self._jobs[job_id]
+            user_id = job["user_id"]
+            queued_for = (datetime.now(timezone.utc) - job["created_at"]).total_seconds()
+        metrics.observe("pdf.queue_wait", queued_for)
+        self._update(job_id, status=RUNNING)
+
+        started = time.perf_counter()
+        try:
+            result = self._build(user_id, force)
+        except ReportNotFound as e:
+            metrics.incr("pdf.not_found")
+            self._update(job_id, status=FAILED, error=str(e), not_found=True,
+                         finished_at=datetime.now(timezone.utc))
+            return
+        except Exception as e:
+            metrics.incr("pdf.failures")
+            logging.error(f"PDF job {job_id} for user {user_id} failed: {e}")
+            self._update(job_id, status=FAILED, error=str(e), finished_at=datetime.now(timezone.utc))
+            return
+        metrics.observe("pdf.job", time.perf_counter() - started)
+        self._update(job_id, status=DONE, finished_at=datetime.now(timezone.utc), **result)
+
+    # Rendering -------------------------------------------------------------
+
+    def _build(self, user_id, force):
+        user_data = self._load_profile(user_id)
+        if user_data is None:
+            raise ReportNotFound("User not found")
+
+        # Include exchanges still waiting in the write-behind queue
+        if self._flush_chats is not None:
+            self._flush_chats()
+
+        chats_ref = history.chats_collection(self._firestore, user_id)
+        chat_count = chats_ref.count().get()[0][0].value
+        if not chat_count:
+            raise ReportNotFound("No chat history found for this user.")
+
+        fingerprint = report_fingerprint(user_data)
+        latest = history.latest(chats_ref, "timestamp")
+        latest_timestamp = latest.get("timestamp") if latest is not None else None
+        report = self.report(user_id, cached=False)
+        if (report is not None and not force
+                and report.get("chat_count") == chat_count
+                and report.get("last_chat_timestamp") == latest_timestamp
+                and report.get("profile_fingerprint") == fingerprint):
+            metrics.incr("pdf.unchanged")
+            return self._result(report, rebuilt=False)
+
+        # Chats are read page by page while rendering, so the timing covers both
+        render_started = time.perf_counter()
+        data, page_count = render_wellness_pdf(user_id, user_data, history.iter_documents(chats_ref))
+        render_seconds = time.perf_counter() - render_started
+        metrics.observe("pdf.render", render_seconds)
+
+        blob = self._bucket.blob(self.blob_name(user_id))
+        with metrics.timer("pdf.upload"):
+            blob.upload_from_string(data, content_type="application/pdf")
+        metrics.incr("pdf.rebuilds")
+
+        report = {
+            "blob_name": blob.name,
+            "generation": blob.generation,
+            "chat_count": chat_count,
+            "last_chat_timestamp": latest_timestamp,
+            "profile_fingerprint": fingerprint,
+            "page_count": page_count,
+            "size_bytes": len(data),
+            "render_seconds": round(render_seconds, 3),
+            "rendered_at": datetime.now(timezone.utc),
+        }
+        self.report_ref(user_id).set(report)
+        self._remember(user_id, report)
+        return self._result(report, rebuilt=True)
+
+    def _result(self, report, rebuilt):
+        return {
+            "rebuilt": rebuilt,
+            "pdf_url": f"https://storage.googleapis.com/{self.bucket_name}/{report['blob_name']}",
+            "page_count": report.get("page_count"),
+            "chat_count": report.get("chat_count"),
+            "render_seconds": report.get("render_seconds") if rebuilt else 0.0,
+            "rendered_at": report.get("rendered_at"),
+        }
+
+
+def _public(job):
+    # Keys starting with an underscore are bookkeeping for this process only
+    return {key: value for key, value in job.items() if not key.startswith("_")}
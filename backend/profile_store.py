@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from google.cloud import bigquery
+
+from metrics import metrics
+
+PROFILE_QUERY = """
+SELECT *
+FROM `{table}`
+WHERE user_id = @user_id
+LIMIT 1
+"""
+
+
+class ProfileStore:
+    """Point lookups of user profiles for request handlers.
+
+    Reads are served from a process-local TTL cache, then the Firestore
+    ``users/{id}`` document. BigQuery is only consulted for users whose
+    profile is missing from Firestore (or lacks ``required_fields``), with a
+    parameterized query that BigQuery can answer from its result cache. The
+    query's scanned bytes are estimated once with a dry run.
+    """
+
+    def __init__(self, firestore_client, bigquery_client, table, ttl=60, max_entries=10000,
+                 max_bytes_billed=None):
+        self._firestore = firestore_client
+        self._bigquery = bigquery_client
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes_billed = max_bytes_billed
+        self._cache = OrderedDict()  # user_id -> (expires_at, profile)
+        self._lock = threading.Lock()
+        self._estimated_bytes = None
+
+    def cached(self, user_id):
+        """Return the cached profile for ``user_id`` without any I/O, or None."""
+        with self._lock:
+            item = self._cache.get(user_id)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._cache[user_id]
+                return None
+            self._cache.move_to_end(user_id)
+            return dict(item[1])
+
+    def put(self, user_id, profile):
+        """Cache ``profile``; call after writing it so readers see the new version."""
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._cache[user_id] = (time.monotonic() + self.ttl, dict(profile))
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    def get(self, user_id, required_fields=(), bigquery_fallback=True):
+        """Return the user's profile dict, or None if no source has it."""
+        profile = self.cached(user_id)
+        if profile is not None and _complete(profile, required_fields):
+            metrics.incr("profiles.cache_hits")
+            return profile
+        metrics.incr("profiles.cache_misses")
+
+        with metrics.timer("profiles.firestore"):
+            doc = self._firestore.collection("users").document(user_id).get()
+        profile = doc.to_dict() if doc.exists else None
+
+        if bigquery_fallback and (profile is None or not _complete(profile, required_fields)):
+            metrics.incr("profiles.bigquery_fallbacks")
+            profile = self.query_bigquery(user_id) or profile
+
+        if profile is not None:
+            self.put(user_id, profile)
+        return profile
+
+    def _job_config(self, user_id, dry_run=False):
+        return bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("user_id", "STRING", user_id)],
+            use_query_cache=True,
+            dry_run=dry_run,
+            maximum_bytes_billed=self.max_bytes_billed,
+        )
+
+    def estimate_bytes(self, user_id=""):
+        """Dry-run the lookup query and return the bytes it would scan."""
+        query = PROFILE_QUERY.format(table=self.table)
+        job = self._bigquery.query(query, job_config=self._job_config(user_id, dry_run=True))
+        return job.total_bytes_processed
+
+    def query_bigquery(self, user_id):
+        """Fetch the user's onboarding row from BigQuery with a parameterized query."""
+        if self._estimated_bytes is None:
+            try:
+                self._estimated_bytes = self.estimate_bytes()
+                logging.info(
+                    f"Profile lookup on {self.table} scans ~{self._estimated_bytes} bytes per query."
+                )
+            except Exception as e:
+                logging.error(f"Dry run of the profile lookup failed: {e}")
+                self._estimated_bytes = 0
+
+        query = PROFILE_QUERY.format(table=self.table)
+        with metrics.timer("profiles.bigquery"):
+            job = self._bigquery.query(query, job_config=self._job_config(user_id))
+            rows = [dict(row) for row in job.result()]
+        metrics.incr("profiles.bigquery_cache_hits" if job.cache_hit else "profiles.bigquery_jobs")
+        metrics.incr("profiles.bigquery_bytes_estimated", self._estimated_bytes)
+        return rows[0] if rows else None
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._cache)
+        return {
+            "entries": entries,
+            "ttl_seconds": self.ttl,
+            "bigquery_estimated_bytes_per_lookup": self._estimated_bytes,
+        }
+
+
+def _complete(profile, required_fields):
+    return all(profile.get(field) not in (None, "") for field in required_fields)
@@ -0,0 +1,338 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import numpy as np
+
+from metrics import metrics
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.]+$")
+
+
+def normalize_prompt(text):
+    """Normalize case, spacing and trailing punctuation so equivalent prompts share a key."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return _TRAILING_PUNCTUATION.sub("", _WHITESPACE.sub(" ", text).strip())
+
+
+def estimate_tokens(text):
+    # Gemini averages roughly four characters per token for English text
+    return max(1, len(text) // 4)
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class CacheProbe:
+    """Key and embedding computed by ``lookup``, reused by ``store`` after a miss."""
+
+    def __init__(self, namespace, text, key, vector):
+        self.namespace = namespace
+        self.text = text
+        self.key = key
+        self.vector = vector
+
+
+class _Namespace:
+    """LRU entries of one endpoint plus a matrix of their unit embeddings."""
+
+    def __init__(self):
+        self.entries = OrderedDict()  # key -> [response, expires_at, row]
+        self.vectors = None
+        self.row_keys = []
+        self.free_rows = []
+
+    def assign_row(self, key, vector):
+        if vector is None:
+            return None
+        if self.vectors is None:
+            self.vectors = np.zeros((16, len(vector)), dtype=np.float32)
+        if self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            row = len(self.row_keys)
+            self.row_keys.append(None)
+            if row == len(self.vectors):
+                grown = np.zeros((2 * row, self.vectors.shape[1]), dtype=np.float32)
+                grown[:row] = self.vectors
+                self.vectors = grown
+        self.vectors[row] = vector
+        self.row_keys[row] = key
+        return row
+
+    def release(self, key):
+        _, _, row = self.entries.pop(key)
+        if row is not None:
+            self.vectors[row] = 0
+            self.row_keys[row] = None
+            self.free_rows.append(row)
+
+
+class MemoryBackend:
+    """In-process LRU store; each gunicorn worker keeps its own copy."""
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._namespaces = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _namespace(self, namespace):
+        ns = self._namespaces.get(namespace)
+        if ns is None:
+            ns = self._namespaces[namespace] = _Namespace()
+        return ns
+
+    def get(self, namespace, key, now):
+        with self._lock:
+            ns = self._namespace(namespace)
+            entry = ns.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < now:
+                ns.release(key)
+                return None
+            ns.entries.move_to_end(key)
+            return entry[0]
+
+    def nearest(self, namespace, vector, now):
+        """Return (response, similarity) of the closest live entry, or (None, 0.0)."""
+        with self._lock:
+            ns = self._namespace(namespace)
+            if ns.vectors is None or not ns.entries:
+                return None, 0.0
+            scores = ns.vectors[:len(ns.row_keys)] @ vector
+            for row in np.argsort(scores)[::-1][:4]:
+                key = ns.row_keys[row]
+                if key is None:
+                    continue
+                entry = ns.entries[key]
+                if entry[1] < now:
+                    ns.release(key)
+                    continue
+                ns.entries.move_to_end(key)
+                return entry[0], float(scores[row])
+            return None, 0.0
+
+    def put(self, namespace, key, response, vector, expires_at):
+        with self._lock:
+            ns = self._namespace(namespace)
+            if key in ns.entries:
+                ns.release(key)
+            ns.entries[key] = [response, expires_at, ns.assign_row(key, vector)]
+            while len(ns.entries) > self.max_entries:
+                ns.release(next(iter(ns.entries)))
+                self.evictions += 1
+
+    def size(self):
+        with self._lock:
+            return sum(len(ns.entries) for ns in self._namespaces.values())
+
+
+class SqliteBackend:
+    """Response store in a sqlite file that several workers or tests can share."""
+
+    def __init__(self, path, max_entries=5000):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, response TEXT NOT NULL,"
+                " embedding BLOB, expires_at REAL NOT NULL, last_used REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+
+    def get(self, namespace, key, now):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE namespace = ? AND key = ? AND expires_at >= ?",
+                (namespace, key, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_used = ? WHERE namespace = ? AND key = ?",
+                (time.time(), namespace, key),
+            )
+            return row[0]
+
+    def nearest(self, namespace, vector, now):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, response, embedding FROM responses"
+                " WHERE namespace = ? AND expires_at >= ? AND embedding IS NOT NULL",
+                (namespace, now),
+            ).fetchall()
+        if not rows:
+            return None, 0.0
+        matrix = np.vstack([np.frombuffer(embedding, dtype=np.float32) for _, _, embedding in rows])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE responses SET last_used = ? WHERE namespace = ? AND key = ?",
+                (time.time(), namespace, rows[best][0]),
+            )
+        return rows[best][1], float(scores[best])
+
+    def put(self, namespace, key, response, vector, expires_at):
+        embedding = vector.astype(np.float32).tobytes() if vector is not None else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, response, embedding, expires_at, time.time()),
+            )
+            self._conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            evicted = self._conn.execute(
+                "DELETE FROM responses WHERE namespace = ? AND key NOT IN ("
+                " SELECT key FROM responses WHERE namespace = ?"
+                " ORDER BY last_used DESC LIMIT ?)",
+                (namespace, namespace, self.max_entries),
+            ).rowcount
+            self.evictions += max(0, evicted)
+
+    def size(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class ResponseCache:
+    """Cache of Gemini responses keyed by normalized prompt, then by meaning.
+
+    A lookup first tries the SHA-256 of the normalized prompt. The semantic
+    tier is off unless ``similarity`` is set: then, on a miss, it embeds the
+    prompt with ``embedder(text)`` and returns the closest cached response in
+    the same namespace whose cosine similarity is at least ``similarity``.
+    Health questions that differ in one word can score above 0.95, so values
+    below 0.97 are not recommended. The embedding call gets ``embed_timeout``
+    seconds; after a timeout or error the tier is skipped for ``cooldown``
+    seconds. Each namespace (one per endpoint) has its own TTL from ``ttls``;
+    ``backend`` handles storage and LRU eviction.
+    """
+
+    def __init__(self, backend, embedder=None, similarity=0.0, ttls=None, default_ttl=3600,
+                 embed_timeout=0.5, cooldown=30):
+        self.backend = backend
+        self.embedder = embedder
+        self.similarity = similarity
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.embed_timeout = embed_timeout
+        self.cooldown = cooldown
+        self._executor = None
+        if embedder is not None and similarity > 0:
+            self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="response-cache-embed")
+        self._skip_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "saved_tokens": 0}
+
+    def key(self, namespace, text):
+        payload = f"{namespace}\0{normalize_prompt(text)}".encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def _embed(self, text):
+        if self._executor is None:
+            return None
+        if time.monotonic() < self._skip_until:
+            metrics.incr("response_cache.embed_skipped")
+            return None
+        future = self._executor.submit(self.embedder, normalize_prompt(text))
+        try:
+            with metrics.timer("response_cache.embed"):
+                return _unit(future.result(timeout=self.embed_timeout))
+        except TimeoutError:
+            metrics.incr("response_cache.embed_timeouts")
+            logging.warning(
+                f"Response cache embedding took over {self.embed_timeout}s, "
+                f"using exact match only for {self.cooldown}s."
+            )
+        except Exception as e:
+            metrics.incr("response_cache.embed_errors")
+            logging.error(f"Response cache embedding failed, using exact match only for {self.cooldown}s: {e}")
+        self._skip_until = time.monotonic() + self.cooldown
+        return None
+
+    def _hit(self, kind, namespace, text, response):
+        saved = estimate_tokens(text) + estimate_tokens(response)
+        with self._lock:
+            self._stats[f"{kind}_hits"] += 1
+            self._stats["saved_tokens"] += saved
+        metrics.incr(f"response_cache.{namespace}.{kind}_hits")
+        metrics.incr("response_cache.saved_tokens", saved)
+
+    def lookup(self, namespace, text):
+        """Return ``(response, probe)``; ``response`` is None on a miss."""
+        now = time.time()
+        key = self.key(namespace, text)
+        response = self.backend.get(namespace, key, now)
+        if response is not None:
+            self._hit("exact", namespace, text, response)
+            return response, None
+
+        vector = self._embed(text)
+        if vector is not None:
+            response, score = self.backend.nearest(namespace, vector, now)
+            if response is not None and score >= self.similarity:
+                self._hit("semantic", namespace, text, response)
+                # Remember the paraphrase so it is an exact hit next time
+                self.backend.put(namespace, key, response, None, now + self.ttl(namespace))
+                return response, None
+
+        with self._lock:
+            self._stats["misses"] += 1
+        metrics.incr(f"response_cache.{namespace}.misses")
+        return None, CacheProbe(namespace, text, key, vector)
+
+    def store(self, probe, response):
+        """Cache ``response`` for the prompt that missed in ``lookup``."""
+        if probe is None or not response:
+            return
+        expires_at = time.time() + self.ttl(probe.namespace)
+        self.backend.put(probe.namespace, probe.key, response, probe.vector, expires_at)
+
+    def get_or_generate(self, namespace, text, generate):
+        """Return the cached response for ``text`` or call ``generate()`` and cache it.
+
+        ``generate`` returns None when it has nothing worth caching.
+        """
+        response, probe = self.lookup(namespace, text)
+        if response is not None:
+            return response
+        response = generate()
+        self.store(probe, response)
+        return response
+
+    def ttl(self, namespace):
+        return self.ttls.get(namespace, self.default_ttl)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["entries"] = self.backend.size()
+        stats["evictions"] = self.backend.evictions
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = round((lookups - stats["misses"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+def create_backend(spec, max_entries=5000):
+    """Build a backend from ``memory`` or ``sqlite:<path>``."""
+    if spec.startswith("sqlite:"):
+        return SqliteBackend(spec[len("sqlite:"):], max_entries=max_entries)
+    if spec == "memory":
+        return MemoryBackend(max_entries=max_entries)
+    raise ValueError(f"Unknown response cache backend: {spec}")
@@ -0,0 +1,58 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from metrics import metrics
+
+
+class SignedUrlCache:
+    """Reuses signed download URLs until shortly before they expire.
+
+    Entries are keyed by user and blob generation, so a re-rendered PDF gets a
+    fresh URL while repeated downloads of the same one share a single signing.
+    A URL is handed out only while it has at least ``refresh_margin`` seconds
+    of its ``expiration`` left.
+    """
+
+    def __init__(self, expiration=900, refresh_margin=120, max_entries=10000):
+        self.expiration = expiration
+        self.refresh_margin = refresh_margin
+        self.max_entries = max_entries
+        self._urls = OrderedDict()  # (user_id, generation) -> (expires_at, url)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, user_id, generation, sign):
+        """Return a cached URL or call ``sign(expiration)`` for a new one."""
+        key = (user_id, generation)
+        now = time.monotonic()
+        with self._lock:
+            item = self._urls.get(key)
+            if item is not None and item[0] - self.refresh_margin > now:
+                self._urls.move_to_end(key)
+                self._hits += 1
+                metrics.incr("signed_urls.hits")
+                return item[1]
+            self._misses += 1
+        metrics.incr("signed_urls.misses")
+
+        with metrics.timer("signed_urls.sign"):
+            url = sign(timedelta(seconds=self.expiration))
+        with self._lock:
+            self._urls[key] = (now + self.expiration, url)
+            self._urls.move_to_end(key)
+            while len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
+        return url
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._urls),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+            }
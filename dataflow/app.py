@@ -1,90 +1,501 @@
-from google.cloud import firestore, bigquery
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from google.cloud import firestore, bigquery, storage
 from google.oauth2 import service_account
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+
+from bulk_export import PARQUET, SOURCE_FORMATS, StagingFiles, arrow_schema, clean_rows
 
 # Path to your service account key file
 SERVICE_ACCOUNT_FILE = "./getufit.json"
 
-# Load service account credentials
-credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
+if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+    # Local runs against the Firestore emulator (e.g. benchmarks) read without credentials
+    firestore_client = firestore.Client(project=os.environ.get("GOOGLE_CLOUD_PROJECT", "demo-getufit"))
+    bigquery_client = None
+    storage_client = None
+else:
+    # Load service account credentials
+    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
 
-# Initialize Firestore and BigQuery clients with the credentials
-firestore_client = firestore.Client(credentials=credentials, project=credentials.project_id)
-bigquery_client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+    # Initialize Firestore and BigQuery clients with the credentials
+    firestore_client = firestore.Client(credentials=credentials, project=credentials.project_id)
+    bigquery_client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+    storage_client = storage.Client(credentials=credentials, project=credentials.project_id)
 
-def firestore_to_bigquery():
-    try:
-        # Firestore collection reference
-        users_collection_ref = firestore_client.collection("users")
-
-        # Query Firestore documents for users
-        users_docs = users_collection_ref.stream()
-
-        # Prepare rows for BigQuery
-        user_rows_to_insert = []
-        chat_rows_to_insert = []
-
-        for user_doc in users_docs:
-            user_data = user_doc.to_dict()
-            user_id = user_doc.id  # Firestore document ID acts as user_id
-
-            if user_data:
-                # Add user profile data to BigQuery
-                user_rows_to_insert.append({
-                    "user_id": user_id,
-                    "name": user_data.get("name", ""),
-                    "age": user_data.get("age", None),
-                    "gender": user_data.get("gender", ""),
-                })
-
-                # Fetch chat history subcollection for this user
-                chats_ref = users_collection_ref.document(user_id).collection("chats")
-                chat_docs = chats_ref.stream()
-
-                for chat_doc in chat_docs:
-                    chat_data = chat_doc.to_dict()
-                    # Convert Firestore timestamp to ISO format
-                    timestamp = chat_data.get("timestamp", datetime.now(timezone.utc))
-                    if isinstance(timestamp, datetime):
-                        timestamp = timestamp.isoformat()
-
-                    chat_rows_to_insert.append({
-                        "user_id": user_id,
-                        "query": chat_data.get("query", ""),
-                        "response": chat_data.get("response", ""),
-                        "timestamp": timestamp,
-                    })
-
-        # Debugging: Print rows
-        print("User Rows to insert:", user_rows_to_insert)
-        print("Chat Rows to insert:", chat_rows_to_insert)
-
-        # Skip BigQuery insertion if no rows are present
-        if not user_rows_to_insert and not chat_rows_to_insert:
-            print("No data to insert into BigQuery.")
+# BigQuery table IDs
+DATASET_ID = "buildnblog.wellness_analytics"
+USER_TABLE_ID = f"{DATASET_ID}.users"
+CHAT_TABLE_ID = f"{DATASET_ID}.chat_history"
+
+# Exported columns, and the ones that identify a row so re-running a sync never inserts it twice
+USER_COLUMNS = ["user_id", "name", "age", "gender"]
+USER_KEY = ["user_id"]
+# Profile columns that change in Firestore and are updated in place; chats never change
+USER_UPDATE_COLUMNS = ["name", "age", "gender"]
+CHAT_COLUMNS = ["user_id", "query", "response", "timestamp"]
+CHAT_KEY = ["user_id", "timestamp", "query"]
+
+# Firestore page size, concurrent partition readers, rows per BigQuery load and concurrent loads
+PAGE_SIZE = 1000
+READ_WORKERS = 8
+CHUNK_SIZE = 5000
+FLUSH_WORKERS = 4
+# Rows BigQuery may reject per load job before the whole chunk fails
+MAX_BAD_RECORDS = 100
+
+# Firestore document that stores the sync high-water marks
+CHECKPOINT_COLLECTION = "sync_state"
+CHECKPOINT_DOCUMENT = "firestore_to_bigquery"
+# Incremental runs re-read this far behind the checkpoint so writes committed
+# while the previous run was reading are not missed; the MERGE drops repeats
+SYNC_OVERLAP = timedelta(minutes=10)
+
+
+def load_checkpoint():
+    """Return the high-water marks of the last successful sync, or an empty dict."""
+    doc = firestore_client.collection(CHECKPOINT_COLLECTION).document(CHECKPOINT_DOCUMENT).get()
+    return doc.to_dict() or {}
+
+
+def save_checkpoint(checkpoint):
+    firestore_client.collection(CHECKPOINT_COLLECTION).document(CHECKPOINT_DOCUMENT).set(checkpoint)
+
+
+def to_iso(timestamp):
+    # Convert Firestore timestamp to ISO format
+    return timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp
+
+
+def user_row(user_doc):
+    user_data = user_doc.to_dict()
+    return {
+        "user_id": user_doc.id,  # Firestore document ID acts as user_id
+        "name": user_data.get("name", ""),
+        "age": user_data.get("age", None),
+        "gender": user_data.get("gender", ""),
+    }
+
+
+def chat_timestamp(chat_doc, chat_data):
+    # Fall back to the document's create time so the MERGE key is the same on every run
+    return chat_data.get("timestamp") or chat_doc.create_time
+
+
+def chat_row(chat_doc, chat_data=None):
+    if chat_data is None:
+        chat_data = chat_doc.to_dict()
+    return {
+        # users/{user_id}/chats/{chat_id}
+        "user_id": chat_doc.reference.parent.parent.id,
+        "query": chat_data.get("query", ""),
+        "response": chat_data.get("response", ""),
+        "timestamp": to_iso(chat_timestamp(chat_doc, chat_data)),
+    }
+
+
+class HighWater:
+    """Largest timestamp seen so far, starting from the previous checkpoint."""
+
+    def __init__(self, value=None):
+        self.value = value
+        self._lock = threading.Lock()
+
+    def update(self, value):
+        if not isinstance(value, datetime):
+            return
+        with self._lock:
+            if self.value is None or value > self.value:
+                self.value = value
+
+
+class Progress:
+    """Thread-safe export counters, printed as each chunk finishes."""
+
+    def __init__(self, label):
+        self.label = label
+        self.rows = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.chunk_errors = 0
+        self.rejected_rows = 0
+        self.invalid_values = Counter()  # column -> values loaded as NULL
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def chunk_done(self, rows, nbytes, rejected=0, invalid=None):
+        with self._lock:
+            self.rows += rows
+            self.bytes += nbytes
+            self.chunks += 1
+            self.rejected_rows += rejected
+            if invalid:
+                self.invalid_values.update(invalid)
+            self.report()
+
+    def chunk_failed(self):
+        with self._lock:
+            self.chunk_errors += 1
+            self.report()
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        print(
+            f"[{self.label}] {self.rows} rows in {self.chunks} chunks, "
+            f"{self.bytes / 2**20:.1f} MB, {self.rows / elapsed:.0f} rows/s, "
+            f"{self.chunk_errors} chunk errors, {self.rejected_rows} rejected rows, "
+            f"{sum(self.invalid_values.values())} values loaded as NULL",
+            flush=True,
+        )
+
+
+def paginate(query, page_size=PAGE_SIZE):
+    """Yield the documents of an ordered ``query`` one page at a time.
+
+    Each page resumes after the last document of the previous one, so only a
+    single page is held in memory and no stream stays open for the whole run.
+    """
+    last_doc = None
+    while True:
+        page = query.limit(page_size)
+        if last_doc is not None:
+            page = page.start_after(last_doc)
+        docs = list(page.stream())
+        yield from docs
+        if len(docs) < page_size:
             return
+        last_doc = docs[-1]
+
+
+def read_users(updated_after=None, page_size=PAGE_SIZE):
+    """Yield user documents changed since ``updated_after`` (all users if None).
+
+    Firestore can't filter on update time, so this reads every user document
+    but only returns the changed ones; the users collection is one document
+    per user, unlike the chat history.
+    """
+    query = firestore_client.collection("users").order_by("__name__")
+    for user_doc in paginate(query, page_size):
+        if not user_doc.to_dict():
+            continue
+        if updated_after is None or user_doc.update_time > updated_after:
+            yield user_doc
+
+
+def chat_partitions(after=None, count=READ_WORKERS):
+    """Split the chats collection group into up to ``count`` disjoint queries.
+
+    Firestore only partitions unfiltered collection-group queries, so a full
+    backfill uses its partition cursors, while an incremental run slices the
+    time range since ``after`` into equal windows.
+    """
+    chats = firestore_client.collection_group("chats")
+    if after is None:
+        return [partition.query() for partition in chats.get_partitions(count)]
 
-        # BigQuery table IDs
-        user_table_id = "buildnblog.wellness_analytics.users"
-        chat_table_id = "buildnblog.wellness_analytics.chat_history"
+    now = datetime.now(timezone.utc)
+    if now <= after:
+        return [chats.where(filter=firestore.FieldFilter("timestamp", ">", after)).order_by("timestamp")]
+    step = (now - after) / count
+    queries = []
+    for i in range(count):
+        query = chats.where(filter=firestore.FieldFilter("timestamp", ">", after + step * i))
+        if i < count - 1:
+            query = query.where(filter=firestore.FieldFilter("timestamp", "<=", after + step * (i + 1)))
+        queries.append(query.order_by("timestamp"))
+    return queries
 
-        # Insert rows into BigQuery
-        if user_rows_to_insert:
-            user_errors = bigquery_client.insert_rows_json(user_table_id, user_rows_to_insert)
-            if user_errors:
-                print(f"Encountered errors while inserting users: {user_errors}")
+
+def read_partitions(queries, workers=READ_WORKERS, page_size=PAGE_SIZE):
+    """Yield documents from ``queries``, each paged through by one of ``workers`` threads.
+
+    Readers hand documents over through a bounded queue, so reading stays at
+    most a few pages ahead of the consumer.
+    """
+    documents = queue.Queue(maxsize=workers * page_size)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                documents.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(query):
+        try:
+            for doc in paginate(query, page_size):
+                if not put(doc):
+                    return
+            put(finished)
+        except Exception as e:
+            put(e)
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-reader")
+    for query in queries:
+        executor.submit(read, query)
+    try:
+        remaining = len(queries)
+        while remaining:
+            item = documents.get()
+            if item is finished:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
             else:
-                print("User data successfully written to BigQuery!")
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
+def user_rows(updated_after, high_water, page_size=PAGE_SIZE):
+    for user_doc in read_users(updated_after, page_size):
+        high_water.update(user_doc.update_time)
+        yield user_row(user_doc)
+
+
+def chat_rows(after, high_water, page_size=PAGE_SIZE, workers=READ_WORKERS):
+    # Over-partition so that slow partitions don't leave other readers idle
+    queries = chat_partitions(after, count=4 * workers)
+    for chat_doc in read_partitions(queries, workers, page_size):
+        # DocumentSnapshot.get raises KeyError for a missing field, so read the dict
+        chat_data = chat_doc.to_dict()
+        high_water.update(chat_timestamp(chat_doc, chat_data))
+        yield chat_row(chat_doc, chat_data)
+
+
+def chunked(rows, size):
+    """Group an iterable of rows into lists of at most ``size``."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_chunk(staging_id, schema, chunk, invalid=None):
+    """Append ``chunk`` to the staging table with a load job.
+
+    Values that don't fit their column are sent as NULL (counted in
+    ``invalid``), and BigQuery may still skip up to ``MAX_BAD_RECORDS`` rows
+    rather than fail the chunk. Returns ``(bytes sent, rows rejected)``.
+    """
+    chunk = clean_rows(chunk, arrow_schema(schema), invalid)
+    data = "\n".join(json.dumps(row, default=str) for row in chunk).encode("utf-8")
+    job = bigquery_client.load_table_from_file(
+        io.BytesIO(data),
+        staging_id,
+        job_config=bigquery.LoadJobConfig(
+            schema=schema,
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            max_bad_records=MAX_BAD_RECORDS,
+            ignore_unknown_values=True,
+        ),
+    )
+    job.result()
+    rejected = len(chunk) - (job.output_rows or 0)
+    for error in (job.errors or [])[:5]:
+        print(f"Rejected row in {staging_id}: {error.get('message')}")
+    return len(data), rejected
+
+
+def load_staged_files(files, staging_id, schema):
+    """Load every staged file of a table into the staging table with one load job."""
+    job_config = bigquery.LoadJobConfig(
+        schema=schema,
+        source_format=files.source_format,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+    if files.uri:
+        job = bigquery_client.load_table_from_uri(files.uri, staging_id, job_config=job_config)
+    else:
+        with open(files.path, "rb") as f:
+            job = bigquery_client.load_table_from_file(f, staging_id, job_config=job_config)
+    job.result()
+    print(f"Loaded {job.output_rows} staged rows into {staging_id}.")
+
 
-        if chat_rows_to_insert:
-            chat_errors = bigquery_client.insert_rows_json(chat_table_id, chat_rows_to_insert)
-            if chat_errors:
-                print(f"Encountered errors while inserting chats: {chat_errors}")
+def merge_staging(table_id, staging_id, columns, key_columns, update_columns=()):
+    """Insert staged rows into ``table_id`` unless a row with the same key already exists.
+
+    Existing rows whose ``update_columns`` differ from the staged row are
+    updated in place; without ``update_columns`` the merge is insert-only.
+    """
+    on = " AND ".join(f"T.`{column}` = S.`{column}`" for column in key_columns)
+    column_list = ", ".join(f"`{column}`" for column in columns)
+    values = ", ".join(f"S.`{column}`" for column in columns)
+    update = ""
+    if update_columns:
+        changed = " OR ".join(f"T.`{column}` IS DISTINCT FROM S.`{column}`" for column in update_columns)
+        assignments = ", ".join(f"`{column}` = S.`{column}`" for column in update_columns)
+        update = f"""
+        WHEN MATCHED AND ({changed}) THEN
+          UPDATE SET {assignments}"""
+    merge_job = bigquery_client.query(f"""
+        MERGE `{table_id}` T
+        USING `{staging_id}` S
+        ON {on}{update}
+        WHEN NOT MATCHED THEN
+          INSERT ({column_list}) VALUES ({values})
+    """)
+    merge_job.result()
+    return merge_job.num_dml_affected_rows or 0
+
+
+def export_rows(table_id, rows, columns, key_columns, progress, run_id,
+                chunk_size=CHUNK_SIZE, workers=FLUSH_WORKERS, bulk_staging=None,
+                bulk_format=PARQUET, update_columns=()):
+    """Stream ``rows`` into ``table_id`` in chunks and return the rows inserted or updated.
+
+    Chunks are loaded into a per-run staging table by up to ``workers``
+    concurrent load jobs; at most two chunks per worker are buffered, so
+    memory stays bounded however long the history is. With ``bulk_staging``
+    (a directory or gs:// prefix) chunks are written to Parquet or NDJSON
+    files there instead and loaded by a single job at the end. The staged
+    rows are then MERGEd into the target, which keeps re-runs idempotent.
+    """
+    target = bigquery_client.get_table(table_id)
+    schema = [field for field in target.schema if field.name in columns]
+    staging = bigquery.Table(f"{DATASET_ID}._staging_{target.table_id}_{run_id}", schema=schema)
+    # Expire the staging table in case this run dies before dropping it
+    staging.expires = datetime.now(timezone.utc) + timedelta(days=1)
+    staging_id = f"{staging.project}.{staging.dataset_id}.{staging.table_id}"
+    bigquery_client.create_table(staging, exists_ok=True)
+
+    files = None
+    if bulk_staging:
+        files = StagingFiles(
+            f"{bulk_staging.rstrip('/')}/{run_id}", target.table_id, schema, bulk_format, storage_client
+        )
+
+    def flush(chunk):
+        try:
+            if files is not None:
+                progress.chunk_done(len(chunk), files.write(chunk))
             else:
-                print("Chat data successfully written to BigQuery!")
+                invalid = Counter()
+                nbytes, rejected = load_chunk(staging_id, schema, chunk, invalid)
+                progress.chunk_done(len(chunk), nbytes, rejected, invalid)
+        except Exception as e:
+            print(f"[{progress.label}] Failed to load a chunk of {len(chunk)} rows: {e}")
+            progress.chunk_failed()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = set()
+            for chunk in chunked(rows, chunk_size):
+                if len(in_flight) >= 2 * workers:
+                    _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                in_flight.add(executor.submit(flush, chunk))
+            wait(in_flight)
+
+        if not progress.rows:
+            return 0
+        if files is not None:
+            files.close()
+            if files.invalid_values:
+                print(
+                    f"[{progress.label}] {sum(files.invalid_values.values())} values did not match "
+                    f"their column type and were staged as NULL: {dict(files.invalid_values)}"
+                )
+            load_staged_files(files, staging_id, schema)
+        return merge_staging(table_id, staging_id, columns, key_columns, update_columns)
+    finally:
+        bigquery_client.delete_table(staging_id, not_found_ok=True)
+        if files is not None:
+            files.cleanup()
+
+
+def firestore_to_bigquery(full_backfill=False, chunk_size=CHUNK_SIZE, workers=FLUSH_WORKERS,
+                          page_size=PAGE_SIZE, read_workers=READ_WORKERS, bulk_staging=None,
+                          bulk_format=PARQUET):
+    try:
+        # A full backfill ignores the checkpoint and re-reads all history
+        checkpoint = {} if full_backfill else load_checkpoint()
+        users_after = checkpoint.get("users_updated_at")
+        chats_after = checkpoint.get("chats_timestamp")
+        users_from = users_after - SYNC_OVERLAP if users_after else None
+        chats_from = chats_after - SYNC_OVERLAP if chats_after else None
+        print(f"Syncing users updated after {users_from} and chats after {chats_from}.")
+
+        run_id = uuid.uuid4().hex[:12]
+        users_high_water = HighWater(users_after)
+        chats_high_water = HighWater(chats_after)
+        user_progress = Progress("users")
+        chat_progress = Progress("chats")
+
+        inserted = export_rows(
+            USER_TABLE_ID, user_rows(users_from, users_high_water, page_size),
+            USER_COLUMNS, USER_KEY, user_progress, run_id, chunk_size, workers,
+            bulk_staging, bulk_format, update_columns=USER_UPDATE_COLUMNS,
+        )
+        print(f"User data written to BigQuery: {inserted} rows inserted or updated.")
+
+        inserted = export_rows(
+            CHAT_TABLE_ID, chat_rows(chats_from, chats_high_water, page_size, read_workers),
+            CHAT_COLUMNS, CHAT_KEY, chat_progress, run_id, chunk_size, workers,
+            bulk_staging, bulk_format,
+        )
+        print(f"Chat data written to BigQuery: {inserted} new rows.")
+
+        # Only advance the checkpoint once every chunk of both tables is written
+        if user_progress.chunk_errors or chat_progress.chunk_errors:
+            print("Some chunks failed to load; keeping the previous checkpoint.")
+            return
+        save_checkpoint({
+            "users_updated_at": users_high_water.value,
+            "chats_timestamp": chats_high_water.value,
+            "completed_at": firestore.SERVER_TIMESTAMP,
+            "full_backfill": full_backfill,
+        })
 
     except Exception as e:
         print(f"Error: {e}")
 
+
 if __name__ == "__main__":
-    firestore_to_bigquery()
+    parser = argparse.ArgumentParser(description="Sync Firestore users and chats to BigQuery.")
+    parser.add_argument(
+        "--full-backfill",
+        action="store_true",
+        help="Ignore the checkpoint and re-sync all users and chats; chats already in BigQuery are skipped.",
+    )
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Rows per BigQuery load job.")
+    parser.add_argument("--workers", type=int, default=FLUSH_WORKERS, help="Concurrent load jobs.")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Firestore documents per page.")
+    parser.add_argument(
+        "--read-workers", type=int, default=READ_WORKERS, help="Threads reading chat partitions."
+    )
+    parser.add_argument(
+        "--bulk-staging",
+        help="Directory or gs://bucket/prefix to stage files in; loads each table with one job.",
+    )
+    parser.add_argument(
+        "--bulk-format", choices=sorted(SOURCE_FORMATS), default=PARQUET, help="Staging file format."
+    )
+    args = parser.parse_args()
+    firestore_to_bigquery(
+        full_backfill=args.full_backfill,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        page_size=args.page_size,
+        read_workers=args.read_workers,
+        bulk_staging=args.bulk_staging,
+        bulk_format=args.bulk_format,
+    )
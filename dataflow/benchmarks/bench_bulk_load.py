@@ -0,0 +1,138 @@
+"""Compare streaming inserts with a staged-file load job for 100k synthetic chat rows.
+
+Usage: python benchmarks/bench_bulk_load.py [--rows 100000] [--insert-batch 500]
+           [--request-ms 60] [--job-ms 3000] [--load-mbps 200]
+
+LocalBigQuery stands in for the BigQuery client: insert_rows_json sleeps for
+a per-request round trip plus upload time, and a load job for the job
+latency plus reading the staged file. Serializing rows and writing the
+NDJSON/Parquet files is real work done with the exporter's own code.
+Streaming inserts are billed per row with a 1 KB minimum (shown as billed
+MB); load jobs are free.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bulk_export import NDJSON, PARQUET, StagingFiles  # noqa: E402
+
+
+class Field:
+    def __init__(self, name, field_type):
+        self.name = name
+        self.field_type = field_type
+
+
+CHAT_SCHEMA = [
+    Field("user_id", "STRING"),
+    Field("query", "STRING"),
+    Field("response", "STRING"),
+    Field("timestamp", "TIMESTAMP"),
+]
+
+
+class LocalBigQuery:
+    """Sleeps for the time the BigQuery calls would take instead of making them."""
+
+    def __init__(self, request_seconds, job_seconds, load_bytes_per_second, upload_bytes_per_second):
+        self.request_seconds = request_seconds
+        self.job_seconds = job_seconds
+        self.load_bytes_per_second = load_bytes_per_second
+        self.upload_bytes_per_second = upload_bytes_per_second
+        self.rows = 0
+
+    def insert_rows_json(self, table, rows, row_ids=None):
+        payload = len(json.dumps({"rows": [{"insertId": i, "json": r} for i, r in zip(row_ids, rows)]}))
+        time.sleep(self.request_seconds + payload / self.upload_bytes_per_second)
+        self.rows += len(rows)
+        return []
+
+    def load_table_from_file(self, f, table, job_config=None):
+        size = os.fstat(f.fileno()).st_size
+        time.sleep(size / self.upload_bytes_per_second)
+        time.sleep(self.job_seconds + size / self.load_bytes_per_second)
+        return size
+
+
+def synthetic_chats(n):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(n):
+        yield {
+            "user_id": f"user-{i % 5000}",
+            "query": f"What should I eat before leg day number {i % 97}?",
+            "response": "Have complex carbs and some protein about two hours before training. " * 3,
+            "timestamp": (start + timedelta(seconds=i)).isoformat(),
+        }
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--insert-batch", type=int, default=500)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--request-ms", type=float, default=60)
+    parser.add_argument("--job-ms", type=float, default=3000)
+    parser.add_argument("--load-mbps", type=float, default=200)
+    parser.add_argument("--upload-mbps", type=float, default=50)
+    args = parser.parse_args()
+
+    client = LocalBigQuery(
+        args.request_ms / 1000, args.job_ms / 1000,
+        args.load_mbps * 2**20, args.upload_mbps * 2**20,
+    )
+    print(f"{'method':>20} {'seconds':>8} {'rows/s':>9} {'sent MB':>8} {'billed MB':>10} {'calls':>6}")
+
+    start = time.perf_counter()
+    calls = sent = 0
+    for i, batch in enumerate(chunked(synthetic_chats(args.rows), args.insert_batch)):
+        ids = [f"{i}-{j}" for j in range(len(batch))]
+        client.insert_rows_json("chat_history", batch, row_ids=ids)
+        sent += sum(len(json.dumps(row)) for row in batch)
+        calls += 1
+    elapsed = time.perf_counter() - start
+    billed = sum(max(1024, len(json.dumps(row))) for row in synthetic_chats(args.rows))
+    print(
+        f"{'streaming inserts':>20} {elapsed:8.2f} {args.rows / elapsed:9.0f} "
+        f"{sent / 2**20:8.1f} {billed / 2**20:10.1f} {calls:>6}"
+    )
+
+    for file_format in (NDJSON, PARQUET):
+        directory = tempfile.mkdtemp(prefix="bench-bulk-")
+        try:
+            start = time.perf_counter()
+            files = StagingFiles(directory, "chat_history", CHAT_SCHEMA, file_format)
+            for chunk in chunked(synthetic_chats(args.rows), args.chunk_size):
+                files.write(chunk)
+            files.close()
+            with open(files.path, "rb") as f:
+                size = client.load_table_from_file(f, "chat_history")
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(directory)
+        label = f"{file_format} load job"
+        print(
+            f"{label:>20} {elapsed:8.2f} {args.rows / elapsed:9.0f} "
+            f"{size / 2**20:8.1f} {0:10.1f} {1:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Time chat reads from the Firestore emulator: per-user loop vs partitioned collection group.
+
+Usage:
+    export FIRESTORE_EMULATOR_HOST=localhost:8080
+    python benchmarks/bench_chat_reads.py --seed --users 500 --chats 40
+    python benchmarks/bench_chat_reads.py --workers 1 4 8 16
+
+The per-user loop is the original exporter: stream users, then each user's
+chats subcollection one after another. The partitioned runs use the same
+chat_partitions/read_partitions code as the sync, on a full backfill.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+    sys.exit("Set FIRESTORE_EMULATOR_HOST; this benchmark only runs against the emulator.")
+
+import app  # noqa: E402
+
+
+def seed(users, chats_per_user):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    batch, pending = app.firestore_client.batch(), 0
+    for u in range(users):
+        user_ref = app.firestore_client.collection("users").document(f"bench-user-{u}")
+        batch.set(user_ref, {"name": f"User {u}", "age": 20 + u % 50, "gender": "n/a"})
+        pending += 1
+        for c in range(chats_per_user):
+            batch.set(user_ref.collection("chats").document(), {
+                "query": f"How should I train for goal {c % 7}?",
+                "response": "Warm up, then three sets of squats and lunges. " * 8,
+                "timestamp": start + timedelta(minutes=u * chats_per_user + c),
+            })
+            pending += 1
+            if pending == 500:
+                batch.commit()
+                batch, pending = app.firestore_client.batch(), 0
+    if pending:
+        batch.commit()
+    print(f"Seeded {users} users with {chats_per_user} chats each.")
+
+
+def per_user_loop():
+    count = 0
+    users_ref = app.firestore_client.collection("users")
+    for user_doc in users_ref.stream():
+        for _ in users_ref.document(user_doc.id).collection("chats").stream():
+            count += 1
+    return count
+
+
+def partitioned(workers, page_size):
+    queries = app.chat_partitions(None, count=4 * workers)
+    return sum(1 for _ in app.read_partitions(queries, workers, page_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seed", action="store_true", help="Write a synthetic dataset first.")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--chats", type=int, default=40, help="Chats per seeded user.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--page-size", type=int, default=app.PAGE_SIZE)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args.users, args.chats)
+
+    start = time.perf_counter()
+    docs = per_user_loop()
+    baseline = time.perf_counter() - start
+    print(f"{'method':>16} {'docs':>8} {'seconds':>8} {'docs/s':>9} {'speedup':>8}")
+    print(f"{'per-user loop':>16} {docs:>8} {baseline:8.2f} {docs / baseline:9.0f} {1:8.2f}x")
+
+    for workers in args.workers:
+        start = time.perf_counter()
+        docs = partitioned(workers, args.page_size)
+        elapsed = time.perf_counter() - start
+        label = f"partitioned x{workers}"
+        print(f"{label:>16} {docs:>8} {elapsed:8.2f} {docs / elapsed:9.0f} {baseline / elapsed:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import io
+import json
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PARQUET = "parquet"
+NDJSON = "ndjson"
+
+# BigQuery source formats for each staging file format
+SOURCE_FORMATS = {PARQUET: "PARQUET", NDJSON: "NEWLINE_DELIMITED_JSON"}
+
+# Arrow types for the BigQuery column types the exported tables use
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INTEGER": pa.int64(),
+    "INT64": pa.int64(),
+    "FLOAT": pa.float64(),
+    "FLOAT64": pa.float64(),
+    "BOOLEAN": pa.bool_(),
+    "BOOL": pa.bool_(),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+}
+
+
+def arrow_schema(schema):
+    """Map BigQuery ``SchemaField``s to an Arrow schema; unknown types become strings."""
+    return pa.schema([
+        pa.field(field.name, ARROW_TYPES.get(field.field_type, pa.string())) for field in schema
+    ])
+
+
+def _coerce(value, arrow_type):
+    """Convert ``value`` to ``arrow_type``; raises ValueError or TypeError if it can't be."""
+    if value is None or value == "":
+        return None
+    if pa.types.is_integer(arrow_type):
+        return int(value)
+    if pa.types.is_floating(arrow_type):
+        return float(value)
+    if pa.types.is_timestamp(arrow_type):
+        if isinstance(value, str):
+            return datetime.fromisoformat(value)
+        if not isinstance(value, datetime):
+            raise TypeError(f"not a timestamp: {value!r}")
+    if pa.types.is_string(arrow_type) and not isinstance(value, str):
+        return str(value)
+    return value
+
+
+def to_arrow(rows, schema, invalid=None):
+    """Build an Arrow table from row dicts, converting values to the column types.
+
+    Free-form Firestore values that don't fit their column (an age of
+    "twenty") are written as null rather than failing the whole chunk, and
+    counted per column in the ``invalid`` Counter when one is given.
+    """
+    columns = []
+    for field in schema:
+        values = []
+        for row in rows:
+            try:
+                values.append(_coerce(row.get(field.name), field.type))
+            except (ValueError, TypeError, OverflowError):
+                values.append(None)
+                if invalid is not None:
+                    invalid[field.name] += 1
+        columns.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def clean_rows(rows, schema, invalid=None):
+    """Return ``rows`` with values that don't fit their Arrow column type set to None.
+
+    Valid values are kept as they are, so NDJSON output is unchanged for
+    clean rows; replaced values are counted per column in ``invalid``.
+    """
+    cleaned = []
+    for row in rows:
+        row = dict(row)
+        for field in schema:
+            try:
+                _coerce(row.get(field.name), field.type)
+            except (ValueError, TypeError, OverflowError):
+                row[field.name] = None
+                if invalid is not None:
+                    invalid[field.name] += 1
+        cleaned.append(row)
+    return cleaned
+
+
+def to_ndjson(rows):
+    return "".join(json.dumps(row, default=str) + "\n" for row in rows).encode("utf-8")
+
+
+def to_parquet(rows, schema, invalid=None):
+    buffer = io.BytesIO()
+    pq.write_table(to_arrow(rows, schema, invalid), buffer, compression="snappy")
+    return buffer.getvalue()
+
+
+class StagingFiles:
+    """Stages one table's rows as Parquet or NDJSON files for a single load job.
+
+    ``destination`` is a local directory or a ``gs://bucket/prefix`` URI. Locally,
+    every chunk is appended to one file (a new row group for Parquet); on GCS each
+    chunk becomes its own object so chunks can be uploaded concurrently, and the
+    load job reads them all through a wildcard URI. Values that could not be
+    converted to their column type are staged as null and counted in
+    ``invalid_values``.
+    """
+
+    def __init__(self, destination, name, schema, file_format=PARQUET, storage_client=None):
+        if file_format not in SOURCE_FORMATS:
+            raise ValueError(f"Unknown staging format: {file_format}")
+        self.name = name
+        self.file_format = file_format
+        self.source_format = SOURCE_FORMATS[file_format]
+        self.schema = arrow_schema(schema)
+        self.extension = "parquet" if file_format == PARQUET else "json"
+        self._lock = threading.Lock()
+        self._parts = 0
+        self._writer = None
+        self._file = None
+        self.invalid_values = Counter()  # column -> values written as null
+
+        if destination.startswith("gs://"):
+            bucket_name, _, prefix = destination[len("gs://"):].partition("/")
+            self._bucket = storage_client.bucket(bucket_name)
+            self._prefix = f"{prefix.rstrip('/')}/{name}".lstrip("/")
+            self.path = None
+            self.uri = f"gs://{bucket_name}/{self._prefix}/part-*.{self.extension}"
+        else:
+            os.makedirs(destination, exist_ok=True)
+            self._bucket = None
+            self.path = os.path.join(destination, f"{name}.{self.extension}")
+            self.uri = None
+            if file_format == PARQUET:
+                # Keep the sink so write() can report how much each row group added to the file
+                self._file = pa.OSFile(self.path, "wb")
+                self._writer = pq.ParquetWriter(self._file, self.schema, compression="snappy")
+            else:
+                self._file = open(self.path, "wb")
+
+    def write(self, rows):
+        """Stage ``rows`` and return the bytes written; safe to call from several threads."""
+        invalid = Counter()
+        if self._bucket is not None:
+            if self.file_format == PARQUET:
+                data = to_parquet(rows, self.schema, invalid)
+            else:
+                data = to_ndjson(clean_rows(rows, self.schema, invalid))
+            with self._lock:
+                self._parts += 1
+                part = self._parts
+                self.invalid_values.update(invalid)
+            blob = self._bucket.blob(f"{self._prefix}/part-{part:05d}.{self.extension}")
+            blob.upload_from_string(data)
+            return len(data)
+
+        if self.file_format == PARQUET:
+            table = to_arrow(rows, self.schema, invalid)
+            with self._lock:
+                self.invalid_values.update(invalid)
+                start = self._file.tell()
+                self._writer.write_table(table)
+                return self._file.tell() - start
+        data = to_ndjson(clean_rows(rows, self.schema, invalid))
+        with self._lock:
+            self.invalid_values.update(invalid)
+            self._file.write(data)
+        return len(data)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+
+    def cleanup(self):
+        """Delete the staged files once they have been loaded."""
+        self.close()
+        if self._bucket is not None:
+            for blob in self._bucket.list_blobs(prefix=f"{self._prefix}/"):
+                blob.delete()
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+            try:
+                os.rmdir(os.path.dirname(self.path))
+            except OSError:
+                pass  # other tables of the run are still staged there
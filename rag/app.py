@@ -1,18 +1,32 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 import numpy as np
 from flask_cors import CORS
-import faiss
 import vertexai
-from google.cloud import aiplatform
 from vertexai.generative_models import GenerativeModel
 import logging
 import os
 import json
+import time
+import uuid
 import warnings
 from datetime import datetime
 from google.oauth2 import service_account
-from google.protobuf.json_format import MessageToDict
 from google.cloud import storage  # Import the GCS client library
+from conversation_memory import ConversationMemory, assemble_prompt
+from document_columns import DocumentColumns
+from embedding_cache import EmbeddingCache, normalize_text
+from embeddings import DeadlineEmbedder, PredictionClientPool, predict_embeddings
+from index_factory import (
+    FLAT,
+    IndexPromoter,
+    create_index,
+    deserialize_index,
+    index_bytes,
+)
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from metrics import metrics
+from patient_store import PatientStore
+from segment_store import SegmentCompactor, SegmentStore
 
 # Suppress specific future warnings that aren't critical to functionality
 warnings.filterwarnings("ignore", category=FutureWarning)
@@ -49,6 +63,26 @@ EMBEDDING_MODEL_ENDPOINT = (
 # Embedding dimensions for textembedding-gecko
 embedding_dimension = 768
 
+# Maximum number of instances textembedding-gecko accepts per predict call
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 5))
+
+# Long-lived prediction clients shared by all request threads
+prediction_client_pool = PredictionClientPool(
+    credentials=credentials,
+    api_endpoint="us-central1-aiplatform.googleapis.com",
+    size=int(os.environ.get("PREDICTION_CLIENT_POOL_SIZE", 2)),
+)
+
+# Embedding cache keyed by endpoint + normalized text; set EMBEDDING_CACHE_DIR
+# to keep a memory-mapped copy on disk across restarts
+embedding_cache = EmbeddingCache(
+    namespace=EMBEDDING_MODEL_ENDPOINT,
+    dimension=embedding_dimension,
+    max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000)),
+    disk_dir=os.environ.get("EMBEDDING_CACHE_DIR"),
+    disk_capacity=int(os.environ.get("EMBEDDING_CACHE_DISK_CAPACITY", 100000)),
+)
+
 # GCS bucket name
 GCS_BUCKET_NAME = "getufit1"
 
@@ -57,65 +91,91 @@ storage_client = storage.Client(
     credentials=credentials, project="buildnblog"
 )
 
-# Initialize the language model
-model = GenerativeModel("gemini-1.5-flash-002")
+# Segment-based patient persistence and its background compactor
+segment_store = SegmentStore(storage_client, GCS_BUCKET_NAME, embedding_dimension)
+segment_compactor = SegmentCompactor(
+    segment_store,
+    small_rows=int(os.environ.get("SEGMENT_SMALL_ROWS", 64)),
+    max_small_segments=int(os.environ.get("SEGMENT_MAX_SMALL", 8)),
+)
 
-# Initialize dictionary for patient data
-patients_data = {}
+# Patients start on a brute-force Flat index and move to an ANN index
+# ("ivf" or "hnsw") once they reach ANN_PROMOTE_THRESHOLD documents
+ANN_INDEX_KIND = os.environ.get("ANN_INDEX_KIND", "ivf")
+ANN_PROMOTE_THRESHOLD = int(os.environ.get("ANN_PROMOTE_THRESHOLD", 5000))
 
+# Retrieval fuses BM25 and vector rankings ("hybrid"); "vector" and "lexical"
+# use one side only. Each side contributes HYBRID_CANDIDATES rows to the fusion.
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "hybrid")
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", 20))
 
-# Function to ensure patient-specific data structures are set up
-def ensure_patient_data(patient_id):
-    if patient_id not in patients_data:
-        patients_data[patient_id] = {
-            "text_index": faiss.IndexFlatL2(embedding_dimension),
-            "text_documents": [],  # Holds dictionaries with 'text' and 'timestamp'
-            "text_embeddings": [],
-        }
+# Initialize the language model
+model = GenerativeModel("gemini-1.5-flash-002")
 
+# Function to create an empty patient-specific data structure
+def new_patient_data():
+    # Vectors live only in the FAISS index; documents are kept column-wise
+    return {
+        "text_index": create_index(FLAT, embedding_dimension),
+        "text_documents": DocumentColumns(),
+        # BM25 postings over the same rows, rebuilt from the texts on load
+        "lexical_index": BM25Index(),
+    }
 
-# Function to generate embeddings using Vertex AI
-def generate_gcp_embedding(text):
-    """Generate embedding using GCP Vertex AI model."""
-    if not isinstance(text, str) or not text.strip():
-        raise ValueError("Text content for embedding must be a non-empty string.")
 
-    prediction_client = aiplatform.gapic.PredictionServiceClient(
-        client_options={"api_endpoint": "us-central1-aiplatform.googleapis.com"},
-        credentials=credentials,
-    )
-    instance = {"content": text}
-
-    try:
-        response = prediction_client.predict(
-            endpoint=EMBEDDING_MODEL_ENDPOINT, instances=[instance]
-        )
-        response_dict = MessageToDict(response._pb)
+# Function to generate embeddings using Vertex AI
+def generate_gcp_embeddings_batch(texts):
+    """Generate embeddings for a list of texts as an (n, 768) float32 matrix."""
+    for text in texts:
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError("Text content for embedding must be a non-empty string.")
+
+    embeddings = np.empty((len(texts), embedding_dimension), dtype=np.float32)
+
+    # Serve what we can from the cache and embed each distinct miss once. Misses
+    # are grouped by normalized text, which the cache key is built from, but the
+    # model sees the first caller's original text for each group
+    missing = {}
+    for i, text in enumerate(texts):
+        cached = embedding_cache.get(text)
+        if cached is not None:
+            embeddings[i] = cached
+        else:
+            missing.setdefault(normalize_text(text), []).append(i)
 
-        predictions = response_dict.get("predictions")
-        if not predictions:
-            raise ValueError("No predictions found in response.")
+    if missing:
+        missing_texts = [texts[rows[0]] for rows in missing.values()]
+        try:
+            computed = predict_embeddings(
+                prediction_client_pool,
+                EMBEDDING_MODEL_ENDPOINT,
+                missing_texts,
+                embedding_dimension,
+                EMBEDDING_BATCH_SIZE,
+            )
+        except Exception as e:
+            logging.error(f"Error generating embeddings: {e}")
+            raise
 
-        embeddings = predictions[0].get("embeddings")
-        if embeddings is None:
-            raise ValueError("Embeddings not found in response.")
+        for (key_text, rows), embedding in zip(missing.items(), computed):
+            embedding_cache.put(key_text, embedding)
+            embeddings[rows] = embedding
 
-        # Handle nested 'values' structure
-        if isinstance(embeddings, dict) and "values" in embeddings:
-            embedding_values = embeddings["values"]
-        elif isinstance(embeddings, list):
-            embedding_values = embeddings
-        else:
-            raise ValueError(f"Unexpected embeddings format: {embeddings}")
+    return embeddings
 
-        # Convert values to float
-        return np.array([float(value) for value in embedding_values], dtype=np.float32)
 
-    except Exception as e:
-        logging.error(f"Error generating embedding: {e}")
-        raise
+def generate_gcp_embedding(text):
+    """Generate embedding using GCP Vertex AI model."""
+    return generate_gcp_embeddings_batch([text])[0]
 
 
+# Query embeddings give up after QUERY_EMBEDDING_TIMEOUT seconds so retrieval
+# can fall back to BM25 alone while the embedding service is slow or down
+query_embedder = DeadlineEmbedder(
+    generate_gcp_embedding,
+    timeout=float(os.environ.get("QUERY_EMBEDDING_TIMEOUT", 1.5)),
+    cooldown=int(os.environ.get("QUERY_EMBEDDING_COOLDOWN", 30)),
+)
 
 
 # Function to upload data to GCS
@@ -141,67 +201,104 @@ def download_from_gcs(bucket_name, source_blob_name):
     return data
 
 
-# Function to save embeddings and documents to GCS
-def save_patient_data_to_gcs(patient_id, data):
-    # Save embeddings
-    embeddings_blob_name = f"embeddings/{patient_id}/{patient_id}_embeddings.npy"
-    embeddings_data = np.array(data["text_embeddings"], dtype=np.float32)
-    # Convert numpy array to bytes
-    embeddings_bytes = embeddings_data.tobytes()
-    upload_to_gcs(GCS_BUCKET_NAME, embeddings_blob_name, embeddings_bytes)
-
-    # Save documents
-    documents_blob_name = f"documents/{patient_id}/{patient_id}_documents.json"
-    # Serialize documents to JSON string
-    documents_json = json.dumps(data["text_documents"], default=str)
-    upload_to_gcs(GCS_BUCKET_NAME, documents_blob_name, documents_json)
+# Function to persist newly inserted embeddings and documents to GCS
+def append_patient_data_to_gcs(patient_id, embeddings, documents):
+    """Upload only the new rows as a segment and schedule compaction if needed."""
+    manifest = segment_store.append_segment(patient_id, embeddings, documents)
+    segment_compactor.maybe_schedule(patient_id, manifest)
 
 
 # Function to load embeddings and documents from GCS
 def load_patient_data_from_gcs(patient_id):
-    data = patients_data[patient_id]
+    data = new_patient_data()
 
-    # Load embeddings
-    embeddings_blob_name = f"embeddings/{patient_id}/{patient_id}_embeddings.npy"
     try:
-        embeddings_bytes = download_from_gcs(
-            GCS_BUCKET_NAME, embeddings_blob_name
-        )
-        embeddings_data = np.frombuffer(
-            embeddings_bytes, dtype=np.float32
-        ).reshape(-1, embedding_dimension)
-        data["text_embeddings"] = embeddings_data.tolist()
-        # Reconstruct FAISS index
-        data["text_index"].add(embeddings_data)
+        embeddings_data, documents, manifest = segment_store.load(patient_id)
     except Exception as e:
-        logging.info(
-            f"No embeddings found in GCS for patient {patient_id}: {e}"
-        )
+        logging.error(f"Failed to load data from GCS for patient {patient_id}: {e}")
+        raise
+
+    if manifest is None:
+        logging.info(f"No stored data found in GCS for patient {patient_id}.")
+        return data
+
+    # Reuse a persisted ANN index if there is one, otherwise rebuild Flat
+    index = load_patient_index_from_gcs(patient_id, manifest, embeddings_data)
+    if index is not None:
+        data["text_index"] = index
+        if index.ntotal < len(embeddings_data):
+            index.add(embeddings_data[index.ntotal:])
+    else:
+        data["text_index"].add(embeddings_data)
+    data["text_documents"].extend(documents)
+    data["lexical_index"].add(document["text"] for document in documents)
+    return data
+
 
-    # Load documents
-    documents_blob_name = f"documents/{patient_id}/{patient_id}_documents.json"
+# Function to load a trained index persisted after promotion
+def load_patient_index_from_gcs(patient_id, manifest, embeddings_data):
+    index_info = manifest.get("index")
+    if not index_info or index_info["ntotal"] > len(embeddings_data):
+        return None
     try:
-        documents_json = download_from_gcs(
-            GCS_BUCKET_NAME, documents_blob_name
-        )
-        data["text_documents"] = json.loads(documents_json)
+        index = deserialize_index(segment_store.download_index(index_info))
     except Exception as e:
-        logging.info(
-            f"No documents found in GCS for patient {patient_id}: {e}"
-        )
+        logging.error(f"Failed to load {index_info['kind']} index for patient {patient_id}: {e}")
+        return None
+
+    # Spot-check that the index rows still line up with the stored segments
+    ntotal = index.ntotal
+    if ntotal == 0:
+        return None
+    for row in {0, ntotal // 2, ntotal - 1}:
+        if not np.allclose(index.reconstruct(row), embeddings_data[row]):
+            logging.info(f"Stale {index_info['kind']} index for patient {patient_id}, rebuilding.")
+            return None
+    return index
+
+
+# Function to persist a freshly promoted index to GCS
+def save_patient_index_to_gcs(patient_id, kind, ntotal, index_data):
+    try:
+        segment_store.save_index(patient_id, kind, ntotal, index_data)
+    except Exception as e:
+        logging.error(f"Failed to save {kind} index for patient {patient_id}: {e}")
 
 
-# Function to insert text documents for a specific patient
-def insert_text_documents(patient_id, documents):
-    ensure_patient_data(patient_id)
-    data = patients_data[patient_id]
+index_promoter = IndexPromoter(
+    ANN_INDEX_KIND,
+    ANN_PROMOTE_THRESHOLD,
+    embedding_dimension,
+    on_promoted=save_patient_index_to_gcs,
+)
 
-    # Load existing data from GCS
-    load_patient_data_from_gcs(patient_id)
 
+# Function to estimate the resident memory of a patient's data structure
+def estimate_patient_bytes(data):
+    return (
+        index_bytes(data["text_index"])
+        + data["text_documents"].nbytes
+        + data["lexical_index"].nbytes
+    )
+
+
+# Per-patient residency: each patient is loaded once and flushed incrementally
+patient_store = PatientStore(
+    loader=load_patient_data_from_gcs,
+    flusher=append_patient_data_to_gcs,
+    sizer=estimate_patient_bytes,
+    max_bytes=int(os.environ.get("PATIENT_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+    idle_ttl=int(os.environ.get("PATIENT_CACHE_IDLE_TTL", 1800)),
+)
+
+
+# Function to insert text documents for a specific patient
+def insert_text_documents(patient_id, documents):
+    start = time.perf_counter()
+    texts = []
     for doc in documents:
         raw_text = doc["text"]
-        
+
         # Serialize the text if it's a dictionary
         if isinstance(raw_text, dict):
             text = json.dumps(raw_text, indent=2)  # Convert to a JSON-formatted string
@@ -213,19 +310,42 @@ def insert_text_documents(patient_id, documents):
             continue
 
         logging.info(f"Inserting document text: {text}")
-        timestamp = datetime.now().isoformat()
-
-        # Generate embedding using Vertex AI
-        embedding = generate_gcp_embedding(text)
-
-        data["text_documents"].append({"text": text, "timestamp": timestamp})
-        data["text_embeddings"].append(embedding.tolist())
-
-        # Add the embedding to the FAISS index
-        data["text_index"].add(np.array([embedding]).astype(np.float32))
-
-    # Save embeddings and documents to GCS
-    save_patient_data_to_gcs(patient_id, data)
+        texts.append(text)
+
+    if not texts:
+        return {"inserted": 0, "docs_per_second": 0.0}
+
+    # Generate all embeddings in as few Vertex AI calls as possible
+    embeddings = generate_gcp_embeddings_batch(texts)
+
+    # Load existing data from GCS unless it is already resident
+    with patient_store.use(patient_id) as entry:
+        with entry.lock:
+            data = entry.data
+            new_documents = [
+                {"text": text, "timestamp": datetime.now().isoformat()}
+                for text in texts
+            ]
+            data["text_documents"].extend(new_documents)
+
+            # Add the embeddings to the FAISS index and the texts to BM25
+            data["text_index"].add(embeddings)
+            data["lexical_index"].add(texts)
+            patient_store.mark_dirty(entry, embeddings, new_documents)
+            index_promoter.maybe_promote(entry)
+
+        # Persist only the new rows to GCS
+        patient_store.flush(patient_id)
+
+    elapsed = time.perf_counter() - start
+    docs_per_second = len(texts) / elapsed if elapsed > 0 else 0.0
+    metrics.observe("ingest.insert_text_documents", elapsed)
+    metrics.incr("ingest.documents", len(texts))
+    logging.info(
+        f"Inserted {len(texts)} documents for patient {patient_id} "
+        f"({docs_per_second:.1f} docs/s)."
+    )
+    return {"inserted": len(texts), "docs_per_second": round(docs_per_second, 2)}
 
 
 # Route for adding data
@@ -248,59 +368,119 @@ def add_data():
             return jsonify({"error": "Each document must have a non-empty 'text' field."}), 400
 
     # Insert validated documents
-    insert_text_documents(patient_id, documents)
+    stats = insert_text_documents(patient_id, documents)
 
-    return jsonify({"message": "Data added successfully"}), 200
+    return jsonify({"message": "Data added successfully", **stats}), 200
 
 
 # Function to retrieve top documents for a specific patient
 def retrieve_top_text_documents(patient_id, query, top_n=3):
-    ensure_patient_data(patient_id)
-    data = patients_data[patient_id]
-
-    # Load existing data from GCS if not already loaded
-    if data["text_index"].ntotal == 0:
-        load_patient_data_from_gcs(patient_id)
-
-    if data["text_index"].ntotal == 0:
-        logging.info(
-            f"No embeddings found for patient {patient_id}. "
-            "Please add documents first."
-        )
-        return []
-
-    # Generate query embedding using Vertex AI
-    query_embedding = generate_gcp_embedding(query)
-    query_embedding = np.array([query_embedding]).astype(np.float32)
-
-    distances, indices = data["text_index"].search(query_embedding, top_n)
-
-    retrieved_docs = [
-        data["text_documents"][int(index)]["text"]
-        for index in indices[0]
-        if 0 <= index < len(data["text_documents"])
-    ]
-
+    """Return the ``top_n`` texts best matching ``query``.
+
+    BM25 and vector rankings are fused with reciprocal rank fusion, so exact
+    mentions of a medication or lab value rank alongside semantic matches.
+    If the query embedding fails or misses its deadline, the BM25 ranking
+    is used alone.
+    """
+    start = time.perf_counter()
+    candidates = max(top_n, HYBRID_CANDIDATES)
+    # Load existing data from GCS if not already resident
+    with patient_store.use(patient_id) as entry:
+        if entry.data["text_index"].ntotal == 0:
+            logging.info(
+                f"No embeddings found for patient {patient_id}. "
+                "Please add documents first."
+            )
+            return []
+
+        lexical_rows = []
+        if RETRIEVAL_MODE != "vector":
+            with entry.lock:
+                matches = entry.data["lexical_index"].search(query, candidates)
+            lexical_rows = [row for row, _ in matches]
+
+        # Generate query embedding using Vertex AI
+        if RETRIEVAL_MODE == "lexical":
+            query_embedding = None
+        elif RETRIEVAL_MODE == "vector":
+            query_embedding = generate_gcp_embedding(query)
+        else:
+            query_embedding = query_embedder(query)
+
+        with entry.lock:
+            data = entry.data
+            if query_embedding is not None:
+                query_embedding = np.array([query_embedding]).astype(np.float32)
+                distances, indices = data["text_index"].search(query_embedding, candidates)
+                index_promoter.maybe_promote(entry)
+                vector_rows = [int(index) for index in indices[0] if index >= 0]
+                if lexical_rows:
+                    rows = reciprocal_rank_fusion([vector_rows, lexical_rows], top_n)
+                    metrics.incr("retrieval.hybrid")
+                else:
+                    rows = vector_rows[:top_n]
+                    metrics.incr("retrieval.vector_only")
+            else:
+                rows = lexical_rows[:top_n]
+                metrics.incr("retrieval.lexical_only")
+
+            texts = data["text_documents"].texts
+            retrieved_docs = [texts[row] for row in rows if 0 <= row < len(texts)]
+
+    metrics.observe("retrieval.total", time.perf_counter() - start)
     return retrieved_docs
 
 
 # Function to retrieve the latest document for a patient by timestamp
 def retrieve_latest_document(patient_id):
-    ensure_patient_data(patient_id)
-    data = patients_data[patient_id]
-
-    # Load existing data from GCS if not already loaded
-    if not data["text_documents"]:
-        load_patient_data_from_gcs(patient_id)
+    # Answer from memory if the patient is resident
+    with patient_store.peek(patient_id) as entry:
+        if entry is not None:
+            with entry.lock:
+                latest = entry.data["text_documents"].latest()
+            metrics.incr("latest.resident")
+            return latest["text"] if latest else "No health records available."
+
+    # Otherwise the manifest alone carries the newest record
+    manifest, _ = segment_store.read_manifest(patient_id)
+    if manifest is not None and manifest.get("latest"):
+        metrics.incr("latest.manifest")
+        return manifest["latest"]["text"]
+
+    # Older manifests (or legacy blobs) need a full load
+    metrics.incr("latest.full_load")
+    with patient_store.use(patient_id) as entry, entry.lock:
+        latest = entry.data["text_documents"].latest()
+        return latest["text"] if latest else "No health records available."
+
+
+# Function to retrieve a patient's records by recency or time range
+def retrieve_documents_by_time(patient_id, latest_n=None, start=None, end=None):
+    with patient_store.use(patient_id) as entry, entry.lock:
+        documents = entry.data["text_documents"]
+        if latest_n is not None:
+            return documents.latest_n(latest_n)
+        return documents.between(start, end)
+
+
+# Route for listing records by recency or time range
+@app.route("/records", methods=["GET"])
+def records():
+    patient_id = request.args.get("patient_id")
+    if not patient_id:
+        return jsonify({"error": "Patient ID is required."}), 400
 
-    if not data["text_documents"]:
-        return "No health records available."
+    latest_n = request.args.get("latest", type=int)
+    if "latest" in request.args and (latest_n is None or latest_n < 1):
+        return jsonify({"error": "latest must be a positive integer."}), 400
+    start = request.args.get("start")
+    end = request.args.get("end")
+    try:
+        documents = retrieve_documents_by_time(patient_id, latest_n, start, end)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid timestamp: {e}"}), 400
 
-    # Find the latest document by timestamp
-    latest_document = max(
-        data["text_documents"], key=lambda x: x["timestamp"]
-    )
-    return latest_document["text"]
+    return jsonify({"records": documents}), 200
 
 
 # Set generation configuration
@@ -311,56 +491,207 @@ generation_config = {
 }
 
 
-# Function to handle the RAG pipeline for a specific patient
-def rag_pipeline(
-    patient_id, query, conversation_context="", top_n=3
-):
-    ensure_patient_data(patient_id)
+# Token budget for everything sent to Gemini besides the generation itself
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 6000))
+
+summary_config = {
+    "max_output_tokens": 512,
+    "temperature": 0.2,
+}
+
+
+# Function to fold older conversation turns into the running summary
+def summarize_conversation(summary, turns):
+    prompt = (
+        "Update the summary of this conversation between a patient and a health "
+        "assistant. Keep symptoms, medications, measurements, goals and advice "
+        "already given; drop small talk. Reply with the summary only.\n\n"
+        f"Current summary:\n{summary or '(none)'}\n\n"
+        "New turns:\n" + "\n".join(turns)
+    )
+    response = model.generate_content(prompt, generation_config=summary_config)
+    return response.text.strip()
+
+
+# Per-patient, per-session conversation memory for /chat
+conversation_memory = ConversationMemory(
+    summarizer=summarize_conversation,
+    window=int(os.environ.get("CONVERSATION_WINDOW_TURNS", 6)),
+    summary_every=int(os.environ.get("CONVERSATION_SUMMARY_EVERY", 4)),
+    max_sessions=int(os.environ.get("CONVERSATION_MAX_SESSIONS", 10000)),
+    idle_ttl=int(os.environ.get("CONVERSATION_IDLE_TTL", 3600)),
+)
 
+
+# Function to build the prompt for a patient's query
+def prepare_rag_prompt(patient_id, query, session_id=None, conversation_context="", top_n=3):
+    """Return ``(direct_answer, prompt)``; exactly one of them is set.
+
+    With a ``session_id`` the conversation comes from server-side memory;
+    otherwise a client-supplied ``conversation_context`` is used as is.
+    """
     # Check if the query specifically asks for the latest issue
     if "latest health issue" in query.lower():
-        return retrieve_latest_document(patient_id)
+        return retrieve_latest_document(patient_id), None
 
     # Retrieve relevant documents
     retrieved_docs = retrieve_top_text_documents(
         patient_id, query, top_n
     )
 
-    # If no docs retrieved, fall back to query-only response
-    if not retrieved_docs:
+    if session_id is not None:
+        context, turns = conversation_memory.context(patient_id, session_id)
+    else:
+        context, turns = conversation_context, []
+
+    # Without documents or history the query goes to Gemini on its own
+    prompt, prompt_tokens, dropped_tokens = assemble_prompt(
+        query, retrieved_docs, PROMPT_TOKEN_BUDGET, context, turns
+    )
+    metrics.incr("chat.prompt_tokens", prompt_tokens)
+    metrics.incr("chat.context_tokens_dropped", dropped_tokens)
+    logging.info(
+        f"Prompt for patient {patient_id}: {prompt_tokens} tokens, "
+        f"{dropped_tokens} over budget dropped."
+    )
+    return None, prompt
+
+
+# Function to handle the RAG pipeline for a specific patient
+def rag_pipeline(
+    patient_id, query, session_id=None, conversation_context="", top_n=3
+):
+    answer, prompt = prepare_rag_prompt(
+        patient_id, query, session_id, conversation_context, top_n
+    )
+    if answer is None:
         response = model.start_chat().send_message(
-            query, generation_config=generation_config
+            prompt, generation_config=generation_config
         )
-        return response.text
+        answer = response.text
+
+    if session_id is not None:
+        conversation_memory.record(patient_id, session_id, query, answer)
+    return answer
+
 
-    # Use all retrieved docs as context for generating a response
-    context = "\n".join(retrieved_docs)
-    full_context = (
-        f"{conversation_context}\nRelevant Information:\n"
-        f"{context}\n\nQuestion:\n{query}"
+# Function to stream the RAG pipeline response chunk by chunk
+def rag_pipeline_stream(
+    patient_id, query, session_id=None, conversation_context="", top_n=3
+):
+    answer, prompt = prepare_rag_prompt(
+        patient_id, query, session_id, conversation_context, top_n
     )
+    if answer is not None:
+        yield answer
+        return
 
-    response = model.start_chat().send_message(
-        full_context, generation_config=generation_config
+    responses = model.start_chat().send_message(
+        prompt, generation_config=generation_config, stream=True
     )
-    return response.text
+    for chunk in responses:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. a trailing finish reason)
+            continue
+        if text:
+            yield text
+
+
+# Function to format a server-sent event
+def sse_event(data, event=None):
+    message = f"data: {json.dumps(data)}\n\n"
+    return f"event: {event}\n{message}" if event else message
+
+
+# Function to forward a streamed RAG response as server-sent events
+def stream_chat_events(patient_id, query, session_id, conversation_context, started):
+    parts = []
+    try:
+        for text in rag_pipeline_stream(patient_id, query, session_id, conversation_context):
+            if not parts:
+                metrics.observe("chat.stream.ttfb", time.perf_counter() - started)
+            parts.append(text)
+            yield sse_event({"text": text})
+    except Exception as e:
+        logging.error(f"Error streaming chat response: {e}")
+        metrics.incr("chat.stream.errors")
+        yield sse_event({"error": str(e)}, event="error")
+        return
+
+    response = "".join(parts)
+    if session_id is not None:
+        conversation_memory.record(patient_id, session_id, query, response)
+    metrics.incr("chat.turns")
+    metrics.observe("chat.stream.total", time.perf_counter() - started)
+    yield sse_event({"response": response, "session_id": session_id}, event="done")
 
 
 # Route for chatting with the bot
 @app.route("/chat", methods=["POST"])
 def chat():
+    """Answer a patient's query.
+
+    Conversation history is kept server-side per ``session_id``; a request
+    without one and without a legacy ``conversation_context`` starts a new
+    session, whose id is returned for the following turns.
+    """
+    started = time.perf_counter()
     content = request.json
     patient_id = content["patient_id"]
     query = content["query"]
 
     conversation_context = content.get("conversation_context", "")
+    session_id = content.get("session_id")
+    if session_id is None and not conversation_context:
+        session_id = uuid.uuid4().hex
+
+    # Opt-in streaming: forward chunks as server-sent events
+    if content.get("stream") is True:
+        return Response(
+            stream_with_context(
+                stream_chat_events(patient_id, query, session_id, conversation_context, started)
+            ),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     # Get response from RAG pipeline
     response = rag_pipeline(
-        patient_id, query, conversation_context
+        patient_id, query, session_id, conversation_context
     )
 
-    return jsonify({"response": response}), 200
+    metrics.incr("chat.turns")
+    metrics.observe("chat.total", time.perf_counter() - started)
+    return jsonify({"response": response, "session_id": session_id}), 200
+
+
+# Route for forgetting a conversation
+@app.route("/chat/session", methods=["DELETE"])
+def end_chat_session():
+    patient_id = request.args.get("patient_id")
+    session_id = request.args.get("session_id")
+    if not patient_id or not session_id:
+        return jsonify({"error": "Patient ID and session ID are required."}), 400
+    if not conversation_memory.clear(patient_id, session_id):
+        return jsonify({"error": "Session not found."}), 404
+    return jsonify({"message": "Session cleared"}), 200
+
+
+# Route for inspecting the resident patient cache
+@app.route("/admin/patients", methods=["GET"])
+def admin_patients():
+    return jsonify(patient_store.stats()), 200
+
+
+# Route for in-process metrics
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    snapshot = metrics.snapshot()
+    snapshot["embedding_cache"] = embedding_cache.stats()
+    snapshot["conversation_memory"] = conversation_memory.stats()
+    return jsonify(snapshot), 200
 
 
 # Run the Flask app
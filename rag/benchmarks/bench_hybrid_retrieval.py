@@ -0,0 +1,158 @@
+"""Compare vector, BM25 and hybrid (RRF) retrieval on a synthetic patient corpus.
+
+Usage: python benchmarks/bench_hybrid_retrieval.py [--sizes 1000 10000] [--queries 300] [--k 3]
+
+Each note is about one topic (diabetes, knee, ...) and names one specific
+entity of it (metformin, ACL, ...). Note vectors are a topic center plus a
+weaker entity direction and noise, approximating embeddings that capture the
+topic well but blur which drug or injury is named. Half the queries name an
+entity (relevant: notes naming it); the other half paraphrase the topic
+in everyday words (relevant: every note of the topic). The query
+embedding call is not timed; "lexical" is the fallback used when it fails.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_factory import FLAT, create_index  # noqa: E402
+from lexical_index import BM25Index, reciprocal_rank_fusion  # noqa: E402
+
+DIMENSION = 768
+CANDIDATES = 20
+
+TOPICS = {
+    "diabetes": {
+        "entities": ["metformin", "insulin", "glipizide", "A1C 7.2", "jardiance"],
+        "words": "glucose fasting reading dose meal carbs sugar morning evening",
+        "paraphrase": "how is my blood sugar control going",
+    },
+    "cardio": {
+        "entities": ["lisinopril", "atorvastatin", "amlodipine", "LDL 130", "troponin"],
+        "words": "blood pressure systolic diastolic heart rate cholesterol chest",
+        "paraphrase": "any concerns about my heart health lately",
+    },
+    "knee": {
+        "entities": ["ACL", "meniscus", "patellar tendon", "MCL", "arthroscopy"],
+        "words": "knee swelling squat lunge brace flexion extension pain",
+        "paraphrase": "can I go back to running on my injured leg",
+    },
+    "sleep": {
+        "entities": ["melatonin", "zolpidem", "CPAP", "trazodone", "apnea"],
+        "words": "slept hours woke night insomnia tired nap bedtime",
+        "paraphrase": "why do I feel exhausted after resting",
+    },
+    "respiratory": {
+        "entities": ["albuterol", "montelukast", "FEV1 82", "fluticasone", "spirometry"],
+        "words": "breathing wheeze inhaler cough shortness breath asthma",
+        "paraphrase": "I get winded climbing stairs what should I do",
+    },
+}
+
+
+def synthetic_corpus(rng, n):
+    topic_names = list(TOPICS)
+    centers = {t: rng.standard_normal(DIMENSION).astype(np.float32) for t in topic_names}
+    entity_dirs = {
+        e: rng.standard_normal(DIMENSION).astype(np.float32)
+        for t in topic_names for e in TOPICS[t]["entities"]
+    }
+    texts, topics, entities = [], [], []
+    vectors = np.empty((n, DIMENSION), dtype=np.float32)
+    for i in range(n):
+        topic = topic_names[rng.integers(len(topic_names))]
+        entity = TOPICS[topic]["entities"][rng.integers(5)]
+        words = rng.choice(TOPICS[topic]["words"].split(), 6)
+        texts.append(f"Day {i}: {' '.join(words[:3])}, on {entity}, {' '.join(words[3:])} noted.")
+        topics.append(topic)
+        entities.append(entity)
+        vectors[i] = centers[topic] + 0.12 * entity_dirs[entity] + 1.2 * rng.standard_normal(DIMENSION)
+    return texts, vectors, np.array(topics), np.array(entities), centers, entity_dirs
+
+
+def synthetic_queries(rng, count, centers, entity_dirs):
+    queries = []
+    topic_names = list(TOPICS)
+    for i in range(count):
+        topic = topic_names[rng.integers(len(topic_names))]
+        noise = 1.2 * rng.standard_normal(DIMENSION).astype(np.float32)
+        if i % 2 == 0:
+            entity = TOPICS[topic]["entities"][rng.integers(5)]
+            vector = centers[topic] + 0.12 * entity_dirs[entity] + noise
+            queries.append(("entity", f"Is the {entity} still working for me?", vector, topic, entity))
+        else:
+            vector = centers[topic] + noise
+            queries.append(("topic", TOPICS[topic]["paraphrase"], vector, topic, None))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(
+        f"{'docs':>6} {'method':>8} {'query kind':>10} "
+        f"{'P@' + str(args.k):>6} {'MRR':>6} {'query ms':>9}"
+    )
+    for n in args.sizes:
+        texts, vectors, topics, entities, centers, entity_dirs = synthetic_corpus(rng, n)
+        index = create_index(FLAT, DIMENSION, vectors)
+
+        # Build BM25 in ingest-sized batches, the way /add_data feeds it
+        lexical = BM25Index()
+        start = time.perf_counter()
+        for i in range(0, n, 50):
+            lexical.add(texts[i:i + 50])
+        build = time.perf_counter() - start
+        print(f"{n:>6} BM25 build {n / build:,.0f} docs/s, ~{lexical.nbytes / 1e6:.1f} MB")
+
+        results = {}
+        for kind, text, vector, topic, entity in synthetic_queries(rng, args.queries, centers, entity_dirs):
+            relevant = entities == entity if kind == "entity" else topics == topic
+
+            start = time.perf_counter()
+            _, indices = index.search(vector[None, :], CANDIDATES)
+            vector_rows = [int(i) for i in indices[0] if i >= 0]
+            vector_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            lexical_rows = [row for row, _ in lexical.search(text, CANDIDATES)]
+            lexical_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            fused = (
+                reciprocal_rank_fusion([vector_rows, lexical_rows], args.k)
+                if lexical_rows else vector_rows[:args.k]
+            )
+            hybrid_time = vector_time + lexical_time + time.perf_counter() - start
+
+            for method, rows, elapsed in (
+                ("vector", vector_rows[:args.k], vector_time),
+                ("lexical", lexical_rows[:args.k], lexical_time),
+                ("hybrid", fused, hybrid_time),
+            ):
+                hits = [bool(relevant[row]) for row in rows]
+                first = next((rank for rank, hit in enumerate(hits, start=1) if hit), None)
+                stats = results.setdefault((method, kind), [0.0, 0.0, 0.0, 0])
+                stats[0] += sum(hits) / args.k
+                stats[1] += 1 / first if first else 0.0
+                stats[2] += elapsed
+                stats[3] += 1
+
+        for (method, kind), (precision, mrr, elapsed, count) in sorted(results.items()):
+            print(
+                f"{n:>6} {method:>8} {kind:>10} {precision / count:>6.3f} "
+                f"{mrr / count:>6.3f} {elapsed / count * 1000:>9.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Compare per-patient memory of the old list-of-lists layout and DocumentColumns.
+
+Usage: python benchmarks/bench_patient_memory.py [--sizes 1000 10000 100000]
+
+Both layouts also hold a FAISS IndexFlatL2 with the same float32 vectors;
+that cost is reported separately since tracemalloc can't see FAISS's C++
+allocations. The old layout needs ~2.5 GB at 100k documents, so sizes above
+--max-legacy are extrapolated linearly from the largest measured size.
+"""
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_columns import DocumentColumns  # noqa: E402
+
+DIMENSION = 768
+
+
+def synthetic_records(n):
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "text": f"Blood pressure 12{i % 10}/8{i % 7}, slept {6 + i % 3}h, knee pain {i % 5}/10.",
+            "timestamp": (start + timedelta(minutes=i)).isoformat(),
+        }
+        for i in range(n)
+    ]
+
+
+def measure(build):
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    keep = build()
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    del keep
+    return used
+
+
+# Both layouts are built from the stored JSON so each owns its strings
+def legacy_layout(payload, embeddings):
+    def build():
+        documents = json.loads(payload)
+        vectors = [row.tolist() for row in embeddings]
+        return documents, vectors
+    return build
+
+
+def columnar_layout(payload):
+    def build():
+        documents = DocumentColumns()
+        documents.extend(json.loads(payload))
+        return documents
+    return build
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--max-legacy", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    legacy_per_doc = None
+    print(f"{'docs':>8} {'faiss MB':>10} {'legacy MB':>12} {'columnar MB':>12} {'saved':>7}")
+    for n in args.sizes:
+        payload = json.dumps(synthetic_records(n))
+        index_bytes = n * DIMENSION * 4
+        if n <= args.max_legacy:
+            embeddings = rng.standard_normal((n, DIMENSION), dtype=np.float32)
+            legacy = measure(legacy_layout(payload, embeddings))
+            legacy_per_doc = legacy / n
+            del embeddings
+            legacy_label = f"{legacy / 2**20:12.1f}"
+        else:
+            legacy = legacy_per_doc * n
+            legacy_label = f"{legacy / 2**20:11.1f}*"
+        columnar = measure(columnar_layout(payload))
+        saved = 1 - (index_bytes + columnar) / (index_bytes + legacy)
+        print(
+            f"{n:>8} {index_bytes / 2**20:10.1f} {legacy_label} "
+            f"{columnar / 2**20:12.1f} {saved:7.1%}"
+        )
+    print("* extrapolated; 'saved' includes the shared FAISS index in both totals")
+
+
+if __name__ == "__main__":
+    main()
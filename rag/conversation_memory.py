@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+# Headers and separators assemble_prompt adds around the sections
+SECTION_TOKENS = 16
+
+
+def estimate_tokens(text):
+    # Gemini averages roughly four characters per token for English text
+    return (len(text) + 3) // 4 if text else 0
+
+
+def trim_to_tokens(text, tokens):
+    """Keep the end of ``text`` so it fits in ``tokens``; the newest context matters most."""
+    if estimate_tokens(text) <= tokens:
+        return text
+    return text[-tokens * 4:] if tokens > 0 else ""
+
+
+def format_turn(query, response):
+    return f"Patient: {query}\nAssistant: {response}"
+
+
+def assemble_prompt(query, documents, budget, context="", turns=()):
+    """Build the RAG prompt within ``budget`` tokens.
+
+    The question is always kept. Retrieved documents come next, in rank
+    order, then ``context`` (a summary or a client-supplied transcript,
+    trimmed from the front), then as many of ``turns`` as still fit, newest
+    first. Returns ``(prompt, prompt_tokens, dropped_tokens)``.
+    """
+    remaining = budget - estimate_tokens(query) - SECTION_TOKENS
+    dropped = 0
+
+    kept_documents = []
+    for document in documents:
+        tokens = estimate_tokens(document)
+        if tokens <= remaining:
+            kept_documents.append(document)
+            remaining -= tokens
+        else:
+            dropped += tokens
+
+    kept_context = trim_to_tokens(context, max(0, remaining))
+    remaining -= estimate_tokens(kept_context)
+    dropped += estimate_tokens(context) - estimate_tokens(kept_context)
+
+    kept_turns = []
+    for turn in reversed(turns):
+        tokens = estimate_tokens(turn)
+        if tokens > remaining:
+            dropped += sum(estimate_tokens(t) for t in turns[:len(turns) - len(kept_turns)])
+            break
+        kept_turns.append(turn)
+        remaining -= tokens
+    kept_turns.reverse()
+
+    if not kept_documents and not kept_context and not kept_turns:
+        return query, estimate_tokens(query), dropped
+
+    sections = []
+    if kept_context:
+        sections.append(kept_context)
+    if kept_turns:
+        sections.append("Recent conversation:\n" + "\n".join(kept_turns))
+    conversation = "\n\n".join(sections)
+    if kept_documents:
+        prompt = (
+            f"{conversation}\nRelevant Information:\n"
+            + "\n".join(kept_documents)
+            + f"\n\nQuestion:\n{query}"
+        )
+    else:
+        prompt = f"{conversation}\n\nQuestion:\n{query}"
+    return prompt, estimate_tokens(prompt), dropped
+
+
+class Session:
+    """Turns and running summary of one patient's conversation."""
+
+    def __init__(self, window):
+        self.lock = threading.Lock()
+        self.summary = ""
+        self.window = deque(maxlen=window)
+        self.unsummarized = []  # turns that left the window but are not in the summary yet
+        self.summarizing = False
+        self.turns = 0
+        self.last_access = time.monotonic()
+
+
+class ConversationMemory:
+    """Server-side conversation memory keyed by (patient_id, session_id).
+
+    Each session keeps its last ``window`` turns verbatim. Turns that slide
+    out of the window are folded into a running summary by
+    ``summarizer(summary, turns)`` on a background thread once
+    ``summary_every`` of them have accumulated; until then they are still
+    offered to the prompt as older turns. Sessions are kept in LRU order,
+    bounded by ``max_sessions`` and dropped after ``idle_ttl`` seconds
+    without a turn. Memory is per process, like the resident patient cache.
+    """
+
+    def __init__(self, summarizer=None, window=6, summary_every=4, max_sessions=10000,
+                 idle_ttl=3600):
+        self._summarizer = summarizer
+        self.window = window
+        self.summary_every = summary_every
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-summary")
+
+    def _session(self, patient_id, session_id, create):
+        key = (patient_id, session_id)
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and self.idle_ttl > 0 and now - session.last_access > self.idle_ttl:
+                del self._sessions[key]
+                metrics.incr("memory.sessions_expired")
+                session = None
+            if session is None:
+                if not create:
+                    return None
+                session = self._sessions[key] = Session(self.window)
+            self._sessions.move_to_end(key)
+            session.last_access = now
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                metrics.incr("memory.sessions_evicted")
+            return session
+
+    def context(self, patient_id, session_id):
+        """Return ``(summary, turns)`` for the prompt, oldest turn first."""
+        session = self._session(patient_id, session_id, create=False)
+        if session is None:
+            return "", []
+        with session.lock:
+            turns = session.unsummarized + list(session.window)
+            summary = session.summary
+        return (f"Conversation summary:\n{summary}" if summary else ""), turns
+
+    def record(self, patient_id, session_id, query, response):
+        """Append a finished turn, scheduling a summary refresh when one is due."""
+        session = self._session(patient_id, session_id, create=True)
+        with session.lock:
+            if len(session.window) == session.window.maxlen:
+                session.unsummarized.append(session.window[0])
+            session.window.append(format_turn(query, response))
+            session.turns += 1
+            # Without summaries, keep only as many old turns as one refresh would fold in
+            if self._summarizer is None:
+                del session.unsummarized[:-self.summary_every]
+            due = (
+                self._summarizer is not None
+                and not session.summarizing
+                and len(session.unsummarized) >= self.summary_every
+            )
+            if due:
+                session.summarizing = True
+        if due:
+            self._executor.submit(self._refresh_summary, session)
+
+    def _refresh_summary(self, session):
+        with session.lock:
+            summary = session.summary
+            turns = list(session.unsummarized)
+        try:
+            with metrics.timer("memory.summarize"):
+                new_summary = self._summarizer(summary, turns)
+        except Exception as e:
+            metrics.incr("memory.summarize_errors")
+            logging.error(f"Conversation summary refresh failed: {e}")
+            with session.lock:
+                session.summarizing = False
+                # Keep the backlog bounded while the summarizer is failing
+                del session.unsummarized[:-4 * self.summary_every]
+            return
+        with session.lock:
+            session.summary = new_summary or summary
+            del session.unsummarized[:len(turns)]
+            session.summarizing = False
+        metrics.incr("memory.summaries")
+
+    def clear(self, patient_id, session_id):
+        with self._lock:
+            return self._sessions.pop((patient_id, session_id), None) is not None
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "max_sessions": self.max_sessions,
+            "window_turns": self.window,
+            "summarized_sessions": sum(1 for s in sessions if s.summary),
+        }
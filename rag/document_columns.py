@@ -0,0 +1,144 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Rough CPython cost of a str object on top of its characters
+_STR_OVERHEAD = 49
+
+
+class GrowableArray:
+    """Preallocated NumPy buffer that doubles its capacity as rows are appended."""
+
+    def __init__(self, dtype, capacity=16):
+        self._data = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, size):
+        capacity = len(self._data)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        grown = np.empty(capacity, dtype=self._data.dtype)
+        grown[:self._size] = self._data[:self._size]
+        self._data = grown
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self._data.dtype)
+        self._reserve(self._size + len(rows))
+        self._data[self._size:self._size + len(rows)] = rows
+        self._size += len(rows)
+
+    def view(self):
+        """Return the filled rows without copying."""
+        return self._data[:self._size]
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+
+def to_datetime64(timestamps):
+    """Convert ISO timestamp strings to a datetime64[us] array of naive UTC times."""
+    values = []
+    for timestamp in timestamps:
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        if isinstance(timestamp, datetime) and timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        values.append(timestamp)
+    return np.array(values, dtype="datetime64[us]")
+
+
+class DocumentColumns:
+    """Columnar patient documents: a list of texts and a datetime64 timestamp column.
+
+    Row ``i`` lines up with vector ``i`` in the patient's FAISS index. A
+    running pointer to the newest row and a time-ordered permutation of rows
+    make "latest N" and "between t1 and t2" lookups avoid a full scan.
+    """
+
+    def __init__(self):
+        self.texts = []
+        self.timestamps = GrowableArray("datetime64[us]")
+        self._text_bytes = 0
+        self._latest = -1
+        # Rows sorted by timestamp, and their timestamps, for range lookups.
+        # Appends in time order extend them; anything else forces a lazy rebuild.
+        self._order = GrowableArray(np.int64)
+        self._sorted_timestamps = GrowableArray("datetime64[us]")
+        self._order_valid = True
+
+    def __len__(self):
+        return len(self.texts)
+
+    def extend(self, records):
+        """Append ``{"text", "timestamp"}`` records as stored in GCS segments."""
+        if not records:
+            return
+        texts = [record["text"] for record in records]
+        new_timestamps = to_datetime64(record["timestamp"] for record in records)
+        first_row = len(self.texts)
+
+        # Ties keep the earliest row, matching max() over the old document list
+        candidate = int(np.argmax(new_timestamps))
+        if self._latest < 0 or new_timestamps[candidate] > self.timestamps.view()[self._latest]:
+            self._latest = first_row + candidate
+
+        self.timestamps.extend(new_timestamps)
+        self.texts.extend(texts)
+        self._text_bytes += sum(len(text) + _STR_OVERHEAD for text in texts)
+
+        if self._order_valid:
+            sorted_timestamps = self._sorted_timestamps.view()
+            in_order = bool(np.all(new_timestamps[1:] >= new_timestamps[:-1])) and (
+                not len(sorted_timestamps) or new_timestamps[0] >= sorted_timestamps[-1]
+            )
+            if in_order:
+                self._order.extend(np.arange(first_row, first_row + len(texts)))
+                self._sorted_timestamps.extend(new_timestamps)
+            else:
+                self._order_valid = False
+
+    def _sorted_rows(self):
+        if not self._order_valid:
+            timestamps = self.timestamps.view()
+            rows = np.argsort(timestamps, kind="stable")
+            capacity = max(16, len(rows))
+            self._order = GrowableArray(np.int64, capacity=capacity)
+            self._order.extend(rows)
+            self._sorted_timestamps = GrowableArray("datetime64[us]", capacity=capacity)
+            self._sorted_timestamps.extend(timestamps[rows])
+            self._order_valid = True
+        return self._order.view()
+
+    def record(self, i):
+        return {"text": self.texts[i], "timestamp": self.timestamps.view()[i].item().isoformat()}
+
+    def latest(self):
+        """Return the newest record, or None if there are no documents."""
+        return self.record(self._latest) if self._latest >= 0 else None
+
+    def latest_n(self, n):
+        """Return up to ``n`` records, newest first."""
+        rows = self._sorted_rows()
+        return [self.record(int(i)) for i in rows[::-1][:n]]
+
+    def between(self, start=None, end=None):
+        """Return records with ``start <= timestamp <= end`` in time order."""
+        rows = self._sorted_rows()
+        ordered = self._sorted_timestamps.view()
+        lo = 0 if start is None else np.searchsorted(ordered, to_datetime64([start])[0], "left")
+        hi = len(rows) if end is None else np.searchsorted(ordered, to_datetime64([end])[0], "right")
+        return [self.record(int(i)) for i in rows[lo:hi]]
+
+    @property
+    def nbytes(self):
+        # 8 bytes per list slot plus the str objects themselves
+        return (
+            self.timestamps.nbytes + self._order.nbytes + self._sorted_timestamps.nbytes
+            + 8 * len(self.texts) + self._text_bytes
+        )
@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Normalize text so trivially different submissions share a cache key."""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class DiskEmbeddingStore:
+    """Fixed-capacity on-disk embedding tier that survives restarts.
+
+    Vectors live in a memory-mapped file of float32 rows and keys in an
+    append-only ``key row`` index file. Rows are reused in ring order once the
+    file is full; the newest index line for a row wins when reloading.
+    """
+
+    def __init__(self, directory, dimension, capacity):
+        os.makedirs(directory, exist_ok=True)
+        self.dimension = dimension
+        self.capacity = capacity
+        self._vectors_path = os.path.join(directory, "embeddings.f32")
+        self._index_path = os.path.join(directory, "index.txt")
+
+        mode = "r+" if os.path.exists(self._vectors_path) else "w+"
+        self._vectors = np.memmap(
+            self._vectors_path, dtype=np.float32, mode=mode, shape=(capacity, dimension)
+        )
+        self._rows = {}
+        self._row_keys = {}
+        self._next_row = 0
+        self._load_index()
+        self._index_file = open(self._index_path, "a", encoding="utf-8")
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path):
+            return
+        lines = 0
+        with open(self._index_path, encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 2:
+                    continue
+                key, row = parts[0], int(parts[1])
+                if row >= self.capacity:
+                    continue
+                self._assign(key, row)
+                self._next_row = (row + 1) % self.capacity
+                lines += 1
+        # Rewrite the index once it carries mostly superseded entries
+        if lines > 2 * self.capacity:
+            with open(self._index_path, "w", encoding="utf-8") as f:
+                for key, row in self._rows.items():
+                    f.write(f"{key} {row}\n")
+
+    def _assign(self, key, row):
+        previous = self._row_keys.get(row)
+        if previous is not None:
+            self._rows.pop(previous, None)
+        self._rows[key] = row
+        self._row_keys[row] = key
+        return previous is not None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, key):
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        return np.array(self._vectors[row])
+
+    def put(self, key, vector):
+        """Store ``vector`` under ``key``; returns True if an old row was evicted."""
+        if key in self._rows:
+            return False
+        row = self._next_row
+        self._next_row = (row + 1) % self.capacity
+        self._vectors[row] = vector
+        evicted = self._assign(key, row)
+        self._index_file.write(f"{key} {row}\n")
+        self._index_file.flush()
+        return evicted
+
+    def flush(self):
+        self._vectors.flush()
+        self._index_file.flush()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache with an LRU memory tier.
+
+    Keys are a SHA-256 of the model endpoint and the normalized text, so a
+    change of embedding model never serves stale vectors. An optional
+    ``DiskEmbeddingStore`` backs the memory tier across restarts.
+    """
+
+    def __init__(self, namespace, dimension, max_entries=10000, disk_dir=None, disk_capacity=100000):
+        self.namespace = namespace
+        self.dimension = dimension
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        if disk_dir:
+            try:
+                self._disk = DiskEmbeddingStore(disk_dir, dimension, disk_capacity)
+            except Exception as e:
+                logging.error(f"Disabling on-disk embedding cache at {disk_dir}: {e}")
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "disk_evictions": 0,
+        }
+
+    def key(self, text):
+        payload = f"{self.namespace}\0{normalize_text(text)}".encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def _remember(self, key, vector):
+        # Caller must hold self._lock
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get(self, text):
+        """Return the cached embedding for ``text`` or None."""
+        key = self.key(text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return vector
+            if self._disk is not None:
+                vector = self._disk.get(key)
+                if vector is not None:
+                    self._remember(key, vector)
+                    self._stats["disk_hits"] += 1
+                    return vector
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, text, vector):
+        key = self.key(text)
+        vector = np.array(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if self._disk is not None and self._disk.put(key, vector):
+                self._stats["disk_evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_entries"] = len(self._disk) if self._disk is not None else 0
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((lookups - stats["misses"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def flush(self):
+        with self._lock:
+            if self._disk is not None:
+                self._disk.flush()
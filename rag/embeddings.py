@@ -0,0 +1,128 @@
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import numpy as np
+from google.cloud import aiplatform
+from google.protobuf.json_format import MessageToDict
+
+from metrics import metrics
+
+
+class PredictionClientPool:
+    """Round-robin pool of long-lived Vertex AI prediction clients.
+
+    Clients are created lazily on first use and then reused for the life of the
+    worker, so requests share warm gRPC channels instead of opening new ones.
+    """
+
+    def __init__(self, credentials, api_endpoint, size=2):
+        self._credentials = credentials
+        self._api_endpoint = api_endpoint
+        self._size = max(1, size)
+        self._clients = []
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def _create_client(self):
+        start = time.perf_counter()
+        client = aiplatform.gapic.PredictionServiceClient(
+            client_options={"api_endpoint": self._api_endpoint},
+            credentials=self._credentials,
+        )
+        metrics.observe("embeddings.client_setup", time.perf_counter() - start)
+        return client
+
+    def get(self):
+        """Return the next client in the pool, creating it on first use."""
+        slot = next(self._counter) % self._size
+        if slot < len(self._clients):
+            return self._clients[slot]
+        with self._lock:
+            while len(self._clients) <= slot:
+                self._clients.append(self._create_client())
+            return self._clients[slot]
+
+
+def parse_embedding_predictions(response, dimension):
+    """Convert a predict response into an (n, dimension) float32 matrix."""
+    predictions = MessageToDict(response._pb).get("predictions")
+    if not predictions:
+        raise ValueError("No predictions found in response.")
+
+    rows = []
+    for prediction in predictions:
+        embeddings = prediction.get("embeddings")
+        if embeddings is None:
+            raise ValueError("Embeddings not found in response.")
+        # Handle nested 'values' structure
+        if isinstance(embeddings, dict) and "values" in embeddings:
+            rows.append(embeddings["values"])
+        elif isinstance(embeddings, list):
+            rows.append(embeddings)
+        else:
+            raise ValueError(f"Unexpected embeddings format: {embeddings}")
+
+    matrix = np.asarray(rows, dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[1] != dimension:
+        raise ValueError(f"Unexpected embeddings shape: {matrix.shape}")
+    return matrix
+
+
+def predict_embeddings(pool, endpoint, texts, dimension, batch_size):
+    """Embed ``texts`` with as few predict calls as the per-request limit allows."""
+    if not texts:
+        return np.empty((0, dimension), dtype=np.float32)
+
+    matrices = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        instances = [{"content": text} for text in batch]
+        call_start = time.perf_counter()
+        response = pool.get().predict(endpoint=endpoint, instances=instances)
+        metrics.observe("embeddings.predict", time.perf_counter() - call_start)
+        metrics.incr("embeddings.predict_calls")
+        metrics.incr("embeddings.texts", len(batch))
+        matrices.append(parse_embedding_predictions(response, dimension))
+
+    logging.debug(f"Embedded {len(texts)} texts in {len(matrices)} predict calls.")
+    return np.vstack(matrices)
+
+
+class DeadlineEmbedder:
+    """Embeds queries within a deadline and stops trying for a while after failures.
+
+    ``__call__`` returns ``embed(text)``, or None if it raised or took longer
+    than ``timeout`` seconds; a late call keeps running in the background so
+    its result can still land in the embedding cache. After a failure, calls
+    return None immediately for ``cooldown`` seconds so a slow or unavailable
+    service costs one timeout rather than one per query.
+    """
+
+    def __init__(self, embed, timeout=1.5, cooldown=30, max_workers=4):
+        self._embed = embed
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query-embed")
+        self._skip_until = 0.0
+
+    def available(self):
+        return time.monotonic() >= self._skip_until
+
+    def __call__(self, text):
+        if not self.available():
+            metrics.incr("embeddings.query_skipped")
+            return None
+        future = self._executor.submit(self._embed, text)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            metrics.incr("embeddings.query_timeouts")
+            logging.warning(f"Query embedding took over {self.timeout}s, skipping embeddings for {self.cooldown}s.")
+        except Exception as e:
+            metrics.incr("embeddings.query_errors")
+            logging.error(f"Query embedding failed, skipping embeddings for {self.cooldown}s: {e}")
+        self._skip_until = time.monotonic() + self.cooldown
+        return None
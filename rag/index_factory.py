@@ -0,0 +1,150 @@
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from metrics import metrics
+
+FLAT = "flat"
+IVF = "ivf"
+HNSW = "hnsw"
+
+HNSW_NEIGHBORS = 32
+
+
+def index_kind(index):
+    if isinstance(index, faiss.IndexHNSW):
+        return HNSW
+    if isinstance(index, faiss.IndexIVF):
+        return IVF
+    return FLAT
+
+
+def configure_search(index, nprobe=None, ef_search=64):
+    """Apply query-time parameters, which trade a little recall for speed."""
+    kind = index_kind(index)
+    if kind == IVF:
+        index.nprobe = nprobe or max(1, index.nlist // 8)
+    elif kind == HNSW:
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def create_index(kind, dimension, vectors=None):
+    """Build an L2 index of ``kind``, training and filling it with ``vectors``.
+
+    IVF uses roughly sqrt(n) lists and keeps a direct map so vectors can still
+    be reconstructed, as they can from Flat and HNSW.
+    """
+    if kind == FLAT:
+        index = faiss.IndexFlatL2(dimension)
+    elif kind == IVF:
+        if vectors is None or len(vectors) == 0:
+            raise ValueError("IVF indexes need training vectors.")
+        nlist = min(4096, max(16, int(math.sqrt(len(vectors)))))
+        index = faiss.index_factory(dimension, f"IVF{nlist},Flat", faiss.METRIC_L2)
+        index.train(vectors)
+        index.make_direct_map()
+    elif kind == HNSW:
+        index = faiss.index_factory(dimension, f"HNSW{HNSW_NEIGHBORS},Flat", faiss.METRIC_L2)
+    else:
+        raise ValueError(f"Unknown index kind: {kind}")
+
+    if vectors is not None and len(vectors):
+        index.add(vectors)
+    return configure_search(index)
+
+
+def index_bytes(index):
+    """Approximate resident bytes of a Flat, IVF-Flat or HNSW-Flat index."""
+    vector_bytes = index.ntotal * index.d * 4
+    kind = index_kind(index)
+    if kind == IVF:
+        # Inverted-list ids, the direct map and the coarse centroids
+        return vector_bytes + index.ntotal * 16 + index.nlist * index.d * 4
+    if kind == HNSW:
+        # Level-0 links dominate: 2 * M neighbours of 4 bytes each
+        return vector_bytes + index.ntotal * HNSW_NEIGHBORS * 2 * 4
+    return vector_bytes
+
+
+def serialize_index(index):
+    return faiss.serialize_index(index).tobytes()
+
+
+def deserialize_index(data):
+    return configure_search(faiss.deserialize_index(np.frombuffer(data, dtype=np.uint8)))
+
+
+class IndexPromoter:
+    """Moves patients from a brute-force Flat index to an ANN index in the background.
+
+    Once a patient's Flat index reaches ``threshold`` vectors, a worker thread
+    snapshots the vectors, builds the ``kind`` index outside the patient lock
+    and swaps it in, catching up on rows added while it was training.
+    ``on_promoted(patient_id, kind, ntotal, data)`` receives the serialized
+    index so it can be persisted.
+    """
+
+    def __init__(self, kind, threshold, dimension, on_promoted=None):
+        self.kind = kind
+        self.threshold = threshold
+        self.dimension = dimension
+        self._on_promoted = on_promoted
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-trainer")
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def maybe_promote(self, entry):
+        """Schedule promotion for ``entry``; the caller holds ``entry.lock``."""
+        if self.kind == FLAT or self.threshold <= 0:
+            return
+        index = entry.data["text_index"]
+        if index_kind(index) != FLAT or index.ntotal < self.threshold:
+            return
+        with self._lock:
+            if entry.patient_id in self._pending:
+                return
+            self._pending.add(entry.patient_id)
+        self._executor.submit(self._promote, entry, index)
+
+    def _promote(self, entry, flat_index):
+        start = time.perf_counter()
+        try:
+            with entry.lock:
+                if entry.data is None or entry.data["text_index"] is not flat_index:
+                    return
+                snapshot_size = flat_index.ntotal
+                vectors = flat_index.reconstruct_n(0, snapshot_size)
+
+            promoted = create_index(self.kind, self.dimension, vectors)
+
+            with entry.lock:
+                if entry.data is None or entry.data["text_index"] is not flat_index:
+                    return  # evicted or replaced while training
+                if flat_index.ntotal > snapshot_size:
+                    promoted.add(
+                        flat_index.reconstruct_n(snapshot_size, flat_index.ntotal - snapshot_size)
+                    )
+                entry.data["text_index"] = promoted
+                data = serialize_index(promoted) if self._on_promoted else None
+                ntotal = promoted.ntotal
+
+            metrics.incr(f"index.promotions_{self.kind}")
+            metrics.observe("index.promote", time.perf_counter() - start)
+            logging.info(
+                f"Promoted patient {entry.patient_id} to a {self.kind} index "
+                f"with {ntotal} vectors."
+            )
+            if self._on_promoted:
+                self._on_promoted(entry.patient_id, self.kind, ntotal, data)
+        except Exception as e:
+            metrics.incr("index.promotion_errors")
+            logging.error(f"Index promotion failed for patient {entry.patient_id}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(entry.patient_id)
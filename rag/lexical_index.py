@@ -0,0 +1,100 @@
+import math
+import re
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from document_columns import GrowableArray
+
+# Terms with a decimal point stay whole so lab values like "6.5" match exactly
+_TOKEN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by did do does for from had has have how i in is it its "
+    "me my of on or she so that the their them there they this to was we were what when "
+    "which who why will with you your".split()
+)
+
+
+def tokenize(text):
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Append-only BM25 inverted index whose rows line up with the FAISS index.
+
+    Each term maps to parallel ``array`` postings of row ids and term
+    frequencies, so adding a document only appends to the postings of its
+    own terms. Scoring accumulates into a dense float32 array over all rows,
+    which stays cheap for per-patient corpora.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}  # term -> (rows array, term frequency array)
+        self._lengths = GrowableArray(np.float32)
+        self._total_length = 0
+        self._posting_count = 0
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, texts):
+        """Index ``texts`` as the next rows, in the order they were added to FAISS."""
+        row = len(self._lengths)
+        lengths = []
+        for text in texts:
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = (array("I"), array("H"))
+                postings[0].append(row)
+                postings[1].append(min(tf, 0xFFFF))
+            self._posting_count += len(counts)
+            length = sum(counts.values())
+            lengths.append(length)
+            self._total_length += length
+            row += 1
+        self._lengths.extend(lengths)
+
+    def search(self, query, k):
+        """Return up to ``k`` ``(row, score)`` pairs, best first; rows without a match are omitted."""
+        n = len(self._lengths)
+        terms = [term for term in set(tokenize(query)) if term in self._postings]
+        if not n or not terms or k <= 0:
+            return []
+
+        lengths = self._lengths.view()
+        norm = self.k1 * (1 - self.b + self.b * lengths / (self._total_length / n))
+        scores = np.zeros(n, dtype=np.float32)
+        for term in terms:
+            rows, tfs = self._postings[term]
+            rows = np.frombuffer(rows, dtype=np.uint32)
+            tfs = np.frombuffer(tfs, dtype=np.uint16).astype(np.float32)
+            df = len(rows)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            # Each row appears at most once per term, so plain fancy-index += is safe
+            scores[rows] += idf * tfs * (self.k1 + 1) / (tfs + norm[rows])
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(scores[matched], -k)[-k:]]
+        matched = matched[np.argsort(scores[matched], kind="stable")[::-1]]
+        return [(int(row), float(scores[row])) for row in matched]
+
+    @property
+    def nbytes(self):
+        # Postings arrays plus a rough dict/tuple/str cost per distinct term
+        return self._posting_count * 6 + len(self._postings) * 200 + self._lengths.nbytes
+
+
+def reciprocal_rank_fusion(rankings, limit, k=60):
+    """Fuse ranked lists of row ids by summing ``1 / (k + rank)``; return the best ``limit`` rows."""
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda row: (-scores[row], row))[:limit]
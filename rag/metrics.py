@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Thread-safe in-process counters and latency samples."""
+
+    def __init__(self, max_samples=2048):
+        self._lock = threading.Lock()
+        self._max_samples = max_samples
+        self._counters = defaultdict(int)
+        self._timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = {
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "samples": deque(maxlen=self._max_samples),
+                }
+                self._timings[name] = timing
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+            timing["samples"].append(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return counters and p50/p99 summaries of the recent timing samples."""
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {}
+            for name, timing in self._timings.items():
+                samples = sorted(timing["samples"])
+                timings[name] = {
+                    "count": timing["count"],
+                    "avg_ms": round(timing["total"] / timing["count"] * 1000, 3),
+                    "p50_ms": round(_percentile(samples, 50) * 1000, 3),
+                    "p99_ms": round(_percentile(samples, 99) * 1000, 3),
+                    "max_ms": round(timing["max"] * 1000, 3),
+                }
+        return {"counters": counters, "timings": timings}
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[index]
+
+
+# Process-wide metrics shared by the app and its helpers
+metrics = Metrics()
@@ -0,0 +1,284 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from metrics import metrics
+
+# Patient residency lifecycle
+UNLOADED = "unloaded"
+LOADING = "loading"
+RESIDENT = "resident"
+DIRTY = "dirty"
+FLUSHING = "flushing"
+
+
+class PatientEntry:
+    """In-memory state of one patient plus the lock that guards it.
+
+    ``lock`` must be held while reading or mutating ``data``; ``pending`` holds
+    rows that were added in memory but not yet persisted. ``pins`` counts the
+    callers currently using the entry, which makes it ineligible for eviction.
+    """
+
+    def __init__(self, patient_id):
+        self.patient_id = patient_id
+        self.state = UNLOADED
+        self.data = None
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+        self.pending = []
+        self.pins = 0
+        self.size_bytes = 0
+        self.last_access = time.monotonic()
+
+
+class PatientStore:
+    """Bounded registry of patient entries that loads and flushes each patient once.
+
+    ``loader(patient_id)`` returns the patient's data structure,
+    ``flusher(patient_id, embeddings, documents)`` persists newly added rows and
+    ``sizer(data)`` estimates an entry's resident bytes. Concurrent callers
+    share a single in-flight load, and rows added while a flush is running are
+    picked up by the next flush.
+
+    Resident patients are kept in LRU order. Once ``max_bytes`` is exceeded, or
+    a patient has been idle for ``idle_ttl`` seconds, unpinned entries are
+    flushed if dirty and then dropped back to the unloaded state.
+    """
+
+    def __init__(self, loader, flusher, sizer, max_bytes=0, idle_ttl=0, sweep_interval=60):
+        self._loader = loader
+        self._flusher = flusher
+        self._sizer = sizer
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._bytes = 0
+        self._evictions = {"lru": 0, "ttl": 0}
+
+        if idle_ttl > 0:
+            self._sweeper = threading.Thread(
+                target=self._sweep_forever,
+                args=(min(sweep_interval, idle_ttl),),
+                name="patient-sweeper",
+                daemon=True,
+            )
+            self._sweeper.start()
+
+    def add_listener(self, listener):
+        """Register ``listener(event, patient_id, seconds)`` for load/flush/evict events."""
+        self._listeners.append(listener)
+
+    def _emit(self, event, patient_id, seconds):
+        metrics.incr(f"patients.{event}")
+        metrics.observe(f"patients.{event}", seconds)
+        for listener in self._listeners:
+            try:
+                listener(event, patient_id, seconds)
+            except Exception as e:
+                logging.error(f"Patient store listener failed on {event}: {e}")
+
+    def _entry(self, patient_id, pin=False):
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is None:
+                entry = PatientEntry(patient_id)
+                self._entries[patient_id] = entry
+            self._entries.move_to_end(patient_id)
+            entry.last_access = time.monotonic()
+            if pin:
+                entry.pins += 1
+            return entry
+
+    def state(self, patient_id):
+        entry = self._entries.get(patient_id)
+        return entry.state if entry is not None else UNLOADED
+
+    def _load(self, entry):
+        """Bring ``entry`` to a resident state, sharing any in-flight load."""
+        with entry.condition:
+            while entry.state == LOADING:
+                entry.condition.wait()
+            if entry.state != UNLOADED:
+                return
+            entry.state = LOADING
+
+        start = time.perf_counter()
+        try:
+            data = self._loader(entry.patient_id)
+        except Exception:
+            with entry.condition:
+                entry.state = UNLOADED
+                entry.condition.notify_all()
+            raise
+
+        with entry.condition:
+            entry.data = data
+            entry.state = RESIDENT
+            self._resize(entry)
+            entry.condition.notify_all()
+        self._emit("load", entry.patient_id, time.perf_counter() - start)
+
+    @contextmanager
+    def use(self, patient_id):
+        """Pin the patient's entry, loading it if needed, for the duration of the block."""
+        entry = self._entry(patient_id, pin=True)
+        try:
+            self._load(entry)
+            yield entry
+        finally:
+            with self._lock:
+                entry.pins -= 1
+                entry.last_access = time.monotonic()
+            self._enforce_budget()
+
+    @contextmanager
+    def peek(self, patient_id):
+        """Pin and yield the patient's entry only if it is already resident, else None."""
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is None or entry.state in (UNLOADED, LOADING):
+                entry = None
+            else:
+                entry.pins += 1
+                entry.last_access = time.monotonic()
+                self._entries.move_to_end(patient_id)
+        try:
+            yield entry
+        finally:
+            if entry is not None:
+                with self._lock:
+                    entry.pins -= 1
+
+    def _resize(self, entry):
+        # Caller must hold entry.lock
+        size = self._sizer(entry.data) if entry.data is not None else 0
+        with self._lock:
+            if self._entries.get(entry.patient_id) is entry:
+                self._bytes += size - entry.size_bytes
+            entry.size_bytes = size
+
+    def mark_dirty(self, entry, embeddings, documents):
+        """Record rows added to ``entry.data``; the caller holds ``entry.lock``."""
+        entry.pending.append((embeddings, documents))
+        if entry.state == RESIDENT:
+            entry.state = DIRTY
+        self._resize(entry)
+
+    def flush(self, patient_id):
+        """Persist pending rows for ``patient_id``; a no-op if nothing is dirty."""
+        with self._lock:
+            entry = self._entries.get(patient_id)
+        if entry is None:
+            return
+        with entry.condition:
+            while entry.state == FLUSHING:
+                entry.condition.wait()
+            if entry.state != DIRTY:
+                return
+            pending, entry.pending = entry.pending, []
+            entry.state = FLUSHING
+
+        start = time.perf_counter()
+        embeddings = np.vstack([rows for rows, _ in pending])
+        documents = [doc for _, docs in pending for doc in docs]
+        try:
+            self._flusher(patient_id, embeddings, documents)
+        except Exception:
+            with entry.condition:
+                entry.pending = pending + entry.pending
+                entry.state = DIRTY
+                entry.condition.notify_all()
+            metrics.incr("patients.flush_errors")
+            raise
+
+        with entry.condition:
+            entry.state = DIRTY if entry.pending else RESIDENT
+            entry.condition.notify_all()
+        self._emit("flush", patient_id, time.perf_counter() - start)
+
+    # Eviction ----------------------------------------------------------
+
+    def _evict(self, entry, reason):
+        """Flush ``entry`` if dirty and drop its data; False if it is in use."""
+        start = time.perf_counter()
+        if entry.state == DIRTY:
+            try:
+                self.flush(entry.patient_id)
+            except Exception as e:
+                logging.error(f"Not evicting patient {entry.patient_id}, flush failed: {e}")
+                return False
+
+        with entry.condition:
+            if entry.state not in (RESIDENT, UNLOADED) or entry.pending:
+                return False
+            with self._lock:
+                if entry.pins or self._entries.get(entry.patient_id) is not entry:
+                    return False
+                del self._entries[entry.patient_id]
+                self._bytes -= entry.size_bytes
+                if entry.state == RESIDENT:
+                    self._evictions[reason] += 1
+            entry.state = UNLOADED
+            entry.data = None
+            entry.size_bytes = 0
+        self._emit(f"evict_{reason}", entry.patient_id, time.perf_counter() - start)
+        return True
+
+    def _enforce_budget(self):
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            if self._bytes <= self.max_bytes:
+                return
+            candidates = [e for e in self._entries.values() if not e.pins]
+        for entry in candidates:  # least recently used first
+            if self._bytes <= self.max_bytes:
+                break
+            self._evict(entry, "lru")
+
+    def evict_idle(self):
+        """Evict every unpinned patient idle for longer than ``idle_ttl``."""
+        cutoff = time.monotonic() - self.idle_ttl
+        with self._lock:
+            idle = [
+                e for e in self._entries.values()
+                if not e.pins and e.last_access < cutoff
+            ]
+        return sum(1 for entry in idle if self._evict(entry, "ttl"))
+
+    def _sweep_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logging.error(f"Idle patient sweep failed: {e}")
+
+    def stats(self):
+        """Summarize resident patients, bytes and eviction counts."""
+        now = time.monotonic()
+        with self._lock:
+            patients = [
+                {
+                    "patient_id": entry.patient_id,
+                    "state": entry.state,
+                    "bytes": entry.size_bytes,
+                    "idle_seconds": round(now - entry.last_access, 1),
+                }
+                for entry in self._entries.values()
+            ]
+            return {
+                "resident_patients": sum(1 for p in patients if p["state"] != UNLOADED),
+                "resident_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "idle_ttl_seconds": self.idle_ttl,
+                "evictions": dict(self._evictions),
+                "patients": patients,
+            }
@@ -0,0 +1,352 @@
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from document_columns import to_datetime64
+from metrics import metrics
+
+MANIFEST_VERSION = 1
+
+
+class SegmentStore:
+    """Append-only GCS persistence for patient embeddings and documents.
+
+    Each insert uploads one immutable, numbered segment (raw float32 embedding
+    rows plus a JSON document list) and then swaps in a small manifest that
+    lists the segments in index order. Manifest updates use GCS generation
+    preconditions, so concurrent writers retry instead of losing segments.
+
+    The manifest also carries the newest document (``latest``) so "latest
+    record" lookups can be answered without downloading any segment.
+    """
+
+    def __init__(self, storage_client, bucket_name, dimension, max_workers=8):
+        self._storage_client = storage_client
+        self._bucket_name = bucket_name
+        self.dimension = dimension
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="segment-io"
+        )
+
+    @property
+    def _bucket(self):
+        return self._storage_client.bucket(self._bucket_name)
+
+    # Blob naming -------------------------------------------------------
+
+    @staticmethod
+    def manifest_blob_name(patient_id):
+        return f"patients/{patient_id}/manifest.json"
+
+    @staticmethod
+    def segment_blob_names(patient_id, segment_id):
+        prefix = f"patients/{patient_id}/segments/{segment_id:06d}"
+        return f"{prefix}_embeddings.npy", f"{prefix}_documents.json"
+
+    @staticmethod
+    def legacy_blob_names(patient_id):
+        return (
+            f"embeddings/{patient_id}/{patient_id}_embeddings.npy",
+            f"documents/{patient_id}/{patient_id}_documents.json",
+        )
+
+    # Manifest ----------------------------------------------------------
+
+    def read_manifest(self, patient_id):
+        """Return ``(manifest, generation)``; generation is 0 if none exists."""
+        blob = self._bucket.get_blob(self.manifest_blob_name(patient_id))
+        if blob is None:
+            return None, 0
+        try:
+            data = blob.download_as_bytes(if_generation_match=blob.generation)
+        except (NotFound, PreconditionFailed):
+            # Replaced between the metadata read and the download
+            return self.read_manifest(patient_id)
+        return json.loads(data), blob.generation
+
+    def _write_manifest(self, patient_id, manifest, generation):
+        blob = self._bucket.blob(self.manifest_blob_name(patient_id))
+        blob.upload_from_string(
+            json.dumps(manifest),
+            content_type="application/json",
+            if_generation_match=generation,
+        )
+
+    def _new_manifest(self, patient_id):
+        """Build the first manifest, adopting pre-segment blobs as segment 0."""
+        manifest = {"version": MANIFEST_VERSION, "next_segment": 1, "segments": []}
+        embeddings_name, documents_name = self.legacy_blob_names(patient_id)
+        embeddings_blob = self._bucket.get_blob(embeddings_name)
+        if embeddings_blob is not None and self._bucket.get_blob(documents_name) is not None:
+            count = embeddings_blob.size // (4 * self.dimension)
+            manifest["segments"].append({
+                "id": 0,
+                "count": count,
+                "embeddings": embeddings_name,
+                "documents": documents_name,
+            })
+        return manifest
+
+    # Writes ------------------------------------------------------------
+
+    def _upload_segment(self, patient_id, segment_id, embeddings, documents, max_probes=16):
+        """Upload a segment at the first free id at or after ``segment_id``.
+
+        The embeddings blob is created with ``if_generation_match=0`` and acts
+        as the claim on the id, so ids orphaned by an interrupted writer are
+        skipped rather than blocking every later append.
+        """
+        bucket = self._bucket
+        embeddings_bytes = np.ascontiguousarray(embeddings, dtype=np.float32).tobytes()
+        for probe in range(max_probes):
+            embeddings_name, documents_name = self.segment_blob_names(
+                patient_id, segment_id + probe
+            )
+            try:
+                bucket.blob(embeddings_name).upload_from_string(
+                    embeddings_bytes, if_generation_match=0
+                )
+            except PreconditionFailed:
+                continue
+            bucket.blob(documents_name).upload_from_string(
+                json.dumps(documents, default=str),
+                content_type="application/json",
+                if_generation_match=0,
+            )
+            return {
+                "id": segment_id + probe,
+                "count": len(documents),
+                "embeddings": embeddings_name,
+                "documents": documents_name,
+            }
+        raise RuntimeError(f"No free segment id for patient {patient_id}.")
+
+    def append_segment(self, patient_id, embeddings, documents, max_attempts=5):
+        """Persist only the new rows as a segment and return the updated manifest."""
+        if len(documents) != len(embeddings):
+            raise ValueError("Embeddings and documents must have the same length.")
+        start = time.perf_counter()
+        segment = None
+        for attempt in range(max_attempts):
+            manifest, generation = self.read_manifest(patient_id)
+            if manifest is None:
+                manifest = self._new_manifest(patient_id)
+            if segment is None:
+                # The uploaded blobs stay ours across manifest retries
+                segment = self._upload_segment(
+                    patient_id, manifest["next_segment"], embeddings, documents
+                )
+            manifest["segments"].append(segment)
+            manifest["next_segment"] = max(manifest["next_segment"], segment["id"] + 1)
+            manifest["latest"] = _newer_document(manifest.get("latest"), documents)
+            try:
+                self._write_manifest(patient_id, manifest, generation)
+            except PreconditionFailed:
+                metrics.incr("segments.append_conflicts")
+                logging.info(
+                    f"Manifest conflict for patient {patient_id}, retrying "
+                    f"(attempt {attempt + 1})."
+                )
+                continue
+            metrics.observe("segments.append", time.perf_counter() - start)
+            logging.info(
+                f"Uploaded segment {segment['id']} ({len(documents)} rows) "
+                f"for patient {patient_id}."
+            )
+            return manifest
+        raise RuntimeError(f"Could not append segment for patient {patient_id}.")
+
+    # Reads -------------------------------------------------------------
+
+    def _download_segment(self, segment):
+        bucket = self._bucket
+        embeddings_bytes = bucket.blob(segment["embeddings"]).download_as_bytes()
+        documents = json.loads(bucket.blob(segment["documents"]).download_as_bytes())
+        embeddings = np.frombuffer(embeddings_bytes, dtype=np.float32).reshape(
+            -1, self.dimension
+        )
+        return embeddings, documents
+
+    def load(self, patient_id, retries=2):
+        """Return ``(embeddings, documents, manifest)`` for a patient.
+
+        Segments are fetched in parallel and concatenated in manifest order.
+        ``manifest`` is None when the patient has no stored data.
+        """
+        start = time.perf_counter()
+        manifest, _ = self.read_manifest(patient_id)
+        if manifest is None:
+            manifest = self._new_manifest(patient_id)
+            if not manifest["segments"]:
+                return np.empty((0, self.dimension), dtype=np.float32), [], None
+
+        try:
+            parts = list(self._executor.map(self._download_segment, manifest["segments"]))
+        except NotFound:
+            if retries <= 0:
+                raise
+            # A compaction replaced the segments we were reading
+            return self.load(patient_id, retries - 1)
+        embeddings = (
+            np.vstack([part[0] for part in parts])
+            if parts
+            else np.empty((0, self.dimension), dtype=np.float32)
+        )
+        documents = [doc for part in parts for doc in part[1]]
+        if len(documents) != len(embeddings):
+            raise ValueError(
+                f"Stored data for patient {patient_id} is inconsistent: "
+                f"{len(embeddings)} embeddings, {len(documents)} documents."
+            )
+        metrics.observe("segments.load", time.perf_counter() - start)
+        metrics.incr("segments.loaded", len(parts))
+        return embeddings, documents, manifest
+
+    # Trained ANN index -------------------------------------------------
+
+    @staticmethod
+    def index_blob_name(patient_id, kind, ntotal):
+        return f"patients/{patient_id}/index/{kind}_{ntotal:09d}.faiss"
+
+    def save_index(self, patient_id, kind, ntotal, data, max_attempts=5):
+        """Upload a serialized index covering the first ``ntotal`` rows and record it."""
+        name = self.index_blob_name(patient_id, kind, ntotal)
+        self._bucket.blob(name).upload_from_string(data)
+        for _ in range(max_attempts):
+            manifest, generation = self.read_manifest(patient_id)
+            if manifest is None:
+                return False
+            previous = manifest.get("index")
+            manifest["index"] = {"kind": kind, "ntotal": ntotal, "blob": name}
+            try:
+                self._write_manifest(patient_id, manifest, generation)
+            except PreconditionFailed:
+                continue
+            if previous and previous["blob"] != name:
+                try:
+                    self._bucket.blob(previous["blob"]).delete()
+                except NotFound:
+                    pass
+            logging.info(f"Saved {kind} index ({ntotal} rows) for patient {patient_id}.")
+            return True
+        return False
+
+    def download_index(self, index_info):
+        return self._bucket.blob(index_info["blob"]).download_as_bytes()
+
+    # Compaction --------------------------------------------------------
+
+    @staticmethod
+    def small_segment_runs(manifest, small_rows):
+        """Return runs of two or more adjacent segments below ``small_rows``."""
+        runs, run = [], []
+        for segment in manifest["segments"]:
+            if segment["count"] < small_rows:
+                run.append(segment)
+                continue
+            if len(run) > 1:
+                runs.append(run)
+            run = []
+        if len(run) > 1:
+            runs.append(run)
+        return runs
+
+    def compact(self, patient_id, small_rows):
+        """Merge adjacent small segments, keeping row order intact."""
+        start = time.perf_counter()
+        manifest, generation = self.read_manifest(patient_id)
+        if manifest is None:
+            return False
+        runs = self.small_segment_runs(manifest, small_rows)
+        if not runs:
+            return False
+
+        replaced = []
+        segments = list(manifest["segments"])
+        for run in runs:
+            parts = list(self._executor.map(self._download_segment, run))
+            embeddings = np.vstack([part[0] for part in parts])
+            documents = [doc for part in parts for doc in part[1]]
+            merged = self._upload_segment(
+                patient_id, manifest["next_segment"], embeddings, documents
+            )
+            manifest["next_segment"] = merged["id"] + 1
+            position = segments.index(run[0])
+            segments[position:position + len(run)] = [merged]
+            replaced.extend(run)
+
+        manifest["segments"] = segments
+        try:
+            self._write_manifest(patient_id, manifest, generation)
+        except PreconditionFailed:
+            # A writer appended meanwhile; the merged blobs are orphaned and the
+            # next compaction pass starts again from the fresh manifest.
+            metrics.incr("segments.compaction_conflicts")
+            return False
+
+        segments_prefix = f"patients/{patient_id}/segments/"
+        for segment in replaced:
+            for name in (segment["embeddings"], segment["documents"]):
+                if not name.startswith(segments_prefix):
+                    continue  # leave pre-segment blobs in place
+                try:
+                    self._bucket.blob(name).delete()
+                except NotFound:
+                    pass
+        metrics.observe("segments.compact", time.perf_counter() - start)
+        logging.info(
+            f"Compacted {len(replaced)} segments into {len(runs)} for patient {patient_id}."
+        )
+        return True
+
+
+class SegmentCompactor:
+    """Background thread that compacts patients queued after an append."""
+
+    def __init__(self, store, small_rows=64, max_small_segments=8):
+        self.store = store
+        self.small_rows = small_rows
+        self.max_small_segments = max_small_segments
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="segment-compactor", daemon=True
+        )
+        self._thread.start()
+
+    def maybe_schedule(self, patient_id, manifest):
+        """Queue ``patient_id`` when its manifest has too many small segments."""
+        small = sum(1 for s in manifest["segments"] if s["count"] < self.small_rows)
+        if small <= self.max_small_segments:
+            return
+        with self._lock:
+            if patient_id in self._pending:
+                return
+            self._pending.add(patient_id)
+        self._queue.put(patient_id)
+
+    def _run(self):
+        while True:
+            patient_id = self._queue.get()
+            with self._lock:
+                self._pending.discard(patient_id)
+            try:
+                self.store.compact(patient_id, self.small_rows)
+            except Exception as e:
+                metrics.incr("segments.compaction_errors")
+                logging.error(f"Compaction failed for patient {patient_id}: {e}")
+
+
+def _newer_document(latest, documents):
+    """Return the newest of ``latest`` and ``documents`` (earliest wins ties)."""
+    candidates = ([latest] if latest else []) + list(documents)
+    timestamps = to_datetime64(doc["timestamp"] for doc in candidates)
+    newest = candidates[int(np.argmax(timestamps))]
+    return {"text": newest["text"], "timestamp": str(newest["timestamp"])}